@@ -0,0 +1,113 @@
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+
+from snappy import cmd
+from snappy import scan
+
+
+# -----------------------------------------------------------
+#  Compare `find <src> -type f ! -readable` (plus the old
+#  per-line post-processing) against snappy.scan on a
+#  synthetic tree. Run with: python -m benchmarks.bench_scan
+# -----------------------------------------------------------
+
+
+def make_tree(root, files, per_folder = 1000, fanout = 10, unreadable_every = 10000) -> None:
+
+    # - folders are nested `fanout` wide so that the tree has some depth
+
+    n_folders = max(1, files // per_folder)
+    count = 0
+    for idx in range(n_folders):
+        parts = []
+        value = idx
+        while True:
+            parts.append(f"d{value % fanout}")
+            value //= fanout
+            if value == 0:
+                break
+
+        folder = os.path.join(root, *parts, f"leaf{idx}")
+        os.makedirs(folder, exist_ok = True)
+        for jdx in range(per_folder):
+            if count >= files:
+                return None
+
+            path = os.path.join(folder, f"f{jdx}")
+            with open(path, "w"):
+                pass
+
+            if count % unreadable_every == 0:
+                os.chmod(path, 0o200)
+
+            count += 1
+
+
+def find_non_readable(src):
+
+    out = cmd.find_non_readable(src)
+    files = out.stdout.decode("utf-8").split("\n")
+    files = (f.strip() for f in files)
+    files = [f for f in files if f != ""]
+
+    for idx, nr in enumerate(files):
+        nr = re.sub(f"^{src}", "", nr)
+        if not nr.startswith(os.path.sep):
+            nr = os.path.sep + nr
+        files[idx] = nr
+
+    return files
+
+
+def native_non_readable(src, workers):
+    return list(scan.iter_non_readable(src, max_workers = workers))
+
+
+def timeit(func, *args, repeat = 3):
+
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def main(argv = None) -> int:
+
+    parser = argparse.ArgumentParser(prog = "bench_scan")
+    parser.add_argument("--files", type = int, default = 1000000, help = "number of files in the synthetic tree")
+    parser.add_argument("--workers", type = int, default = scan.SCAN_WORKERS, help = "scanner threads")
+    parser.add_argument("--repeat", type = int, default = 3, help = "runs per method, best is reported")
+    parser.add_argument("--dir", default = None, help = "where to create the tree (default: system tmp)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir = args.dir) as root:
+
+        src = os.path.join(root, "src")
+        start = time.perf_counter()
+        make_tree(src, args.files)
+        print(f"Created {args.files} files in {time.perf_counter() - start:.1f}s")
+
+        t_find, r_find = timeit(find_non_readable, src, repeat = args.repeat)
+        t_scan, r_scan = timeit(native_non_readable, src, args.workers, repeat = args.repeat)
+
+        if sorted(r_find) != sorted(r_scan):
+            print("Warning: find and scan disagree on the non-readable files", file = sys.stderr)
+
+        print(f"find + post-processing : {t_find:8.3f}s ({len(r_find)} files)")
+        print(f"scan ({args.workers:2d} workers)      : {t_scan:8.3f}s ({len(r_scan)} files)")
+        print(f"speedup                : {t_find / t_scan:8.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
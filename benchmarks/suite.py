@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import datetime
+import tempfile
+import statistics
+import subprocess
+
+from snappy import snappy as snp
+from snappy import logs
+from snappy.rsync import is_rsync_installed, _pump
+from benchmarks import trees
+
+
+# --------------------------------------------------------------
+#  Benchmark suite of the snapshot pipeline. Run with:
+#
+#      python -m benchmarks.suite --output results.json
+#      python -m benchmarks.suite --baseline results.json
+#
+#  Every case is timed --repeat times on a fresh copy of its
+#  synthetic tree and the median is reported. Results are saved
+#  as JSON and compared against a previous run (the baseline)
+# --------------------------------------------------------------
+
+CASES = {}
+
+# - default allowed slowdown against the baseline before a
+# - measurement is reported as a regression
+
+THRESHOLD = 0.10
+
+
+def case(name):
+
+    def register(func):
+        CASES[name] = func
+        return func
+
+    return register
+
+
+@case("snap_backup")
+def bench_snap_backup(root, scale):
+
+    # - first run copies everything, the incremental run hard links
+    # - the unchanged files to the first snapshot
+
+    if not is_rsync_installed():
+        return None
+
+    results = {}
+    for profile in trees.TREES:
+        src = trees.make(profile, os.path.join(root, profile, "src"), scale)
+        dst = os.path.join(root, profile, "dst")
+
+        start = time.perf_counter()
+        snp.snap_backup([src], dst, max_backups = 3)
+        results[f"{profile}.first"] = time.perf_counter() - start
+
+        # - snapshot names have a resolution of one second
+
+        time.sleep(1)
+        trees.touch(src)
+        start = time.perf_counter()
+        snp.snap_backup([src], dst, max_backups = 3)
+        results[f"{profile}.incremental"] = time.perf_counter() - start
+
+    return results
+
+
+@case("non_readable")
+def bench_non_readable(root, scale):
+
+    results = {}
+    for profile in ["tiny", "deep", "unreadable"]:
+        src = trees.make(profile, os.path.join(root, profile), scale)
+
+        start = time.perf_counter()
+        snp._list_non_readable_files(src)
+        results[profile] = time.perf_counter() - start
+
+    return results
+
+
+@case("clean_backups")
+def bench_clean_backups(root, scale, snapshots = 5):
+
+    # - snapshots are hard linked copies of each other, as created
+    # - by rsync --link-dest, so most inodes have several links
+
+    src = trees.make("tiny", os.path.join(root, "src"), scale)
+    dst = os.path.join(root, "dst")
+    for idx in range(snapshots):
+        _link_copy(src, os.path.join(dst, f"2000-01-0{idx + 1}-00_00_00"))
+
+    start = time.perf_counter()
+    snp.clean_backups(dst, 1)
+    return {"tiny" : time.perf_counter() - start}
+
+
+@case("log")
+def bench_log(root, scale):
+
+    # - one line per file, as logged by rsync -v, written through the
+    # - log handler with each compression
+
+    lines = trees.SCALES[scale]["tiny"] * 4
+    results = {}
+    for compression in logs.COMPRESSIONS:
+        if (compression == "zstd") and (logs.zstandard is None):
+            continue
+
+        lg = logging.getLogger(f"snappy.benchmark.{compression}")
+        lg.propagate = False
+        lg.setLevel(logging.DEBUG)
+        hl = logs.CompressedFileHandler(os.path.join(root, "run" + logs.extension(compression)), compression)
+        hl.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        lg.addHandler(hl)
+
+        start = time.perf_counter()
+        try:
+            for idx in range(lines):
+                lg.info(f">f+++++++++ home/user/folder{idx % 97}/file{idx}.txt")
+        finally:
+            lg.removeHandler(hl)
+            hl.close()
+
+        results[f"{compression}.{lines}_lines"] = time.perf_counter() - start
+
+    return results
+
+
+@case("pump")
+def bench_pump(root, scale):
+
+    # - rsync -v output of a tree with many changes pumped through the
+    # - snappy loggers, writing synchronously or through the queue.
+    # - "pump" is the time until the child output is consumed, "total"
+    # - also waits for the records to be written
+
+    lines = trees.SCALES[scale]["tiny"] * 4
+    code = f"for idx in range({lines}): print(f'>f+++++++++ home/user/folder{{idx % 97}}/file{{idx}}.txt')"
+    results = {}
+
+    with open(os.devnull, "w") as devnull:
+        for mode in ["sync", "queue", "queue_summary"]:
+            console = logs.SummaryStreamHandler(devnull) if mode == "queue_summary" else logging.StreamHandler(devnull)
+            file = logs.CompressedFileHandler(os.path.join(root, f"{mode}.log.gz"))
+            for hl in [console, file]:
+                hl.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+            hl = logs.QueueHandler([console, file]) if mode != "sync" else None
+            lg = logging.getLogger(f"snappy.benchmark.pump.{mode}")
+            lg.propagate = False
+            lg.setLevel(logging.DEBUG)
+            for h in ([console, file] if hl is None else [hl]):
+                lg.addHandler(h)
+
+            start = time.perf_counter()
+            try:
+                proc = subprocess.Popen([sys.executable, "-c", code], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+                _pump(proc, lg)
+                results[f"{mode}.pump"] = time.perf_counter() - start
+            finally:
+                for h in list(lg.handlers):
+                    lg.removeHandler(h)
+                    h.close()
+                console.close()
+                file.close()
+
+            results[f"{mode}.total"] = time.perf_counter() - start
+
+    return results
+
+
+def run(names, scale = "small", repeat = 3, folder = None) -> dict:
+
+    samples = {}
+    skipped = []
+    for name in names:
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory(dir = folder) as root:
+                out = CASES[name](root, scale)
+
+            if out is None:
+                skipped.append(name)
+                break
+
+            for key, seconds in out.items():
+                samples.setdefault(f"{name}.{key}", []).append(seconds)
+
+            print(".", end = "", flush = True)
+
+    print("")
+    return {
+        "meta" : _meta(scale, repeat, skipped),
+        "results" : {k : {
+            "median" : statistics.median(v),
+            "min" : min(v),
+            "max" : max(v),
+            "samples" : v,
+        } for k, v in samples.items()},
+    }
+
+
+def compare(current, baseline) -> list:
+
+    # - returns (name, baseline, current, ratio) for every measurement
+    # - found in both runs
+
+    rows = []
+    for name, res in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+
+        ratio = res["median"] / base["median"] if base["median"] > 0 else float("inf")
+        rows.append((name, base["median"], res["median"], ratio))
+
+    return rows
+
+
+def report(current, baseline = None, threshold = THRESHOLD) -> int:
+
+    # - prints the results and returns the number of regressions
+
+    if baseline is None:
+        for name, res in current["results"].items():
+            print(f"{name:40s} {res['median']:10.3f}s")
+        return 0
+
+    regressions = 0
+    print(f"{'case':40s} {'baseline':>10s} {'current':>10s} {'ratio':>8s}")
+    for name, base, cur, ratio in compare(current, baseline):
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  slower"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+
+        print(f"{name:40s} {base:9.3f}s {cur:9.3f}s {ratio:7.2f}x{flag}")
+
+    return regressions
+
+
+def main(argv = None) -> int:
+
+    parser = argparse.ArgumentParser(prog = "suite")
+    parser.add_argument("cases", nargs = "*", default = list(CASES), help = f"cases to run (default: all of {', '.join(CASES)})")
+    parser.add_argument("--scale", default = "small", choices = list(trees.SCALES), help = "size of the synthetic trees")
+    parser.add_argument("--repeat", type = int, default = 3, help = "runs per case, the median is reported")
+    parser.add_argument("--dir", default = None, help = "where to create the trees (default: system tmp)")
+    parser.add_argument("-o", "--output", default = None, help = "save the results as JSON")
+    parser.add_argument("-b", "--baseline", default = None, help = "compare against the JSON results of a previous run")
+    parser.add_argument("--threshold", type = float, default = THRESHOLD, help = "relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    unknown = [c for c in args.cases if c not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    # - keep the snappy logs out of the timings output
+
+    logging.getLogger("snappy").setLevel(logging.WARNING)
+
+    current = run(args.cases, args.scale, args.repeat, args.dir)
+    for name in current["meta"]["skipped"]:
+        print(f"Skipped {name}: rsync is not installed", file = sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent = 1)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+        if baseline["meta"]["scale"] != current["meta"]["scale"]:
+            print("Warning: baseline was run with a different scale", file = sys.stderr)
+
+    regressions = report(current, baseline, args.threshold)
+    return 1 if regressions else 0
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _link_copy(src, dst):
+
+    for folder, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(folder, src))
+        os.makedirs(target, exist_ok = True)
+        for name in files:
+            os.link(os.path.join(folder, name), os.path.join(target, name))
+
+
+def _meta(scale, repeat, skipped):
+
+    try:
+        out = subprocess.run(["rsync", "--version"], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+        rsync = out.stdout.decode("utf8").split("\n")[0]
+    except OSError:
+        rsync = None
+
+    return {
+        "date" : datetime.datetime.now().isoformat(timespec = "seconds"),
+        "scale" : scale,
+        "repeat" : repeat,
+        "skipped" : skipped,
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "cpus" : os.cpu_count(),
+        "rsync" : rsync,
+    }
+
+
+if __name__ == "__main__":
+    sys.exit(main())
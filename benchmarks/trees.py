@@ -0,0 +1,96 @@
+import os
+import random
+
+from benchmarks.bench_scan import make_tree
+
+
+# ------------------------------------------------------------
+#  Synthetic source trees for the benchmark suite. Every tree
+#  is generated from a fixed seed so that runs are comparable
+# ------------------------------------------------------------
+
+SEED = 1234
+
+# - number of files (or MB for the huge tree) per scale
+
+SCALES = {
+    "small" : {"tiny" : 5000, "huge" : 64, "deep" : 2000, "unreadable" : 5000},
+    "medium" : {"tiny" : 50000, "huge" : 512, "deep" : 20000, "unreadable" : 50000},
+    "large" : {"tiny" : 500000, "huge" : 4096, "deep" : 200000, "unreadable" : 500000},
+}
+
+
+def tiny_files(root, n) -> None:
+
+    # - many empty files spread over a shallow tree
+
+    make_tree(root, n, per_folder = 500, unreadable_every = n + 1)
+
+
+def huge_files(root, megabytes, files = 4) -> None:
+
+    # - a few large files of random data, so that rsync cannot
+    # - compress them and the transfer is bound by I/O
+
+    os.makedirs(root, exist_ok = True)
+    rnd = random.Random(SEED)
+    chunk = 1024 ** 2
+    per_file = max(1, megabytes // files)
+    for idx in range(files):
+        with open(os.path.join(root, f"huge{idx}.bin"), "wb") as f:
+            for _ in range(per_file):
+                f.write(rnd.getrandbits(8 * chunk).to_bytes(chunk, "little"))
+
+
+def deep_tree(root, n, depth = 64) -> None:
+
+    # - small files along long chains of nested folders
+
+    chains = max(1, n // depth)
+    for idx in range(chains):
+        folder = root
+        for level in range(depth):
+            folder = os.path.join(folder, f"c{idx}l{level}")
+            os.makedirs(folder, exist_ok = True)
+            with open(os.path.join(folder, "file.txt"), "w") as f:
+                f.write(f"{idx} {level}\n")
+
+
+def unreadable_files(root, n, every = 100) -> None:
+
+    # - one file in every `every` has no read permission
+
+    make_tree(root, n, per_folder = 500, unreadable_every = every)
+
+
+TREES = {
+    "tiny" : tiny_files,
+    "huge" : huge_files,
+    "deep" : deep_tree,
+    "unreadable" : unreadable_files,
+}
+
+
+def make(profile, root, scale = "small") -> str:
+
+    TREES[profile](root, SCALES[scale][profile])
+    return root
+
+
+def touch(root, every = 100) -> int:
+
+    # - modify one file in every `every` to simulate the changes
+    # - between two snapshots. Returns the number of changed files
+
+    count = 0
+    changed = 0
+    for folder, _, files in os.walk(root):
+        for name in sorted(files):
+            path = os.path.join(folder, name)
+            if (count % every == 0) and os.access(path, os.W_OK):
+                with open(path, "a") as f:
+                    f.write("changed\n")
+                changed += 1
+            count += 1
+
+    return changed
@@ -0,0 +1,331 @@
+import os
+import time
+import asyncio
+import datetime
+import logging
+import functools
+import tempfile
+import subprocess
+from asyncio.subprocess import PIPE
+
+from .rsync import (
+    logger as rsync_logger,
+    READ_SIZE,
+    MAX_CAPTURED_LINES,
+    _OutputBuffer,
+    probe,
+    select_options,
+    _pausable,
+)
+
+from .cmd import _fs_cmd_args
+from .prune import PRUNE_WORKERS
+from .destination import get_destination, is_remote
+from .stats import TransferStats, SnapshotResult
+from . import snappy as snp
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+
+async def rsync(src, dst, options = None, log = None, on_line = None, pressure = None):
+
+    # -------------------------------------------------------
+    #  Same as snappy.rsync.rsync but driven by the event loop.
+    #  If the task is cancelled the rsync child is terminated
+    # -------------------------------------------------------
+
+    if log is None:
+        log = rsync_logger
+
+    args = _fs_cmd_args(src, dst, options)
+    if is_remote(dst):
+        args.dst = dst
+
+    pressure = _pausable(pressure, dst, log)
+    default = "-av"
+
+    info = await _in_thread(probe)
+    opt = [default] + select_options(args.options, info, is_remote(dst))
+    cmd = [info.path if info is not None else "rsync"] + opt + [args.src, args.dst]
+    log.debug(f"Running command {cmd}")
+
+    def stdout_line(line):
+        log.info(line)
+        if on_line is not None:
+            on_line(line)
+
+    stdout = _OutputBuffer(MAX_CAPTURED_LINES, stdout_line)
+    stderr = _OutputBuffer(MAX_CAPTURED_LINES, log.debug)
+
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout = PIPE, stderr = PIPE, start_new_session = pressure is not None)
+    if pressure is not None:
+        pressure.attach(proc, log)
+
+    try:
+        await asyncio.gather(
+            _read_stream(proc.stdout, stdout),
+            _read_stream(proc.stderr, stderr),
+        )
+        await proc.wait()
+
+    except BaseException:
+
+        # - a paused rsync must be continued to handle SIGTERM
+
+        if pressure is not None:
+            pressure.detach()
+        await _terminate(proc, log)
+        raise
+
+    finally:
+        if pressure is not None:
+            pressure.detach()
+
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout.text(), stderr.text())
+
+
+async def create_snapshot(sources: list, destination: os.PathLike, rsync_args = None, max_workers = 1, rescan = False, on_line = None, pressure = None, batch = False, fast_path = None, journal = None) -> list:
+
+    # ------------------------------------------------
+    #  Create a backup of each source to destination
+    #  Destination will contain each source
+    # ------------------------------------------------
+
+    if rsync_args is None:
+        rsync_args = []
+
+    dst = destination if is_remote(destination) else ut.normalize_path(destination)
+    if dst[-1] != os.path.sep:
+        dst += os.path.sep
+
+    sources = snp._check_sources(sources)
+    linked = []
+    if fast_path is not None:
+        sources, linked = await _in_thread(snp._link_unchanged, sources, dst, fast_path)
+        if not sources:
+            return linked
+
+    if journal is not None:
+        sources, synced = await _in_thread(snp._sync_changed, sources, dst, rsync_args, journal)
+        linked += synced
+        if not sources:
+            return linked
+
+    if batch and (len(sources) > 1):
+        return linked + [await _snapshot_batch(sources, dst, rsync_args, rescan, on_line, pressure)]
+
+    prefix = len(sources) > 1 and max_workers > 1
+    semaphore = asyncio.Semaphore(max(max_workers, 1))
+
+    async def run(src):
+        async with semaphore:
+            name = snp._source_name(src) if prefix else None
+            return await _snapshot_source(src, dst, rsync_args, name, rescan, on_line, pressure)
+
+    tasks = [asyncio.ensure_future(run(src)) for src in sources]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+    except BaseException:
+        await _cancel(tasks)
+        raise
+
+    failed = [t for t in done if t.exception() is not None]
+    if failed:
+
+        # - stop every other source so that the temporary folder can be removed
+
+        await _cancel(pending)
+        raise failed[0].exception()
+
+    return linked + [t.result() for t in tasks]
+
+
+async def snap_backup(
+    sources: list,
+    backup_folder: os.PathLike,
+    max_backups = 3,
+    rsync_args = None,
+    max_workers = 1,
+    rescan = False,
+    prune_mode = "inline",
+    prune_workers = PRUNE_WORKERS,
+    prune_max_rate = None,
+    pressure = None,
+    batch = False,
+    on_line = None,
+    link_dest = 1,
+    fast_path = False,
+    journal = False,
+) -> SnapshotResult:
+
+    if rsync_args is None:
+        rsync_args = []
+
+    snp._check_link_dest(link_dest)
+
+    start = datetime.datetime.now()
+    dry_run = "--dry-run" in rsync_args
+    dest = get_destination(backup_folder)
+
+    try:
+
+        # - the thread of _begin_backup cannot be interrupted, so a
+        # - cancellation waits for it and rolls back what it started
+
+        begin = asyncio.ensure_future(_in_thread(snp._begin_backup, dest, sources, rsync_args, dry_run, link_dest, fast_path, journal))
+        try:
+            dest, new, tmp, rsync_args, fast, changes = await asyncio.shield(begin)
+        except asyncio.CancelledError:
+            logger.error("Backup was cancelled")
+            await _rollback_begun(begin)
+            raise
+
+        try:
+            logger.info("Creating backup snapshot...")
+            stats = await create_snapshot(sources, dest.target(tmp), rsync_args, max_workers = max_workers, rescan = rescan, on_line = on_line, pressure = pressure, batch = batch, fast_path = fast, journal = changes)
+
+        except asyncio.CancelledError:
+            logger.error("Backup was cancelled")
+            await _in_thread(snp._rollback, dest, tmp, new)
+            raise
+
+        except Exception as err:
+            await _in_thread(snp._rollback, dest, tmp, new)
+            raise RuntimeError from err
+
+        return await _in_thread(snp._end_backup, dest, new, tmp, start, stats, rsync_args, max_backups, prune_mode, prune_workers, prune_max_rate, fast, changes)
+
+    finally:
+        await _in_thread(dest.close)
+
+
+async def clean_backups(path: os.PathLike, n: int, mode = "inline", workers = PRUNE_WORKERS, max_rate = None):
+    return await _in_thread(snp.clean_backups, path, n, mode, workers, max_rate)
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+async def _snapshot_source(src, dst, rsync_args, prefix = None, rescan = False, on_line = None, pressure = None) -> TransferStats:
+
+    # - same as snappy.snappy._snapshot_source
+
+    lg, rlg, options, stats = await _in_thread(snp._start_source, src, rsync_args, prefix, rescan)
+    watch = await _in_thread(snp._wait_pressure, pressure, lg, src)
+
+    try:
+        start = time.monotonic()
+        output = await rsync(src, dst, options, log = rlg, on_line = _feed(stats, on_line), pressure = watch)
+
+        if snp._needs_rescan(output, rescan):
+            options, stats = await _in_thread(snp._rescan_source, src, rsync_args, lg)
+            output = await rsync(src, dst, options, log = rlg, on_line = _feed(stats, on_line), pressure = watch)
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        raise snp._transfer_error(lg, err) from err
+
+    snp._end_source(src, output, stats, lg, time.monotonic() - start, watch)
+    return stats
+
+
+async def _snapshot_batch(sources, dst, rsync_args, rescan = False, on_line = None, pressure = None) -> TransferStats:
+
+    # - same as snappy.snappy._snapshot_batch
+
+    excludes, stats = await _in_thread(snp._start_batch, sources, rsync_args, rescan)
+    watch = await _in_thread(snp._wait_pressure, pressure, logger)
+
+    with tempfile.NamedTemporaryFile(prefix = "snappy-files-") as files:
+        files.write(snp._batch_list(sources))
+        files.flush()
+        options = snp._batch_rsync_options(rsync_args, files.name) + excludes
+
+        try:
+            start = time.monotonic()
+            output = await rsync(os.path.sep, dst, options, on_line = _feed(stats, on_line), pressure = watch)
+
+            if snp._needs_rescan(output, rescan):
+                logger.warning("rsync could not read some files. Scanning the sources again for non-readable files")
+                excludes, stats = await _in_thread(snp._start_batch, sources, rsync_args, True)
+                options = snp._batch_rsync_options(rsync_args, files.name) + excludes
+                output = await rsync(os.path.sep, dst, options, on_line = _feed(stats, on_line), pressure = watch)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            raise snp._transfer_error(logger, err) from err
+
+    snp._end_batch(sources, output, stats, time.monotonic() - start, watch)
+    return stats
+
+
+def _feed(stats, on_line = None):
+
+    def feed(line):
+        stats.feed(line)
+        if on_line is not None:
+            on_line(line)
+
+    return feed
+
+
+async def _rollback_begun(begin) -> None:
+
+    # - begin is the future of snp._begin_backup, which rolls back
+    # - by itself if it fails
+
+    try:
+        dest, new, tmp, *_ = await begin
+    except Exception:
+        return None
+
+    await _in_thread(snp._rollback, dest, tmp, new)
+
+
+async def _read_stream(stream, buffer):
+
+    while True:
+        data = await stream.read(READ_SIZE)
+        if not data:
+            buffer.close()
+            return None
+
+        buffer.feed(data)
+
+
+async def _terminate(proc, log, timeout = 10):
+
+    if proc.returncode is not None:
+        return None
+
+    log.warning(f"Terminating rsync process {proc.pid}")
+    try:
+        proc.terminate()
+    except ProcessLookupError:
+        return None
+
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+async def _cancel(tasks):
+
+    for t in tasks:
+        t.cancel()
+
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def _in_thread(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import hashlib
+import socket
+import logging
+import datetime
+from .destination import LocalDestination
+
+
+logger = logging.getLogger(__name__)
+
+CATALOG = ".snappy-catalog.json"
+MAX_FAILED = 20
+
+# - snapshot names are created by snap_backup, temporary folders
+# - are the md5 hash of the snapshot name
+
+SNAPSHOT_FORMAT = "%Y-%m-%d-%H_%M_%S"
+TMP_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class Catalog:
+
+    # -----------------------------------------------------------------
+    #  Record of the snapshots in a backup folder, saved as JSON in the
+    #  folder itself. Each entry is a dictionary with the keys:
+    #  * name: folder name of the snapshot
+    #  * status: running, complete, failed or incomplete
+    #  * start / end: ISO timestamps, None if unknown
+    #  * sources: list of backed up sources
+    #  * size: bytes in the snapshot, None if unknown
+    #  * pid / host: process creating a running snapshot
+    #  Files are read and written with fs, a destination of the backup
+    #  folder (local if None)
+    # -----------------------------------------------------------------
+
+    version = 1
+
+    def __init__(self, path: os.PathLike, entries = None, fs = None) -> None:
+
+        self.fs = LocalDestination(path) if fs is None else fs
+        self.path = self.fs.path if fs is None else path
+        self.entries = {}
+        for e in (entries or []):
+            self.entries[e["name"]] = e
+
+    @property
+    def file(self) -> str:
+        return os.path.join(self.path, CATALOG)
+
+    @classmethod
+    def load(cls, path: os.PathLike, fs = None):
+
+        # - fall back to the folder contents if there is no usable catalog
+
+        catalog = cls(path, fs = fs)
+        file = catalog.file
+        try:
+            data = json.loads(catalog.fs.read_text(file))
+        except FileNotFoundError:
+            return cls.rebuild(path, fs)
+        except (OSError, ValueError) as err:
+            logger.warning(f"Cannot read snapshot catalog {file}: {err}")
+            logger.warning("Rebuilding catalog from disk")
+            return cls.rebuild(path, fs)
+
+        if data.get("version") != cls.version:
+            logger.warning(f"Unknown catalog version in {file}. Rebuilding catalog from disk")
+            return cls.rebuild(path, fs)
+
+        return cls(path, data.get("snapshots", []), fs)
+
+    @classmethod
+    def rebuild(cls, path: os.PathLike, fs = None):
+
+        # - folders named by snap_backup are complete snapshots and
+        # - temporary folders incomplete ones. Other folders, e.g.
+        # - lost+found, are not snapshots and are left out
+
+        catalog = cls(path, fs = fs)
+        for name in catalog.fs.folders(catalog.path):
+            start = _name_to_time(name)
+            if start is not None:
+                catalog.entries[name] = new_entry(name, "complete", start = start)
+            elif TMP_PATTERN.match(name):
+                catalog.entries[name] = new_entry(name, "incomplete")
+
+        return catalog
+
+    def save(self) -> None:
+
+        data = {
+            "version" : self.version,
+            "snapshots" : [self.entries[k] for k in sorted(self.entries)],
+        }
+
+        self.fs.write_text(self.file, json.dumps(data, indent = 1))
+
+    def snapshots(self, status = "complete") -> list:
+
+        # - entries sorted from oldest to newest
+
+        entries = (self.entries[k] for k in sorted(self.entries))
+        if status is None:
+            return list(entries)
+
+        return [e for e in entries if e["status"] == status]
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def update(self, name, **fields) -> dict:
+
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = new_entry(name)
+            self.entries[name] = entry
+
+        entry.update(fields)
+        return entry
+
+    def remove(self, name) -> None:
+        self.entries.pop(name, None)
+
+    def trim_failed(self, keep = MAX_FAILED) -> None:
+
+        failed = self.snapshots("failed")
+        for e in failed[:max(len(failed) - keep, 0)]:
+            self.remove(e["name"])
+
+
+def new_entry(name, status = "running", start = None, end = None, sources = None, size = None) -> dict:
+    return {
+        "name" : name,
+        "status" : status,
+        "start" : start,
+        "end" : end,
+        "sources" : list(sources or []),
+        "size" : size,
+    }
+
+
+def is_running(entry) -> bool:
+
+    # - whether the process of a running entry is alive. A process of
+    # - another host is assumed to be, one that was not recorded is not
+
+    if entry["status"] != "running":
+        return False
+
+    pid = entry.get("pid")
+    if not pid:
+        return False
+
+    if entry.get("host") != socket.gethostname():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def tmp_name(name) -> str:
+    return hashlib.md5(name.encode("utf8")).hexdigest()
+
+
+def now() -> str:
+    return datetime.datetime.now().isoformat(timespec = "seconds")
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _name_to_time(name):
+    try:
+        return datetime.datetime.strptime(name, SNAPSHOT_FORMAT).isoformat(timespec = "seconds")
+    except ValueError:
+        return None
@@ -1,13 +1,31 @@
 import os
 import io
+import json
+import time
+import cProfile
 import logging
+import signal
 import datetime
 import argparse
-import subprocess
+import threading
 from .rsync import RsyncError
-from .cmd import mv
+from .catalog import Catalog, SNAPSHOT_FORMAT
 from . import config as cfg
 from . import snappy as snp
+from . import prune
+from . import dedup
+from . import verify
+from . import diff
+from . import journal
+from . import inotify
+from . import daemon
+from .lock import DestinationLock, LockedError
+from . import metrics
+from . import spans
+from . import logs
+from .resources import Resources
+from .pressure import PressureGate
+from . import destination
 from . import utils as ut
 
 logger = logging.getLogger("snappy")
@@ -64,27 +82,27 @@ def config_path() -> None:
     print(f"Path: {ut.normalize_path(cfg.config_loc())}")
 
 
-def run_backup(verbose = True, dry_run = True) -> None:
+def run_backup(verbose = True, dry_run = True, rescan = False, trace = False, profile = False, config = None) -> None:
     
     _configure_logger(verbose)
 
-    config = cfg.read_config()
+    config = cfg.read_config() if config is None else config
     if not cfg.is_valid_config(config):
         msg = "Config file is invalid. Please fix the file and try again."
         logger.error(msg)
         raise cfg.InvalidConfigError(msg)
+
+    # - the log file is created on the first record, so nothing has
+    # - been written before the configured handler replaces it
+
+    _configure_logger(verbose, **_log_options(config))
     
     # -------------------------
     #  Source and destination
     # -------------------------
 
-    dst = config["Destination"]["folder"]
-    src = config["Sources"].keys()
-    src = filter(lambda x: x is not None, src)
-    src = filter(lambda x: x != "", src)
-    src = filter(lambda x: not is_comment(x), src)
-    src = [s.strip() for s in src]
-    dst = dst.strip()
+    dst = destination.from_config(config, _destination(config))
+    src = _sources(config)
 
     # ------------------------
     #  Number of max backups
@@ -116,30 +134,330 @@ def run_backup(verbose = True, dry_run = True) -> None:
 
     args += rsync_include
 
+    # - bandwidth limit
+
+    resources = Resources.from_config(config)
+    args += resources.rsync_args()
+
     # - Dry run
 
     if dry_run:
         args.append("--dry-run")
 
+    # ---------------------
+    #  Snapshot execution
+    # ---------------------
+
+    max_workers = config.getint("snapshot", "max_workers", fallback = 1)
+    batch = config.getboolean("snapshot", "batch", fallback = False)
+    link_dest = config.getint("snapshot", "link_dest", fallback = 1)
+    fast_path = config.getboolean("snapshot", "fast_path", fallback = False)
+    use_journal = config.getboolean("snapshot", "journal", fallback = False)
+    prune_mode = config.get("prune", "mode", fallback = "inline").strip()
+    prune_workers = config.getint("prune", "workers", fallback = prune.PRUNE_WORKERS)
+    dedup_after = config.getboolean("dedup", "after_backup", fallback = False)
+
+    # --------------------------------------------------------
+    #  CPU and I/O priority, inherited by rsync and the reaper
+    # --------------------------------------------------------
+
+    resources.apply()
+
+    # - pause rsync while the system is under pressure
+
+    pressure = PressureGate.from_config(config)
+
+    # ----------------------
+    #  Tracing and profiling
+    # ----------------------
+
+    if trace or profile:
+        spans.enable()
+
+    profiler = cProfile.Profile() if profile else None
+
     # ---------------
     #  Start backup
     # ---------------
 
+    start = time.perf_counter()
     now = datetime.datetime.now()
     msg = f"Starting backup on {now.strftime('%d-%b-%Y')} at {now.strftime('%H:%M:%S')}"
     logger.info(msg)
     logger.info("=" * len(msg))
 
+    # - a dry run does not change the destination
+
+    lock = DestinationLock(dst)
+    result = None
     try:
-        backup_folder = snp.snap_backup(src, dst, size, args)
-    except Exception as err:
-        msg = "There was an error when creating the backup"
-        logger.error(msg)
-        raise RsyncError(msg) from err
+        if not dry_run:
+            lock.acquire()
+
+        if profiler is not None:
+            profiler.enable()
+
+        try:
+            with spans.span("snap_backup"):
+                result = snp.snap_backup(
+                    src,
+                    dst,
+                    size,
+                    args,
+                    max_workers = max_workers,
+                    rescan = rescan,
+                    prune_mode = prune_mode,
+                    prune_workers = prune_workers,
+                    prune_max_rate = resources.max_delete_rate,
+                    pressure = pressure,
+                    batch = batch,
+                    link_dest = link_dest,
+                    fast_path = fast_path,
+                    journal = use_journal,
+                )
+        except Exception as err:
+            msg = "There was an error when creating the backup"
+            logger.error(msg)
+            raise RsyncError(msg) from err
+
+        if dedup_after:
+            _dedup_after_backup(config, dst, result)
+
+        with spans.span("rename_log"):
+            _rename_log(logger, result.name)
+
+        with spans.span("save_result"):
+            _save_result(result)
+
+        textfile = metrics.textfile(config)
+        if (textfile is not None) and (not result.dry_run):
+            with spans.span("metrics"):
+                result.phases["total"] = time.perf_counter() - start
+                snapshots = len(snp.get_backup_folders(dst))
+                metrics.record_success(textfile, result, snapshots)
+
+    finally:
+        lock.release()
+        dst.close()
+        for hl in logger.handlers:
+            hl.flush()
+
+        if profiler is not None:
+            profiler.disable()
+            _save_profile(profiler, now if result is None else result.name)
+
+        if spans.tracer.enabled:
+            _print_spans(time.perf_counter() - start)
+            spans.disable()
 
-    _compress_log(logger, backup_folder)
     logger.info("Backup complete!")
 
+
+def run_prune(verbose = True, folder = None, workers = None, max_rate = None, config = None) -> None:
+
+    _configure_logger(verbose)
+
+    # - the configuration file is only needed for missing arguments.
+    # - The background reaper gets them all and inherits the priority
+    # - of the backup process
+
+    if (folder is None) or (workers is None) or (max_rate is None):
+
+        config = _read_valid_config() if config is None else config
+        if folder is None:
+            folder = destination.from_config(config, _destination(config))
+
+        if workers is None:
+            workers = config.getint("prune", "workers", fallback = prune.PRUNE_WORKERS)
+
+        resources = Resources.from_config(config)
+        if max_rate is None:
+            max_rate = resources.max_delete_rate
+
+        resources.apply()
+
+    # - stale snapshots are only trashed under the lock of snap, which
+    # - already did so if it is running, e.g. when it started this
+    # - reaper. A remote trash is deleted with rm on the remote host
+
+    with destination.get_destination(folder) as dest:
+        lock = DestinationLock(dest)
+        try:
+            lock.acquire()
+        except LockedError:
+            logger.info(f"A snapshot of {dest} is running. Only its trash is deleted")
+        else:
+            try:
+                snp.trash_stale(dest)
+            finally:
+                lock.release()
+
+        if dest.remote:
+            dest.reap(max_rate = max_rate)
+        else:
+            prune.reap(dest.path, workers, max_rate)
+
+
+def run_dedup(verbose = True, folder = None, workers = None, config = None) -> None:
+
+    _configure_logger(verbose)
+
+    config = _read_valid_config() if config is None else config
+    if folder is None:
+        folder = _destination(config)
+
+    options = _dedup_options(config)
+    if workers is not None:
+        options["workers"] = workers
+
+    Resources.from_config(config).apply()
+    dedup.dedup(folder, **options)
+
+
+def run_watch(verbose = True) -> None:
+
+    _configure_logger(verbose)
+
+    config = _read_valid_config()
+    _configure_logger(verbose, **_log_options(config))
+
+    if not inotify.is_supported():
+        raise OSError("inotify is not available on this system")
+
+    # - SIGTERM and SIGINT stop watching once the changes are saved
+
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *args: stop.set())
+
+    sources = _sources(config)
+    logger.info(f"Watching {len(sources)} sources for changes")
+    journal.watch(sources, stop = stop)
+    logger.info("Stopped watching")
+
+
+def run_verify(verbose = True, snapshot = None, folder = None, manifest = False, workers = None, config = None) -> bool:
+
+    # - True if the snapshot is intact
+
+    _configure_logger(verbose)
+
+    config = _read_valid_config() if config is None else config
+    if folder is None:
+        folder = _destination(config)
+
+    if workers is None:
+        workers = config.getint("verify", "workers", fallback = verify.VERIFY_WORKERS)
+
+    exclude = [ut.substitute_tilde(e) for e in _process_rsync_patterns(config, "rsync.exclude") if not is_comment(e)]
+
+    Resources.from_config(config).apply()
+    mode = "manifest" if manifest else "sources"
+    stats = verify.verify(folder, snapshot, mode, workers, exclude)
+    return stats.ok
+
+
+def run_daemon(verbose = True, trigger = None, status = False) -> None:
+
+    # - with trigger or status, the request is sent to the running
+    # - daemon and its reply printed
+
+    _configure_logger(verbose)
+    config = _read_valid_config()
+    path = daemon.socket_from_config(config)
+
+    if (trigger is not None) or status:
+        print(daemon.send("status" if status else trigger, path))
+        return None
+
+    _configure_logger(verbose, **_log_options(config))
+
+    quiet = not verbose
+    jobs = {
+        "snap" : lambda config: cli_snap(quiet = quiet, dry_run = False, config = config),
+        "prune" : lambda config: cli_prune(quiet = quiet, config = config),
+        "dedup" : lambda config: cli_dedup(quiet = quiet, config = config),
+    }
+
+    # - each job logs to its own file. The daemon logs to a new one
+    # - after every job
+
+    def run_job(job):
+        def run(config):
+            try:
+                return job(config)
+            finally:
+                _configure_logger(verbose, **_log_options(config))
+        return run
+
+    # - a running job is interrupted, so that stopping the daemon does
+    # - not wait for a whole snapshot
+
+    server = daemon.Daemon({name : run_job(job) for name, job in jobs.items()}, path)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *args: server.stop(interrupt = True))
+
+    logger.info("Starting snappy daemon")
+    server.run()
+
+
+def list_snapshots(folder = None, rebuild = False, as_json = False) -> None:
+
+    if folder is None:
+        config = _read_valid_config()
+        folder = destination.from_config(config, _destination(config))
+
+    with destination.get_destination(folder) as folder:
+        if rebuild:
+            catalog = Catalog.rebuild(folder.path, folder)
+            catalog.save()
+        else:
+            catalog = Catalog.load(folder.path, folder)
+
+    entries = catalog.snapshots(status = None)
+    if as_json:
+        print(json.dumps(entries, indent = 1))
+        return None
+
+    header = ["Name", "Status", "Start", "End", "Sources", "Size"]
+    rows = [header]
+    for e in entries:
+        size = ut.human_size(e["size"]) if e["size"] is not None else "-"
+        rows.append([e["name"], e["status"], e["start"] or "-", e["end"] or "-", str(len(e["sources"])), size])
+
+    widths = [max(len(r[idx]) for r in rows) for idx in range(len(header))]
+    title = f"Snapshots in {folder}"
+    print("")
+    print(title)
+    print("-" * len(title))
+    for r in rows:
+        print("  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip())
+    print("")
+
+
+def diff_snapshots(old = None, new = None, folder = None, as_json = False, unchanged = False) -> None:
+
+    # - entries are printed as they are found, the counts at the end.
+    # - A single snapshot is compared with the one before it
+
+    if new is None:
+        old, new = None, old
+
+    if folder is None:
+        folder = _destination(_read_valid_config())
+
+    a, b = diff.snapshot_folders(folder, old, new)
+    stats = diff.DiffStats()
+    if not as_json:
+        print(f"Changes from {os.path.basename(a)} to {os.path.basename(b)}")
+
+    for entry in diff.diff(a, b, unchanged = unchanged, stats = stats):
+        print(diff.format_entry(entry, as_json))
+
+    if not as_json:
+        print(stats)
+
+
 # --------------
 #  CLI program
 # --------------
@@ -159,20 +477,153 @@ def cli_config(show: bool = True, path: bool = False, create: bool = False, **kw
     return 0
 
 
-def cli_snap(quiet: bool = False, dry_run: bool = True, **kws) -> int:
+def cli_snap(quiet: bool = False, dry_run: bool = True, rescan: bool = False, trace: bool = False, profile: bool = False, config = None, **kws) -> int:
     
     verbose = True if dry_run else (not quiet)
     try:
-        run_backup(verbose = verbose, dry_run = dry_run)
+        run_backup(verbose = verbose, dry_run = dry_run, rescan = rescan, trace = trace, profile = profile, config = config)
+    except cfg.ConfigReadError:
+        code = 1
+    except cfg.ConfigNotFoundError:
+        code = 1
+    except cfg.InvalidConfigError:
+        code = 1
+    except LockedError as err:
+
+        # - not a failure: the running snapshot is as recent
+
+        logger.error(str(err))
+        return 3
+    except snp.RsyncError:
+        code = 2
+    else:
+        return 0
+
+    if not dry_run:
+        _record_failure(code)
+
+    return code
+
+
+def cli_prune(quiet: bool = False, folder: str = None, workers: int = None, max_rate: float = None, config = None, **kws) -> int:
+
+    try:
+        run_prune(verbose = not quiet, folder = folder, workers = workers, max_rate = max_rate, config = config)
     except cfg.ConfigReadError:
         return 1
     except cfg.ConfigNotFoundError:
         return 1
     except cfg.InvalidConfigError:
         return 1
-    except snp.RsyncError:
+    except OSError as err:
+        logger.error(f"Could not prune old backups: {err}")
         return 2
-    
+
+    return 0
+
+
+def cli_dedup(quiet: bool = False, folder: str = None, workers: int = None, config = None, **kws) -> int:
+
+    try:
+        run_dedup(verbose = not quiet, folder = folder, workers = workers, config = config)
+    except cfg.ConfigReadError:
+        return 1
+    except cfg.ConfigNotFoundError:
+        return 1
+    except cfg.InvalidConfigError:
+        return 1
+    except (OSError, ValueError) as err:
+        logger.error(f"Could not deduplicate snapshots: {err}")
+        return 2
+
+    return 0
+
+
+def cli_watch(quiet: bool = False, **kws) -> int:
+
+    try:
+        run_watch(verbose = not quiet)
+    except cfg.ConfigReadError:
+        return 1
+    except cfg.ConfigNotFoundError:
+        return 1
+    except cfg.InvalidConfigError:
+        return 1
+    except OSError as err:
+        logger.error(f"Could not watch sources: {err}")
+        return 2
+
+    return 0
+
+
+def cli_verify(quiet: bool = False, snapshot: str = None, folder: str = None, manifest: bool = False, workers: int = None, **kws) -> int:
+
+    try:
+        ok = run_verify(verbose = not quiet, snapshot = snapshot, folder = folder, manifest = manifest, workers = workers)
+    except cfg.ConfigReadError:
+        return 1
+    except cfg.ConfigNotFoundError:
+        return 1
+    except cfg.InvalidConfigError:
+        return 1
+    except (OSError, ValueError) as err:
+        logger.error(f"Could not verify the snapshot: {err}")
+        return 2
+
+    return 0 if ok else 3
+
+
+def cli_daemon(quiet: bool = False, trigger: str = None, status: bool = False, **kws) -> int:
+
+    try:
+        run_daemon(verbose = not quiet, trigger = trigger, status = status)
+    except cfg.ConfigReadError:
+        return 1
+    except cfg.ConfigNotFoundError:
+        return 1
+    except cfg.InvalidConfigError:
+        return 1
+    except ValueError as err:
+        logger.error(f"Invalid daemon configuration: {err}")
+        return 1
+    except OSError as err:
+        logger.error(f"Could not reach or start the daemon: {err}")
+        return 2
+
+    return 0
+
+
+def cli_list(folder: str = None, rebuild: bool = False, as_json: bool = False, **kws) -> int:
+
+    try:
+        list_snapshots(folder = folder, rebuild = rebuild, as_json = as_json)
+    except cfg.ConfigReadError:
+        return 1
+    except cfg.ConfigNotFoundError:
+        return 1
+    except cfg.InvalidConfigError:
+        return 1
+    except OSError as err:
+        print(f"Cannot list snapshots: {err}")
+        return 2
+
+    return 0
+
+
+def cli_diff(old: str = None, new: str = None, folder: str = None, as_json: bool = False, unchanged: bool = False, **kws) -> int:
+
+    try:
+        diff_snapshots(old = old, new = new, folder = folder, as_json = as_json, unchanged = unchanged)
+    except cfg.ConfigReadError:
+        return 1
+    except cfg.ConfigNotFoundError:
+        return 1
+    except cfg.InvalidConfigError:
+        return 1
+    except (OSError, ValueError) as err:
+        print(f"Cannot compare snapshots: {err}")
+        return 2
+
     return 0
 
 
@@ -185,8 +636,15 @@ def cli():
     description = '''Snappy - backup snapshots with rsync
     ====================================
 
-    Create backup snapshots based on config file specification. There are two commands:
+    Create backup snapshots based on config file specification. The commands are:
     * snap --- create snapshots
+    * list --- show existing snapshots
+    * prune --- delete old snapshots
+    * dedup --- hard link identical files across snapshots
+    * verify --- check the contents of a snapshot
+    * diff --- show the changes between two snapshots
+    * watch --- record the changes to the sources for the next snapshots
+    * daemon --- run scheduled snapshots in the background
     * config --- config utilities
 
     Each command has its dedicated section. You can use snappy [COMMAND] -h to show the description of each command.
@@ -218,6 +676,8 @@ def cli():
     epilog = """This command creates a backup snapshot based on the configuration file
     * You can disable the backup steps by using the option --quiet. This still saves the logs to a file.
     * If you would like to test the tool you can use the option --dry-run. This will print the backup steps, but no backup will be created.
+    * Non-readable files are cached per source in $HOME/.cache/snappy. Use --rescan to walk every source again.
+    * Use --trace to print the time spent in each phase, and --profile to also save a cProfile dump next to the logs.
     """
 
     snap = subparser.add_parser(
@@ -242,6 +702,318 @@ def cli():
     help = "perform trial run without making any changes (disables quiet)"
     snap.add_argument("--dry-run", default = default, action = action, help = help)
 
+    # -- rescan argument
+
+    default = False
+    action = "store_true"
+    help = "ignore the cached non-readable file index and scan every source again"
+    snap.add_argument("--rescan", default = default, action = action, help = help)
+
+    # -- trace argument
+
+    default = False
+    action = "store_true"
+    help = "print the wall and CPU time of each backup phase and source"
+    snap.add_argument("--trace", default = default, action = action, help = help)
+
+    # -- profile argument
+
+    default = False
+    action = "store_true"
+    help = "save a cProfile dump of the main thread in the log folder (implies --trace)"
+    snap.add_argument("--profile", default = default, action = action, help = help)
+
+    # ---------------
+    #  List command
+    # ---------------
+
+    description = "List backup snapshots\n====================="
+    epilog = """Snapshots are recorded in the catalog file .snappy-catalog.json of the destination folder
+    * If there is no catalog, snapshots are found by listing the destination folder.
+    * Use --rebuild to recreate the catalog from the folders on disk.
+    """
+
+    list_cmd = subparser.add_parser(
+        "list",
+        description = description,
+        epilog = epilog,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    list_cmd.set_defaults(func = cli_list)
+
+    # -- folder argument
+
+    default = None
+    help = "backup folder (default: destination in the configuration file)"
+    list_cmd.add_argument("-f", "--folder", default = default, help = help)
+
+    # -- rebuild argument
+
+    default = False
+    action = "store_true"
+    help = "rebuild the catalog from disk"
+    list_cmd.add_argument("--rebuild", default = default, action = action, help = help)
+
+    # -- json argument
+
+    default = False
+    action = "store_true"
+    help = "print the catalog as JSON"
+    list_cmd.add_argument("--json", dest = "as_json", default = default, action = action, help = help)
+
+    # ----------------
+    #  Prune command
+    # ----------------
+
+    description = "Delete old backup snapshots\n==========================="
+    epilog = """Old snapshots are moved to the .trash folder of the destination when a new snapshot is created
+    * Depending on the [prune] mode in the configuration file, they are deleted right away, by a background process or by this command.
+    * Use --folder to prune a destination other than the one in the configuration file.
+    """
+
+    prune_cmd = subparser.add_parser(
+        "prune",
+        description = description,
+        epilog = epilog,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    prune_cmd.set_defaults(func = cli_prune)
+
+    # -- quiet argument
+
+    default = False
+    action = "store_true"
+    help = "don't show steps while pruning"
+    prune_cmd.add_argument("-q", "--quiet", default = default, action = action, help = help)
+
+    # -- folder argument
+
+    default = None
+    help = "backup folder to prune (default: destination in the configuration file)"
+    prune_cmd.add_argument("-f", "--folder", default = default, help = help)
+
+    # -- workers argument
+
+    default = None
+    help = "number of deletion threads (default: [prune] workers in the configuration file)"
+    prune_cmd.add_argument("-w", "--workers", default = default, type = int, help = help)
+
+    # -- max rate argument
+
+    default = None
+    help = "maximum entries deleted per second, 0 for no limit (default: [resources] max_delete_rate in the configuration file)"
+    prune_cmd.add_argument("--max-rate", default = default, type = float, help = help)
+
+    # ----------------
+    #  Dedup command
+    # ----------------
+
+    description = "Deduplicate backup snapshots\n============================"
+    epilog = """Identical files in different snapshots are replaced by hard links to a single copy
+    * rsync only links a file to the same path in the previous snapshots. This also links renamed files and copies shared by several sources.
+    * Only files with the same content and metadata are linked. Their digests are kept in .snappy-dedup.json in the destination folder.
+    * Each run only reads the files of snapshots that were not deduplicated before.
+    * Set after_backup in the [dedup] section of the configuration file to run it after every snapshot.
+    """
+
+    dedup_cmd = subparser.add_parser(
+        "dedup",
+        description = description,
+        epilog = epilog,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    dedup_cmd.set_defaults(func = cli_dedup)
+
+    # -- quiet argument
+
+    default = False
+    action = "store_true"
+    help = "don't show steps while deduplicating"
+    dedup_cmd.add_argument("-q", "--quiet", default = default, action = action, help = help)
+
+    # -- folder argument
+
+    default = None
+    help = "backup folder to deduplicate (default: destination in the configuration file)"
+    dedup_cmd.add_argument("-f", "--folder", default = default, help = help)
+
+    # -- workers argument
+
+    default = None
+    help = "number of hashing processes (default: [dedup] workers in the configuration file)"
+    dedup_cmd.add_argument("-w", "--workers", default = default, type = int, help = help)
+
+    # ----------------
+    #  Verify command
+    # ----------------
+
+    description = "Verify a snapshot\n================="
+    epilog = """This command compares the contents of a snapshot with its sources by hashing the files
+    * Files changed since the snapshot are skipped, as are the rsync exclude patterns of the configuration file.
+    * The digests are saved as a manifest in .snappy-manifests in the destination folder. Files linked from a snapshot with a manifest are not hashed again.
+    * Use --manifest to hash every file of the snapshot again and compare it with its manifest instead, e.g. to find damaged files.
+    * It exits with code 3 if a file differs or is missing.
+    """
+
+    verify_cmd = subparser.add_parser(
+        "verify",
+        description = description,
+        epilog = epilog,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    verify_cmd.set_defaults(func = cli_verify)
+
+    # -- snapshot argument
+
+    default = None
+    help = "name of the snapshot to verify (default: the newest one)"
+    verify_cmd.add_argument("snapshot", nargs = "?", default = default, help = help)
+
+    # -- quiet argument
+
+    default = False
+    action = "store_true"
+    help = "don't show steps while verifying"
+    verify_cmd.add_argument("-q", "--quiet", default = default, action = action, help = help)
+
+    # -- folder argument
+
+    default = None
+    help = "backup folder of the snapshot (default: destination in the configuration file)"
+    verify_cmd.add_argument("-f", "--folder", default = default, help = help)
+
+    # -- manifest argument
+
+    default = False
+    action = "store_true"
+    help = "compare with the saved manifest instead of the sources"
+    verify_cmd.add_argument("-m", "--manifest", default = default, action = action, help = help)
+
+    # -- workers argument
+
+    default = None
+    help = "number of hashing processes (default: [verify] workers in the configuration file)"
+    verify_cmd.add_argument("-w", "--workers", default = default, type = int, help = help)
+
+    # --------------
+    #  Diff command
+    # --------------
+
+    description = "Compare two snapshots\n====================="
+    epilog = """This command lists the entries added (+), removed (-) and modified (M) between two snapshots
+    * No file is read: files hard linked between the snapshots are unchanged, as are files with the same size, mtime, mode and owner.
+    * An added or removed folder is listed once, without its contents.
+    * Paths are listed depth first in name order: the changes inside a folder come right after it.
+    * Without arguments, it compares the two newest snapshots. With one, it compares that snapshot with the one before it.
+    * Use --json to print one JSON object per line.
+    """
+
+    diff_cmd = subparser.add_parser(
+        "diff",
+        description = description,
+        epilog = epilog,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    diff_cmd.set_defaults(func = cli_diff)
+
+    # -- snapshot arguments
+
+    default = None
+    help = "name of the older snapshot (default: the one before the newer snapshot)"
+    diff_cmd.add_argument("old", nargs = "?", default = default, help = help)
+
+    default = None
+    help = "name of the newer snapshot (default: the newest one)"
+    diff_cmd.add_argument("new", nargs = "?", default = default, help = help)
+
+    # -- folder argument
+
+    default = None
+    help = "backup folder of the snapshots (default: destination in the configuration file)"
+    diff_cmd.add_argument("-f", "--folder", default = default, help = help)
+
+    # -- json argument
+
+    default = False
+    action = "store_true"
+    help = "print one JSON object per line"
+    diff_cmd.add_argument("--json", dest = "as_json", default = default, action = action, help = help)
+
+    # -- unchanged argument
+
+    default = False
+    action = "store_true"
+    help = "also list unchanged entries"
+    diff_cmd.add_argument("-u", "--unchanged", default = default, action = action, help = help)
+
+    # ---------------
+    #  Watch command
+    # ---------------
+
+    description = "Watch sources for changes\n========================="
+    epilog = """This command keeps running and records the paths that change in the sources
+    * Set journal in the [snapshot] section of the configuration file so that snappy snap only sends those paths and links the rest from the previous snapshot.
+    * Changes are saved in $HOME/.cache/snappy/journal. A snapshot walks the whole source again if this command was restarted or missed changes since the previous one.
+    * Each folder takes an inotify watch. Raise fs.inotify.max_user_watches for large sources.
+    * It stops on SIGTERM or Ctrl+C.
+    """
+
+    watch_cmd = subparser.add_parser(
+        "watch",
+        description = description,
+        epilog = epilog,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    watch_cmd.set_defaults(func = cli_watch)
+
+    # -- quiet argument
+
+    default = False
+    action = "store_true"
+    help = "don't show steps while watching"
+    watch_cmd.add_argument("-q", "--quiet", default = default, action = action, help = help)
+
+    # ----------------
+    #  Daemon command
+    # ----------------
+
+    description = "Run snappy in the background\n============================"
+    epilog = """This command keeps running and runs the snap, prune and dedup jobs
+    * Set a cron expression for each job in the [daemon] section of the configuration file, e.g. snap=*/15 * * * *. Jobs without one only run on request.
+    * The configuration file is read again when it changes. Scan caches and the rsync lookup are kept in memory between runs.
+    * Use --trigger JOB to run a job now and --status to show the jobs of the running daemon. Both talk to it over its Unix socket, set by socket in the [daemon] section.
+    * A snapshot is never started while another one of the same destination runs, also by snappy snap.
+    * It stops on SIGTERM or Ctrl+C, after the running job.
+    """
+
+    daemon_cmd = subparser.add_parser(
+        "daemon",
+        description = description,
+        epilog = epilog,
+        formatter_class = argparse.RawTextHelpFormatter
+    )
+    daemon_cmd.set_defaults(func = cli_daemon)
+
+    # -- quiet argument
+
+    default = False
+    action = "store_true"
+    help = "don't show steps while running jobs"
+    daemon_cmd.add_argument("-q", "--quiet", default = default, action = action, help = help)
+
+    # -- trigger argument
+
+    default = None
+    help = "run a job of the running daemon now"
+    daemon_cmd.add_argument("-t", "--trigger", default = default, choices = daemon.JOBS, help = help)
+
+    # -- status argument
+
+    default = False
+    action = "store_true"
+    help = "show the jobs of the running daemon"
+    daemon_cmd.add_argument("-s", "--status", default = default, action = action, help = help)
+
     # ----------------
     #  Config command
     # ----------------
@@ -299,7 +1071,7 @@ def cli():
 # ---------------------
 
 
-def _configure_logger(verbose = True) -> None:
+def _configure_logger(verbose = True, compression = "gzip", level = None, console = "full") -> None:
     
     logger.setLevel(logging.DEBUG)
 
@@ -307,7 +1079,7 @@ def _configure_logger(verbose = True) -> None:
     #  Log to console
     # -----------------
 
-    chl = _stream_handler()
+    chl = _stream_handler(console)
     if verbose:
         chl.setLevel(logging.INFO)
     else:
@@ -317,34 +1089,36 @@ def _configure_logger(verbose = True) -> None:
     #  Log to file
     # --------------
 
-    fhl = _file_handler()
+    fhl = _file_handler(compression, level)
 
-    # -----------------------------------------
-    #  Check if we need to update the handlers
-    # -----------------------------------------
+    # ------------------------------------------------------------
+    #  Both handlers are written by a background thread, so that
+    #  logging every rsync line does not slow down the output pump.
+    #  Replaced handlers are closed, which writes pending records
+    # ------------------------------------------------------------
 
-    add_handler = {
-        "Console" : chl,
-        "File" : fhl
-    }
+    for lhl in list(logger.handlers):
+        if lhl.get_name() in ("Queue", "Console", "File"):
+            logger.removeHandler(lhl)
+            lhl.close()
+
+    qhl = logs.QueueHandler([chl, fhl])
+    qhl.set_name("Queue")
+    logger.addHandler(qhl)
 
-    if logger.hasHandlers():
-        
-        for idx, lhl in enumerate(logger.handlers):
-            if lhl.get_name() in add_handler:
-                logger.handlers[idx] = add_handler[lhl.get_name()]
-                add_handler.pop(lhl.get_name())
-    
-    if add_handler:
-        for hl in add_handler.values():
-            logger.addHandler(hl)
 
+def _log_loc() -> str:
+    return os.path.join(os.environ["HOME"], ".logs", "snappy")
 
-def _file_handler() -> logging.FileHandler:
 
-    loc = os.path.join(os.environ["HOME"], ".logs", "snappy")
-    today = datetime.date.today()
-    file = today.strftime("%Y-%m-%d") + ".log"
+def _file_handler(compression = "gzip", level = None) -> logs.CompressedFileHandler:
+
+    # - every run logs to its own file, named after the start time
+    # - and process until the snapshot name is known
+
+    loc = _log_loc()
+    now = datetime.datetime.now()
+    file = now.strftime(SNAPSHOT_FORMAT) + f"-{os.getpid()}" + logs.extension(compression)
 
     if not os.path.exists(loc):
         try:
@@ -354,7 +1128,7 @@ def _file_handler() -> logging.FileHandler:
             raise RuntimeError(msg) from err
     
     file = os.path.join(loc, file)
-    hl = logging.FileHandler(file, encoding = "utf8")
+    hl = logs.CompressedFileHandler(file, compression, level, encoding = "utf8")
     hl.set_name("File")
     fmt = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
     hl.setFormatter(fmt)
@@ -362,9 +1136,15 @@ def _file_handler() -> logging.FileHandler:
     return hl
 
 
-def _stream_handler() -> logging.StreamHandler:
+def _stream_handler(console = "full") -> logging.StreamHandler:
+
+    # - in summary mode the per-file lines of rsync are collapsed into
+    # - one progress line, the file log still has every line
 
-    hl = logging.StreamHandler()
+    if console == "summary":
+        hl = logs.SummaryStreamHandler()
+    else:
+        hl = logging.StreamHandler()
     hl.set_name("Console")
     fmt = logging.Formatter("%(message)s")
     hl.setFormatter(fmt)
@@ -372,36 +1152,156 @@ def _stream_handler() -> logging.StreamHandler:
     return hl
 
 
-def _compress_log(lg, name) -> None:
+def _rename_log(lg, name) -> None:
 
-    for hl in lg.handlers:
+    # - the log of a successful run is named after its snapshot
+
+    for hl in _handlers(lg):
         if hl.get_name() == "File":
             file = hl.baseFilename
-            if not os.path.exists(file):
+            name = os.path.join(os.path.dirname(file), name + logs.extension(hl.compression))
+            try:
+                hl.rename(name)
+            except OSError as err:
+                lg.error(f"Could not rename log file '{file}' to '{name}': {err}")
                 return None
 
-            name = os.path.join(os.path.dirname(file), name)
-            name += ".log"
-            lg.info("Moving file '{}' to '{}'".format(file, name))
-            mv(file, name)
-            
-            lg.info("Compressing file '{}'".format(name))
-            cmd = ["gzip", "--best", '{}'.format(name)]
-            try:
-                lg.info("Running command '{}'".format(" ".join(cmd)))
-                out = subprocess.run(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-            except Exception:
-                lg.error("Could not compress log file '{}'".format(file))
-                mv(name, file)
-                return
-
-            if out.returncode != 0:
-                lg.error("Could not compress log file '{}'".format(file))
-                mv(name, file)
-            
+            lg.info(f"Log file renamed to '{name}'")
             return None
 
 
+def _handlers(lg) -> list:
+
+    # - handlers of the logger, including those behind the queue
+
+    out = []
+    for hl in lg.handlers:
+        out.append(hl)
+        out.extend(getattr(hl, "handlers", []))
+
+    return out
+
+
+def _read_valid_config():
+
+    config = cfg.read_config()
+    if not cfg.is_valid_config(config):
+        msg = "Config file is invalid. Please fix the file and try again."
+        logger.error(msg)
+        raise cfg.InvalidConfigError(msg)
+
+    return config
+
+
+def _log_options(config) -> dict:
+
+    level = config.get("logs", "level", fallback = "").strip()
+    return {
+        "compression" : config.get("logs", "compression", fallback = "gzip").strip(),
+        "level" : int(level) if level != "" else None,
+        "console" : config.get("logs", "console", fallback = "full").strip(),
+    }
+
+
+def _dedup_after_backup(config, dst, result) -> None:
+
+    # - deduplication only needs local access to the snapshots. The
+    # - backup is complete by now, so a failure is only a warning and
+    # - `snappy dedup` can be run later
+
+    if result.dry_run or dst.remote:
+        return None
+
+    start = time.perf_counter()
+    try:
+        with spans.span("dedup"):
+            dedup.dedup(dst.path, **_dedup_options(config))
+    except (OSError, ValueError) as err:
+        logger.warning(f"Could not deduplicate snapshots after the backup: {err}")
+        return None
+
+    result.phases["dedup"] = time.perf_counter() - start
+
+
+def _dedup_options(config) -> dict:
+    return {
+        "workers" : config.getint("dedup", "workers", fallback = dedup.DEDUP_WORKERS),
+        "min_size" : config.getint("dedup", "min_size", fallback = dedup.MIN_SIZE),
+    }
+
+
+def _sources(config) -> list:
+
+    src = config["Sources"].keys()
+    src = filter(lambda x: x is not None, src)
+    src = filter(lambda x: x != "", src)
+    src = filter(lambda x: not is_comment(x), src)
+    return [s.strip() for s in src]
+
+
+def _destination(config) -> str:
+    return config["Destination"]["folder"].strip()
+
+
+def _save_result(result) -> None:
+
+    # - transfer statistics are saved next to the compressed log
+
+    file = os.path.join(_log_loc(), f"{result.name}.json")
+    try:
+        ut.write_atomic(file, result.to_json())
+    except OSError as err:
+        logger.error(f"Could not save transfer statistics to '{file}': {err}")
+        return None
+
+    logger.info(f"Transfer statistics saved to '{file}'")
+
+
+def _save_profile(profiler, name) -> None:
+
+    # - the profile is saved next to the compressed log and can be
+    # - read with `python -m pstats`. Failed runs are named after
+    # - their start time
+
+    if isinstance(name, datetime.datetime):
+        name = "failed-" + name.strftime("%Y-%m-%d-%H_%M_%S")
+
+    file = os.path.join(_log_loc(), f"{name}.prof")
+    try:
+        profiler.dump_stats(file)
+    except OSError as err:
+        print(f"Could not save profile to '{file}': {err}")
+        return None
+
+    print(f"Profile saved to '{file}'")
+
+
+def _print_spans(total) -> None:
+
+    title = "Backup phases"
+    print("")
+    print(title)
+    print("-" * len(title))
+    print(spans.tracer.table())
+    print(f"Total: {total:.3f}s")
+    print("")
+
+
+def _record_failure(code) -> None:
+
+    # - failures are counted even if the configuration is broken, as
+    # - long as it can be read and has a [metrics] textfile
+
+    try:
+        config = cfg.read_config()
+    except Exception:
+        return None
+
+    textfile = metrics.textfile(config)
+    if textfile is not None:
+        metrics.record_failure(textfile, code)
+
+
 def _process_rsync_patterns(config, section):
     
     patt = list(config[section].keys())
@@ -1,6 +1,13 @@
 import os
 import logging
 import configparser
+from .prune import PRUNE_MODES
+from .logs import COMPRESSIONS, CONSOLE_MODES
+from .resources import Resources
+from .pressure import PressureGate
+from . import destination
+from .rsync import MAX_LINK_DEST
+from .schedule import Cron
 
 loc = os.path.abspath(__file__)
 default_config_loc = os.path.join(os.path.dirname(loc), "assets", "snappy.ini")
@@ -23,6 +30,10 @@ def config_loc() -> str:
     return os.path.join(os.environ["HOME"], ".config", "snappy")
 
 
+def cache_loc() -> str:
+    return os.path.join(os.environ["HOME"], ".cache", "snappy")
+
+
 def create_config() -> None:
 
     loc = config_loc()
@@ -113,4 +124,111 @@ def is_valid_config(cfg) -> bool:
     except KeyError:
         return False
 
+    # --> optional snapshot section must have a positive number of workers,
+    # --> boolean batch, fast_path and journal and between 1 and 20 link-dest snapshots
+
+    try:
+        workers = cfg.getint("snapshot", "max_workers", fallback = 1)
+    except ValueError:
+        return False
+
+    if workers < 1:
+        return False
+
+    try:
+        cfg.getboolean("snapshot", "batch", fallback = False)
+        link_dest = cfg.getint("snapshot", "link_dest", fallback = 1)
+        cfg.getboolean("snapshot", "fast_path", fallback = False)
+        cfg.getboolean("snapshot", "journal", fallback = False)
+    except ValueError:
+        return False
+
+    if not (1 <= link_dest <= MAX_LINK_DEST):
+        return False
+
+    # --> optional prune section must have a known mode and workers
+
+    if cfg.get("prune", "mode", fallback = "inline").strip() not in PRUNE_MODES:
+        return False
+
+    try:
+        workers = cfg.getint("prune", "workers", fallback = 1)
+    except ValueError:
+        return False
+
+    if workers < 1:
+        return False
+
+    # --> optional logs section must have a known compression, an
+    # --> empty or numeric level and a known console mode
+
+    if cfg.get("logs", "compression", fallback = "gzip").strip() not in COMPRESSIONS:
+        return False
+
+    level = cfg.get("logs", "level", fallback = "").strip()
+    if level != "":
+        try:
+            int(level)
+        except ValueError:
+            return False
+
+    if cfg.get("logs", "console", fallback = "full").strip() not in CONSOLE_MODES:
+        return False
+
+    # --> optional resources section must have valid limits
+
+    try:
+        Resources.from_config(cfg)
+    except ValueError:
+        return False
+
+    # --> optional pressure section must have positive thresholds
+
+    try:
+        PressureGate.from_config(cfg)
+    except ValueError:
+        return False
+
+    # --> optional dedup section must have a boolean after_backup, a
+    # --> positive number of workers and a non-negative min_size
+
+    try:
+        cfg.getboolean("dedup", "after_backup", fallback = False)
+        workers = cfg.getint("dedup", "workers", fallback = 1)
+        min_size = cfg.getint("dedup", "min_size", fallback = 0)
+    except ValueError:
+        return False
+
+    if (workers < 1) or (min_size < 0):
+        return False
+
+    # --> optional verify section must have a positive number of workers
+
+    try:
+        workers = cfg.getint("verify", "workers", fallback = 1)
+    except ValueError:
+        return False
+
+    if workers < 1:
+        return False
+
+    # --> optional ssh section must have a numeric port and a known
+    # --> compression for remote destinations
+
+    try:
+        destination.from_config(cfg, cfg["Destination"]["folder"].strip())
+    except ValueError:
+        return False
+
+    # --> optional daemon section must have valid cron expressions
+
+    if cfg.has_section("daemon"):
+        for key, expr in cfg.items("daemon"):
+            if (key == "socket") or (not expr) or (expr.strip() == ""):
+                continue
+            try:
+                Cron(expr)
+            except ValueError:
+                return False
+
     return True
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import queue
+import socket
+import logging
+import datetime
+import threading
+import socketserver
+
+from .schedule import Cron
+from . import config as cfg
+from . import rsync
+from . import scan
+
+
+logger = logging.getLogger(__name__)
+
+JOBS = ("snap", "prune", "dedup")
+TICK = 1.0
+MAX_REQUEST = 1024
+SOCKET_TIMEOUT = 5.0
+
+
+class Daemon:
+
+    # ------------------------------------------------------------------
+    #  Runs the jobs of `snappy daemon` one at a time: when their cron
+    #  expression in the [daemon] section matches, and when they are
+    #  requested over the Unix socket. jobs maps a job name to a
+    #  function of the configuration that returns an exit code. The
+    #  configuration is read once and again when the file changes. An
+    #  invalid change is ignored. Scan indexes are kept in memory
+    #  between runs, as is the rsync probe by rsync.probe
+    # ------------------------------------------------------------------
+
+    def __init__(self, jobs: dict, socket_path = None) -> None:
+
+        self.jobs = jobs
+        self.socket_path = socket_path
+        self.config = None
+        self.schedules = {}
+        self.running = None
+        self.history = {}
+        self._mtime = None
+        self._last = {}
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+
+    @property
+    def config_file(self) -> str:
+        return os.path.join(cfg.config_loc(), "snappy.ini")
+
+    def load(self) -> bool:
+
+        # - False if the file did not change or the change is invalid
+
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if (self.config is not None) and (mtime == self._mtime):
+            return False
+
+        self._mtime = mtime
+        try:
+            config = cfg.read_config()
+            if not cfg.is_valid_config(config):
+                raise cfg.InvalidConfigError("Config file is invalid")
+            schedules = schedules_from_config(config)
+        except (cfg.ConfigNotFoundError, cfg.ConfigReadError, cfg.InvalidConfigError, ValueError) as err:
+            if self.config is None:
+                raise
+            logger.error(f"Keeping the previous configuration: {err}")
+            return False
+
+        if self.config is not None:
+            logger.info("Configuration file changed. Reloaded it")
+
+        self.config = config
+        self.schedules = schedules
+        for job, cron in schedules.items():
+            logger.info(f"Job {job} scheduled at '{cron}'")
+
+        if self.socket_path is None:
+            self.socket_path = socket_from_config(config)
+
+        return True
+
+    def run(self) -> None:
+
+        self.load()
+        scan.keep_in_memory()
+        rsync.probe()
+
+        self._server = _serve(self, self.socket_path)
+        logger.info(f"Listening on {self.socket_path}")
+        try:
+            while not self._stop.is_set():
+                self.load()
+                self.schedule(datetime.datetime.now())
+                try:
+                    job, origin = self._queue.get(timeout = TICK)
+                except queue.Empty:
+                    continue
+
+                self.run_job(job, origin)
+
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+            _unlink(self.socket_path)
+            self._server = None
+
+        logger.info("Daemon stopped")
+
+    def stop(self, interrupt = False) -> None:
+
+        # - with interrupt, e.g. from a signal handler of the main thread,
+        # - a job running in it is stopped by KeyboardInterrupt and rolls
+        # - back as on Ctrl-C
+
+        self._stop.set()
+        if interrupt and (self.running is not None):
+            raise KeyboardInterrupt
+
+    def schedule(self, now: datetime.datetime) -> None:
+
+        # - a job runs at most once a minute. Minutes missed while
+        # - another job runs are skipped, as cron does with a lock
+
+        minute = now.replace(second = 0, microsecond = 0)
+        for job, cron in self.schedules.items():
+            if cron.matches(minute) and (self._last.get(job) != minute):
+                self._last[job] = minute
+                self.trigger(job, "schedule")
+
+    def trigger(self, job, origin = "request") -> str:
+
+        if job not in self.jobs:
+            raise ValueError(f"Unknown job '{job}'. Choose one of {', '.join(self.jobs)}")
+
+        with self._lock:
+            if job in self._queued:
+                return f"Job {job} is already queued"
+
+            self._queued.add(job)
+            self._queue.put((job, origin))
+
+        return f"Job {job} queued"
+
+    def run_job(self, job, origin) -> int:
+
+        with self._lock:
+            self._queued.discard(job)
+            self.running = job
+
+        logger.info(f"Running job {job} ({origin})")
+        start = time.monotonic()
+        try:
+            code = self.jobs[job](self.config)
+        except KeyboardInterrupt:
+            logger.warning(f"Job {job} interrupted")
+            code = -1
+        except Exception:
+            logger.exception(f"Job {job} failed")
+            code = -1
+        finally:
+            self.running = None
+
+        seconds = time.monotonic() - start
+        self.history[job] = {
+            "end" : datetime.datetime.now().isoformat(timespec = "seconds"),
+            "code" : code,
+            "seconds" : round(seconds, 3),
+        }
+        logger.info(f"Job {job} finished with code {code} in {seconds:.1f}s")
+        return code
+
+    def status(self) -> dict:
+
+        now = datetime.datetime.now()
+        with self._lock:
+            queued = sorted(self._queued)
+
+        nxt = {}
+        for job, cron in self.schedules.items():
+            dt = cron.next(now)
+            nxt[job] = dt.isoformat(timespec = "minutes") if dt is not None else None
+
+        return {
+            "pid" : os.getpid(),
+            "running" : self.running,
+            "queued" : queued,
+            "next" : nxt,
+            "last" : self.history,
+        }
+
+    def handle(self, request: str) -> str:
+
+        # - one request per connection: a job name or status
+
+        request = request.strip()
+        if request == "status":
+            return json.dumps(self.status(), indent = 1)
+
+        try:
+            return self.trigger(request)
+        except ValueError as err:
+            return f"Error: {err}"
+
+
+def schedules_from_config(config) -> dict:
+
+    # - cron expression of each job in the [daemon] section, empty to
+    # - only run it on request. Raises ValueError if one is invalid
+
+    schedules = {}
+    for job in JOBS:
+        expr = config.get("daemon", job, fallback = "").strip()
+        if expr != "":
+            schedules[job] = Cron(expr)
+
+    return schedules
+
+
+def socket_from_config(config) -> str:
+
+    path = config.get("daemon", "socket", fallback = "").strip()
+    return os.path.expanduser(path) if path != "" else os.path.join(cfg.cache_loc(), "daemon.sock")
+
+
+def send(request, socket_path) -> str:
+
+    # - reply of the daemon listening on socket_path
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(SOCKET_TIMEOUT)
+        s.connect(socket_path)
+        s.sendall(request.encode("utf8") + b"\n")
+        s.shutdown(socket.SHUT_WR)
+
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    return b"".join(chunks).decode("utf8")
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        self.request.settimeout(SOCKET_TIMEOUT)
+        try:
+            request = self.rfile.readline(MAX_REQUEST).decode("utf8", errors = "replace")
+        except OSError:
+            return None
+        self.wfile.write(self.server.daemon.handle(request).encode("utf8") + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _serve(daemon, path):
+
+    # - a socket left by a daemon that died is replaced, one in use
+    # - is not
+
+    if os.path.exists(path):
+        try:
+            send("status", path)
+        except OSError:
+            _unlink(path)
+        else:
+            raise OSError(f"Another snappy daemon is listening on {path}")
+
+    # - the socket is created without access for other users, so no
+    # - one else can connect before it is chmodded
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    mask = os.umask(0o077)
+    try:
+        server = _Server(path, _Handler)
+    finally:
+        os.umask(mask)
+    os.chmod(path, 0o600)
+    server.daemon = daemon
+
+    thread = threading.Thread(target = server.serve_forever, name = "snappy-daemon-socket", daemon = True)
+    thread.start()
+    return server
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import errno
+import mmap
+import fcntl
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from .catalog import Catalog
+from .destination import get_destination
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+DEDUP_INDEX = ".snappy-dedup.json"
+DEDUP_LOCK = ".snappy-dedup.lock"
+DEDUP_WORKERS = 4
+
+# - smaller files are not worth an index entry, and a hard link
+# - saves at most one block for them
+
+MIN_SIZE = 1024
+READ_SIZE = 1024 ** 2
+CHUNK_SIZE = 64
+
+
+class DedupStats:
+
+    def __init__(self) -> None:
+
+        self.snapshots = 0
+        self.files = 0
+        self.linked = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, other) -> None:
+
+        self.snapshots += other.snapshots
+        self.files += other.files
+        self.linked += other.linked
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+
+    def __str__(self) -> str:
+        return (
+            f"{self.linked} of {self.files} new files linked in {self.snapshots} snapshots, "
+            f"{ut.human_size(self.bytes)} saved in {self.seconds:.1f}s"
+        )
+
+
+class DedupIndex:
+
+    # ----------------------------------------------------------------
+    #  Content index of a backup folder, saved as JSON in the folder
+    #  itself. files maps the key of a file (see _key) to its path,
+    #  relative to the folder, and its inode. snapshots lists the ones
+    #  already deduplicated, which are not walked again
+    # ----------------------------------------------------------------
+
+    version = 1
+
+    def __init__(self, path: os.PathLike) -> None:
+
+        self.path = os.path.abspath(path)
+        self.snapshots = set()
+        self.files = {}
+
+    @property
+    def file(self) -> str:
+        return os.path.join(self.path, DEDUP_INDEX)
+
+    def load(self) -> None:
+
+        try:
+            with open(self.file, "r", encoding = "utf8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logger.warning(f"Ignoring unreadable dedup index {self.file}: {err}")
+            return None
+
+        if data.get("version") != self.version:
+            logger.warning(f"Unknown dedup index version in {self.file}. Starting a new index")
+            return None
+
+        self.snapshots = set(data.get("snapshots", []))
+        self.files = data.get("files", {})
+
+    def save(self, snapshots) -> None:
+
+        # - entries of snapshots that no longer exist are dropped
+
+        snapshots = set(snapshots)
+        data = {
+            "version" : self.version,
+            "snapshots" : sorted(self.snapshots & snapshots),
+            "files" : {k : v for k, v in self.files.items() if v[0].split(os.path.sep, 1)[0] in snapshots},
+        }
+
+        try:
+            ut.write_atomic(self.file, json.dumps(data, separators = (",", ":")))
+        except OSError as err:
+            logger.warning(f"Cannot save dedup index {self.file}: {err}")
+
+    def lookup(self, key, dev):
+
+        # - absolute path of the indexed file, None if it is gone or
+        # - was replaced since it was indexed
+
+        entry = self.files.get(key)
+        if entry is None:
+            return None
+
+        path = os.path.join(self.path, entry[0])
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+
+        return path if (st.st_ino == entry[1]) and (st.st_dev == dev) else None
+
+    def add(self, key, path, st) -> None:
+        self.files[key] = [os.path.relpath(path, self.path), st.st_ino]
+
+
+def dedup(path: os.PathLike, workers = DEDUP_WORKERS, min_size = MIN_SIZE) -> DedupStats:
+
+    # ------------------------------------------------------------------
+    #  Replace files of the complete snapshots in the backup folder path
+    #  with hard links to identical files of earlier snapshots, also at
+    #  other paths or from other sources. Only inodes with a single link
+    #  are hashed, since rsync --link-dest already shared the others,
+    #  and snapshots done by an earlier run are skipped. Files are
+    #  hashed by `workers` processes
+    # ------------------------------------------------------------------
+
+    dest = get_destination(path)
+    if dest.remote:
+        raise ValueError(f"Cannot deduplicate remote folder {dest}. Run snappy dedup on the remote host")
+
+    total = DedupStats()
+    lock = open(os.path.join(dest.path, DEDUP_LOCK), "w")
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Another process is already deduplicating {dest.path}")
+            return total
+
+        names = [e["name"] for e in Catalog.load(dest.path).snapshots()]
+        index = DedupIndex(dest.path)
+        index.load()
+
+        for name in names:
+            if name in index.snapshots:
+                continue
+
+            logger.info(f"Deduplicating snapshot {name}")
+            stats = _dedup_snapshot(index, os.path.join(dest.path, name), workers, min_size)
+            logger.info(f"Deduplicated snapshot {name}: {stats}")
+            index.snapshots.add(name)
+            total.add(stats)
+
+        index.save(names)
+
+    finally:
+        lock.close()
+
+    if total.snapshots > 0:
+        logger.info(f"Deduplicated {total.snapshots} snapshots: {total}")
+    else:
+        logger.info("Nothing to deduplicate")
+
+    return total
+
+
+def hash_file(path, mapped = True):
+
+    # ----------------------------------------------------------------
+    #  Content digest, None if the file cannot be read. Large files are
+    #  mapped and read ahead by the kernel, without copies, unless
+    #  mapped is False: a mapped file truncated meanwhile kills the
+    #  process, so files that may change are read in large chunks
+    # ----------------------------------------------------------------
+
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if mapped and (size >= READ_SIZE):
+                with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+                    if hasattr(m, "madvise"):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    digest.update(m)
+            else:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while True:
+                    chunk = f.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+    except (OSError, ValueError):
+        return None
+
+    return digest.hexdigest()
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _dedup_snapshot(index, folder, workers, min_size) -> DedupStats:
+
+    stats = DedupStats()
+    start = time.monotonic()
+
+    files = list(_new_files(folder, min_size))
+    paths = [path for path, _ in files]
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            digests = list(pool.map(hash_file, paths, chunksize = CHUNK_SIZE))
+    else:
+        digests = [hash_file(p) for p in paths]
+
+    for (path, st), digest in zip(files, digests):
+        if digest is None:
+            logger.warning(f"Cannot read {path}. It is not deduplicated")
+            continue
+
+        stats.files += 1
+        key = _key(digest, st)
+        other = index.lookup(key, st.st_dev)
+        if other is None:
+            index.add(key, path, st)
+            continue
+
+        try:
+            _link(other, path)
+        except OSError as err:
+
+            # - the indexed inode has as many links as the file system
+            # - allows, so this file takes its place for the next ones
+
+            if err.errno == errno.EMLINK:
+                index.add(key, path, st)
+            else:
+                logger.warning(f"Cannot link {path} to {other}: {err}")
+            continue
+
+        stats.linked += 1
+        stats.bytes += st.st_blocks * 512
+
+    stats.snapshots = 1
+    stats.seconds = time.monotonic() - start
+    return stats
+
+
+def _new_files(folder, min_size):
+
+    # - regular files with a single link, i.e. written by the last
+    # - rsync and not shared with another snapshot yet
+
+    pending = [folder]
+    while pending:
+        path = pending.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as err:
+            logger.warning(f"Cannot scan folder {path}: {err}")
+            continue
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks = False):
+                    pending.append(entry.path)
+                    continue
+
+                if not entry.is_file(follow_symlinks = False):
+                    continue
+
+                st = entry.stat(follow_symlinks = False)
+            except OSError:
+                continue
+
+            if (st.st_nlink == 1) and (st.st_size >= min_size):
+                yield entry.path, st
+
+
+def _key(digest, st):
+
+    # - linked files share their metadata, so only files that rsync
+    # - would also consider unchanged are linked
+
+    return f"{digest}:{st.st_size}:{st.st_mode}:{st.st_uid}:{st.st_gid}:{st.st_mtime_ns}"
+
+
+def _link(src, dst):
+
+    # - the link is created next to dst and renamed over it, so dst is
+    # - never missing. The folder keeps its modification time, as in
+    # - the source
+
+    folder = os.path.dirname(dst)
+    st = os.lstat(folder)
+    tmp = os.path.join(folder, f".snappy-dedup-{os.getpid()}")
+
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    finally:
+        os.utime(folder, ns = (st.st_atime_ns, st.st_mtime_ns))
@@ -0,0 +1,371 @@
+import os
+import re
+import time
+import errno
+import shlex
+import shutil
+import logging
+import tempfile
+import subprocess
+
+from .cmd import mv
+from . import prune
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+# - [user@]host:/path, as understood by rsync and scp. A colon after
+# - a slash is part of a local path
+
+REMOTE = re.compile(r"^(?:(?P<user>[^@/:]+)@)?(?P<host>[^@/:]+):(?P<path>.*)$")
+
+# - values of rsync --compress-choice, "none" sends data uncompressed
+# - and with "auto" both rsyncs agree on the fastest they support
+
+COMPRESSIONS = ("none", "auto", "zlib", "zlibx", "zstd", "lz4")
+
+# - seconds the master connection stays open once snappy stops using
+# - it, so that a crashed run does not leave it behind for long
+
+CONTROL_PERSIST = 60
+SSH_ERROR = 255
+
+
+class SshError(OSError):
+    pass
+
+
+class LocalDestination:
+
+    # ----------------------------------------------------------------
+    #  Backup folder on a local file system. Its methods are the file
+    #  operations snap_backup needs on the backup folder, with the same
+    #  signature as in SshDestination. Paths are absolute paths inside
+    #  the destination
+    # ----------------------------------------------------------------
+
+    remote = False
+
+    def __init__(self, path: os.PathLike) -> None:
+        self.path = ut.normalize_path(path).rstrip(os.path.sep) or os.path.sep
+
+    def __str__(self) -> str:
+        return self.path
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def join(self, *names) -> str:
+        return os.path.join(self.path, *names)
+
+    def target(self, path) -> str:
+
+        # - path as given to rsync
+
+        return path
+
+    def rsync_args(self) -> list:
+        return []
+
+    def exists(self, path) -> bool:
+        return os.path.exists(path)
+
+    def isdir(self, path) -> bool:
+        return os.path.isdir(path)
+
+    def makedirs(self, path) -> None:
+        os.makedirs(path, exist_ok = True)
+
+    def folders(self, path) -> list:
+        return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+
+    def rmtree(self, path) -> None:
+        shutil.rmtree(path)
+
+    def move(self, src, dst) -> None:
+        mv(src, dst)
+
+    def remove(self, path) -> None:
+        os.unlink(path)
+
+    def read_text(self, path) -> str:
+        with open(path, "r", encoding = "utf8") as f:
+            return f.read()
+
+    def write_text(self, path, data) -> None:
+        ut.write_atomic(path, data)
+
+    def move_to_trash(self, folder) -> str:
+        return prune.move_to_trash(self.path, folder)
+
+
+class SshDestination:
+
+    # -------------------------------------------------------------------
+    #  Backup folder on another host, reached with ssh. Every command and
+    #  every rsync goes through a single master connection (ControlMaster)
+    #  opened on first use and closed by close, so that authentication
+    #  happens once per run. Options:
+    #  * port / ssh_options: passed to every ssh command
+    #  * compress: rsync --compress-choice, None for rsync's default of
+    #    no compression
+    # -------------------------------------------------------------------
+
+    remote = True
+
+    def __init__(self, host, path, user = None, port = None, compress = None, ssh_options = None) -> None:
+
+        if (compress is not None) and (compress not in COMPRESSIONS):
+            raise ValueError(f"Invalid compression '{compress}'. Choose one of {', '.join(COMPRESSIONS)}")
+
+        if not path.startswith("/"):
+            raise ValueError(f"Remote path '{path}' must be absolute")
+
+        self.host = host
+        self.path = os.path.normpath(path)
+        self.user = user
+        self.port = port
+        self.compress = compress
+        self.ssh_options = list(ssh_options or [])
+        self._control = None
+
+    def __str__(self) -> str:
+        return self.target(self.path)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def address(self) -> str:
+        return self.host if self.user is None else f"{self.user}@{self.host}"
+
+    @property
+    def control_path(self):
+        return None if self._control is None else os.path.join(self._control, "master")
+
+    def open(self) -> None:
+
+        # - the master runs in the background until close, or until it
+        # - has been idle for CONTROL_PERSIST seconds
+
+        if self._control is not None:
+            return None
+
+        self._control = tempfile.mkdtemp(prefix = "snappy-ssh-")
+        cmd = self.ssh_command("-o", "ControlMaster=yes", "-o", f"ControlPersist={CONTROL_PERSIST}", "-f", "-N")
+        logger.info(f"Opening ssh connection to {self.address}")
+        logger.debug(f"Running command {cmd}")
+
+        out = subprocess.run(cmd + [self.address], stdin = subprocess.DEVNULL, capture_output = True, text = True)
+        if out.returncode != 0:
+            shutil.rmtree(self._control, ignore_errors = True)
+            self._control = None
+            raise SshError(f"Cannot connect to {self.address}: {out.stderr.strip()}")
+
+    def close(self) -> None:
+
+        if self._control is None:
+            return None
+
+        cmd = self.ssh_command("-O", "exit") + [self.address]
+        subprocess.run(cmd, stdin = subprocess.DEVNULL, capture_output = True)
+        shutil.rmtree(self._control, ignore_errors = True)
+        self._control = None
+
+    def ssh_command(self, *extra) -> list:
+
+        # - ssh and its options, without the host
+
+        cmd = ["ssh", "-o", "BatchMode=yes"]
+        if self._control is not None:
+            cmd += ["-o", f"ControlPath={self.control_path}"]
+        if self.port is not None:
+            cmd += ["-p", str(self.port)]
+
+        return cmd + self.ssh_options + list(extra)
+
+    def run(self, *args, input = None) -> subprocess.CompletedProcess:
+
+        # - runs a command on the remote host through the master
+        # - connection. Arguments are quoted for the remote shell
+
+        self.open()
+        command = " ".join(shlex.quote(str(a)) for a in args)
+        cmd = self.ssh_command() + [self.address, command]
+        logger.debug(f"Running command {cmd}")
+        return subprocess.run(cmd, input = input, capture_output = True, text = True)
+
+    def join(self, *names) -> str:
+        return os.path.join(self.path, *names)
+
+    def target(self, path) -> str:
+        return f"{self.address}:{path}"
+
+    def rsync_args(self) -> list:
+
+        # - rsync opens its own ssh, which reuses the master connection
+
+        self.open()
+        args = ["-e", " ".join(shlex.quote(a) for a in self.ssh_command())]
+        if self.compress not in (None, "none"):
+            args += ["--compress", f"--compress-choice={self.compress}"]
+
+        return args
+
+    def exists(self, path) -> bool:
+        return self._test("-e", path)
+
+    def isdir(self, path) -> bool:
+        return self._test("-d", path)
+
+    def makedirs(self, path) -> None:
+        _check(self.run("mkdir", "-p", "--", path), path)
+
+    def folders(self, path) -> list:
+        out = _check(self.run("find", path, "-mindepth", "1", "-maxdepth", "1", "-type", "d", "-printf", "%f\\n"), path)
+        return [name for name in out.stdout.split("\n") if name != ""]
+
+    def rmtree(self, path) -> None:
+        _check(self.run("rm", "-rf", "--", path), path)
+
+    def move(self, src, dst) -> None:
+        _check(self.run("mv", "--", src, dst), src)
+
+    def remove(self, path) -> None:
+        _check(self.run("rm", "--", path), path)
+
+    def read_text(self, path) -> str:
+        return _check(self.run("cat", "--", path), path).stdout
+
+    def write_text(self, path, data) -> None:
+
+        # - written to a temporary file and renamed, as write_atomic
+
+        tmp = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{time.monotonic_ns()}")
+        out = self.run("sh", "-c", 'cat > "$1" && mv -- "$1" "$2"', "sh", tmp, path, input = data)
+        _check(out, path)
+
+    def move_to_trash(self, folder) -> str:
+
+        # - same names as prune.move_to_trash
+
+        trash = self.join(prune.TRASH)
+        name = os.path.basename(folder.rstrip("/"))
+        dst = os.path.join(trash, name)
+        idx = 1
+
+        self.makedirs(trash)
+        while self.exists(dst):
+            dst = os.path.join(trash, f"{name}.{idx}")
+            idx += 1
+
+        self.move(folder, dst)
+        return dst
+
+    def reap(self, background = False, max_rate = None) -> None:
+
+        # - there is no snappy on the remote host, so the trash is
+        # - deleted with rm. max_rate, the rate limit of `snappy prune`,
+        # - cannot be applied
+
+        if max_rate:
+            logger.warning(f"max_delete_rate does not apply to remote folder {self}. Its trash is deleted at full speed")
+
+        trash = self.join(prune.TRASH)
+        if background:
+            logger.info(f"Pruning {self.target(trash)} in the background")
+            command = f"nohup rm -rf -- {shlex.quote(trash)} > /dev/null 2>&1 &"
+            _check(self.run("sh", "-c", command), trash)
+            return None
+
+        logger.info(f"Pruning {self.target(trash)}")
+        self.rmtree(trash)
+
+    def _test(self, flag, path) -> bool:
+
+        out = self.run("test", flag, path)
+        if out.returncode == SSH_ERROR:
+            _check(out, path)
+
+        return out.returncode == 0
+
+
+def is_remote(spec) -> bool:
+    return isinstance(spec, str) and (REMOTE.match(spec) is not None)
+
+
+def get_destination(spec, **kws):
+
+    # -----------------------------------------------------------
+    #  Destination for a backup folder: spec can be a local path,
+    #  [user@]host:/path or a destination, which is returned as
+    #  it is. Keyword arguments are options of SshDestination
+    # -----------------------------------------------------------
+
+    if isinstance(spec, (LocalDestination, SshDestination)):
+        return spec
+
+    match = REMOTE.match(spec) if isinstance(spec, str) else None
+    if match is None:
+        return LocalDestination(spec)
+
+    return SshDestination(match["host"], match["path"], match["user"], **kws)
+
+
+def from_config(config, spec):
+
+    # - destination with the options of the [ssh] section. Raises
+    # - ValueError if an option is invalid
+
+    def value(key):
+        v = config.get("ssh", key, fallback = "")
+        return "" if v is None else v.strip()
+
+    if not is_remote(spec):
+        return get_destination(spec)
+
+    port = value("port")
+    return get_destination(
+        spec,
+        port = int(port) if port != "" else None,
+        compress = value("compress") or None,
+        ssh_options = shlex.split(value("options")),
+    )
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _check(out, path):
+
+    # - ssh exits with 255 when the connection fails, otherwise with
+    # - the exit code of the command
+
+    if out.returncode == 0:
+        return out
+
+    msg = out.stderr.strip()
+    if out.returncode == SSH_ERROR:
+        raise SshError(f"ssh command failed: {msg}")
+
+    if "No such file or directory" in msg:
+        raise FileNotFoundError(errno.ENOENT, msg, path)
+
+    raise OSError(f"Remote command failed with code {out.returncode}: {msg}")
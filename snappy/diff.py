@@ -0,0 +1,227 @@
+import os
+import stat
+import json
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from .catalog import Catalog
+from .destination import get_destination
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+DIFF_WORKERS = 8
+
+# - folders listed ahead of the walk, on both sides
+
+PREFETCH = 16
+
+STATUSES = ("added", "removed", "modified", "unchanged")
+SYMBOLS = {"added" : "+", "removed" : "-", "modified" : "M", "unchanged" : " "}
+
+DiffEntry = collections.namedtuple("DiffEntry", ["status", "path", "kind"])
+
+
+class DiffStats:
+
+    def __init__(self) -> None:
+        for s in STATUSES:
+            setattr(self, s, 0)
+
+    def add(self, entry) -> None:
+        setattr(self, entry.status, getattr(self, entry.status) + 1)
+
+    def to_dict(self) -> dict:
+        return {s : getattr(self, s) for s in STATUSES}
+
+    def __str__(self) -> str:
+        return ", ".join(f"{getattr(self, s)} {s}" for s in STATUSES)
+
+
+def diff(a: os.PathLike, b: os.PathLike, workers = DIFF_WORKERS, unchanged = False, stats = None):
+
+    # ------------------------------------------------------------------
+    #  Entries that differ between the trees a and b, e.g. two snapshots,
+    #  without reading any file. A file with the same inode on both
+    #  sides is a hard link made by rsync --link-dest and is unchanged,
+    #  as is one with the same type, size, mtime and mode. Folders are
+    #  modified when their mode or owner differ. An added or removed
+    #  folder is a single entry. Entries are yielded depth first in
+    #  name order, the entries under a folder right after its own, and
+    #  only the folders on the path from the root are kept in memory.
+    #  Folders are listed ahead by `workers` threads. stats, a
+    #  DiffStats, counts the entries
+    # ------------------------------------------------------------------
+
+    a = ut.normalize_path(a).rstrip(os.path.sep) or os.path.sep
+    b = ut.normalize_path(b).rstrip(os.path.sep) or os.path.sep
+    for path in (a, b):
+        if not os.path.isdir(path):
+            raise NotADirectoryError(f"Cannot compare {path}: it is not a folder")
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+
+        def listing(item):
+            if item[1] is None:
+                item[1] = pool.submit(_list, os.path.join(a, item[0]))
+                item[2] = pool.submit(_list, os.path.join(b, item[0]))
+
+        def prefetch():
+
+            # - the next PREFETCH folders to enter, from the innermost one
+
+            ahead = 0
+            for _, folders in reversed(frames):
+                for item in folders:
+                    if ahead == PREFETCH:
+                        return None
+                    listing(item)
+                    ahead += 1
+
+        # - each frame holds the children of a folder being walked, as
+        # - entries and sub folders in name order, and the sub folders
+        # - not entered yet. A sub folder is its relative path and the
+        # - listings of both sides, None until it is close to being
+        # - entered
+
+        root = ["", None, None]
+        frames = [(collections.deque([root]), collections.deque([root]))]
+        while frames:
+            children, folders = frames[-1]
+            if not children:
+                frames.pop()
+                continue
+
+            item = children.popleft()
+            if isinstance(item, DiffEntry):
+                if stats is not None:
+                    stats.add(item)
+                yield item
+                continue
+
+            folders.popleft()
+            listing(item)
+            prefetch()
+
+            rel = item[0]
+            old, new = item[1].result(), item[2].result()
+            children, folders = collections.deque(), collections.deque()
+            for name in sorted(old.keys() | new.keys()):
+                path = os.path.join(rel, name) if rel else name
+                sa, sb = old.get(name), new.get(name)
+
+                status = _classify(sa, sb, os.path.join(a, path), os.path.join(b, path))
+                if (status != "unchanged") or unchanged:
+                    children.append(DiffEntry(status, path, _kind(sb if sb is not None else sa)))
+
+                if (sa is not None) and (sb is not None) and stat.S_ISDIR(sa.st_mode) and stat.S_ISDIR(sb.st_mode):
+                    sub = [path, None, None]
+                    children.append(sub)
+                    folders.append(sub)
+
+            frames.append((children, folders))
+
+
+def snapshot_folders(path: os.PathLike, old = None, new = None) -> tuple:
+
+    # - folders of two complete snapshots of the backup folder path,
+    # - by default the two newest ones. new defaults to the newest
+
+    dest = get_destination(path)
+    if dest.remote:
+        raise ValueError(f"Cannot compare snapshots of remote folder {dest}. Run snappy diff on the remote host")
+
+    names = [e["name"] for e in Catalog.load(dest.path).snapshots()]
+    old, new = [None if n is None else os.path.basename(n.rstrip(os.path.sep)) for n in (old, new)]
+    for name in (old, new):
+        if (name is not None) and (name not in names):
+            raise ValueError(f"Snapshot {name} is not a complete snapshot of {dest.path}")
+
+    if new is None:
+        if not names:
+            raise ValueError(f"There are no complete snapshots in {dest.path}")
+        new = names[-1]
+
+    if old is None:
+        earlier = names[:names.index(new)]
+        if not earlier:
+            raise ValueError(f"There is no snapshot before {new} in {dest.path}")
+        old = earlier[-1]
+
+    return os.path.join(dest.path, old), os.path.join(dest.path, new)
+
+
+def format_entry(entry, as_json = False) -> str:
+
+    if as_json:
+        return json.dumps(entry._asdict())
+
+    suffix = os.path.sep if entry.kind == "dir" else ""
+    return f"{SYMBOLS[entry.status]} {entry.path}{suffix}"
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _list(path) -> dict:
+
+    # - name to stat of the entries of a folder
+
+    out = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    out[entry.name] = entry.stat(follow_symlinks = False)
+                except OSError:
+                    continue
+    except OSError as err:
+        logger.warning(f"Cannot list folder {path}: {err}")
+
+    return out
+
+
+def _kind(st) -> str:
+
+    if stat.S_ISREG(st.st_mode):
+        return "file"
+    if stat.S_ISDIR(st.st_mode):
+        return "dir"
+    if stat.S_ISLNK(st.st_mode):
+        return "link"
+    return "other"
+
+
+def _classify(sa, sb, a, b) -> str:
+
+    if sa is None:
+        return "added"
+    if sb is None:
+        return "removed"
+
+    if stat.S_IFMT(sa.st_mode) != stat.S_IFMT(sb.st_mode):
+        return "modified"
+
+    same_owner = (sa.st_mode == sb.st_mode) and (sa.st_uid == sb.st_uid) and (sa.st_gid == sb.st_gid)
+    if stat.S_ISDIR(sa.st_mode):
+        return "unchanged" if same_owner else "modified"
+
+    if (sa.st_ino == sb.st_ino) and (sa.st_dev == sb.st_dev):
+        return "unchanged"
+
+    if not (same_owner and (sa.st_size == sb.st_size) and (sa.st_mtime_ns == sb.st_mtime_ns)):
+        return "modified"
+
+    # - a link target is as short as its size, reading it is cheap
+
+    if stat.S_ISLNK(sa.st_mode):
+        try:
+            return "unchanged" if os.readlink(a) == os.readlink(b) else "modified"
+        except OSError:
+            return "modified"
+
+    return "unchanged"
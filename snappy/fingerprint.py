@@ -0,0 +1,314 @@
+import os
+import json
+import stat
+import time
+import errno
+import shutil
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .config import cache_loc
+from .stats import TransferStats
+from . import scan
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_WORKERS = 8
+LINK_WORKERS = 8
+
+# - entries changed this close to the walk might change again within
+# - the same timestamp tick, so such a fingerprint is not trusted
+
+RACY_SECONDS = scan.RACY_SECONDS
+
+
+class Fingerprint:
+
+    # -------------------------------------------------------------------
+    #  Digest of the metadata of every entry under a source: path, type,
+    #  mode, owner, size, inode, mtime and ctime. Writing, renaming or
+    #  chmod-ing anything changes the ctime of the entry, so two equal
+    #  fingerprints mean that rsync would find nothing to transfer.
+    #  Folders are walked in parallel. racy is True if an entry changed
+    #  right before the walk, in which case the digest is not reliable
+    # -------------------------------------------------------------------
+
+    def __init__(self, src, max_workers = FINGERPRINT_WORKERS) -> None:
+
+        self.src = ut.normalize_path(src)
+        self.digest = None
+        self.racy = False
+        self.files = 0
+        self.size = 0
+        self._max_workers = max_workers
+
+    def compute(self) -> str:
+
+        base = self.src.rstrip(os.path.sep) or os.path.sep
+        started = time.time()
+        limit = (started - RACY_SECONDS) * 1e9
+        totals = []
+
+        def visit(path, rel):
+            digest, subdirs, newest, files, size = _digest_dir(path, rel)
+            totals.append((newest, files, size))
+            return [(rel, digest)], subdirs
+
+        st = os.lstat(base)
+        entries = [("", _entry_line("", st))]
+        totals.append((max(st.st_mtime_ns, st.st_ctime_ns), 0, 0))
+        if stat.S_ISDIR(st.st_mode):
+            entries += scan._walk(base, visit, self._max_workers)
+        else:
+            totals.append((0, 1, st.st_size))
+
+        digest = hashlib.sha256()
+        for rel, line in sorted(entries):
+            digest.update(rel.encode("utf8", errors = "surrogateescape") + b"\0" + line.encode("utf8") + b"\n")
+
+        self.digest = digest.hexdigest()
+        self.racy = any(t[0] >= limit for t in totals)
+        self.files = sum(t[1] for t in totals)
+        self.size = sum(t[2] for t in totals)
+        return self.digest
+
+
+class FastPath:
+
+    # ------------------------------------------------------------------
+    #  Decides which sources can skip rsync. A source is linked from the
+    #  previous snapshot instead when its fingerprint and the rsync
+    #  options are the same as when that snapshot was taken. The
+    #  fingerprints of a run are saved by commit once it succeeds, per
+    #  source and backup folder, in the snappy cache folder
+    # ------------------------------------------------------------------
+
+    version = 1
+
+    def __init__(self, folder, previous = None, rsync_args = None, cache_dir = None) -> None:
+
+        self.folder = os.path.abspath(folder)
+        self.previous = previous
+        self.options = options_digest(rsync_args or [])
+        self.cache_dir = os.path.join(cache_loc(), "fingerprint") if cache_dir is None else cache_dir
+        self._pending = {}
+
+    def check(self, src):
+
+        # - (previous subtree or None, reason)
+
+        fp = Fingerprint(src)
+        if src.endswith(os.path.sep):
+            return None, "its contents are merged into the snapshot root"
+
+        try:
+            fp.compute()
+        except OSError as err:
+            return None, f"cannot compute its fingerprint: {err}"
+
+        if fp.racy:
+            return None, "it changed in the last few seconds"
+
+        self._pending[fp.src] = fp
+
+        if self.previous is None:
+            return None, "there is no previous snapshot"
+
+        cached = self._load(fp.src)
+        if cached is None:
+            return None, "it has no saved fingerprint"
+
+        if cached.get("snapshot") != self.previous:
+            return None, f"its fingerprint is not from the previous snapshot {self.previous}"
+
+        if cached.get("options") != self.options:
+            return None, "the rsync options changed"
+
+        if cached.get("fingerprint") != fp.digest:
+            return None, "it changed since the previous snapshot"
+
+        old = os.path.join(self.folder, self.previous, os.path.basename(fp.src))
+        if not os.path.lexists(old):
+            return None, "it is missing from the previous snapshot"
+
+        return old, f"unchanged since snapshot {self.previous}"
+
+    def fingerprint(self, src):
+        return self._pending.get(ut.normalize_path(src))
+
+    def commit(self, snapshot) -> None:
+
+        for src, fp in self._pending.items():
+            data = {
+                "version" : self.version,
+                "src" : src,
+                "folder" : self.folder,
+                "snapshot" : snapshot,
+                "options" : self.options,
+                "fingerprint" : fp.digest,
+            }
+
+            try:
+                ut.write_atomic(self._file(src), json.dumps(data, indent = 1))
+            except OSError as err:
+                logger.warning(f"Cannot save fingerprint of {src}: {err}")
+
+        self._pending = {}
+
+    def _file(self, src):
+        key = hashlib.sha1(f"{src}\n{self.folder}".encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load(self, src):
+
+        try:
+            with open(self._file(src), "r", encoding = "utf8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logger.warning(f"Ignoring unreadable fingerprint of {src}: {err}")
+            return None
+
+        if (data.get("version") != self.version) or (data.get("src") != src) or (data.get("folder") != self.folder):
+            return None
+
+        return data
+
+
+def link_tree(src, dst, workers = LINK_WORKERS) -> int:
+
+    # -------------------------------------------------------------
+    #  Recreate the folders of src in dst and hard link everything
+    #  else, symbolic links included. Folders are filled by a thread
+    #  pool and get the mode, owner and times of src last. Returns
+    #  the number of linked entries
+    # -------------------------------------------------------------
+
+    if not os.path.isdir(src) or os.path.islink(src):
+        _link(src, dst)
+        return 1
+
+    folders = [(0, src, dst)]
+    linked = 0
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+
+        pending = {pool.submit(_link_folder, src, dst, 0)}
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for fut in done:
+                subdirs, n = fut.result()
+                linked += n
+                for depth, s, d in subdirs:
+                    folders.append((depth, s, d))
+                    pending.add(pool.submit(_link_folder, s, d, depth))
+
+    folders.sort(key = lambda x: x[0], reverse = True)
+    for _, s, d in folders:
+        _copy_folder_stat(s, d)
+
+    return linked
+
+
+def options_digest(rsync_args):
+
+    # - digest of the rsync options that shape a snapshot, without
+    # - the ones that depend on the run
+
+    args = [a for a in rsync_args if not a.startswith("--link-dest=") and a != "--dry-run"]
+    return hashlib.sha1(json.dumps(args).encode("utf8")).hexdigest()
+
+
+def snapshot_stats(src, fp, seconds) -> TransferStats:
+
+    # - statistics of a linked source: nothing was transferred
+
+    stats = TransferStats(src)
+    stats.files = fp.files
+    stats.total_size = fp.size
+    stats.seconds = seconds
+    return stats
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _entry_line(name, st):
+    return f"{name}\0{st.st_mode}\0{st.st_uid}\0{st.st_gid}\0{st.st_size}\0{st.st_ino}\0{st.st_mtime_ns}\0{st.st_ctime_ns}"
+
+
+def _digest_dir(path, rel):
+
+    # - digest of the entries of one folder, its sub folders and the
+    # - newest change time, number and size of its regular files
+
+    with os.scandir(path) as it:
+        entries = sorted(it, key = lambda e: e.name)
+
+    digest = hashlib.sha256()
+    subdirs = []
+    newest = 0
+    files = 0
+    size = 0
+
+    for entry in entries:
+        st = entry.stat(follow_symlinks = False)
+        digest.update(_entry_line(entry.name, st).encode("utf8", errors = "surrogateescape") + b"\n")
+        newest = max(newest, st.st_mtime_ns, st.st_ctime_ns)
+
+        if stat.S_ISDIR(st.st_mode):
+            subdirs.append(rel + os.path.sep + entry.name)
+        elif stat.S_ISREG(st.st_mode):
+            files += 1
+            size += st.st_size
+
+    return digest.hexdigest(), subdirs, newest, files, size
+
+
+def _link_folder(src, dst, depth):
+
+    os.mkdir(dst)
+    with os.scandir(src) as it:
+        entries = list(it)
+
+    subdirs = []
+    linked = 0
+    for entry in entries:
+        target = os.path.join(dst, entry.name)
+        if entry.is_dir(follow_symlinks = False):
+            subdirs.append((depth + 1, entry.path, target))
+            continue
+
+        _link(entry.path, target)
+        linked += 1
+
+    return subdirs, linked
+
+
+def _link(src, dst):
+
+    # - a file with as many links as the file system allows is copied
+
+    try:
+        os.link(src, dst, follow_symlinks = False)
+    except OSError as err:
+        if err.errno != errno.EMLINK:
+            raise
+        shutil.copy2(src, dst, follow_symlinks = False)
+
+
+def _copy_folder_stat(src, dst):
+
+    st = os.lstat(src)
+    try:
+        os.chown(dst, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns = (st.st_atime_ns, st.st_mtime_ns))
@@ -0,0 +1,138 @@
+import os
+import select
+import struct
+import ctypes
+import ctypes.util
+import collections
+
+
+# - flags from <sys/inotify.h>
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# - every change to the contents or metadata of a tree
+
+TREE_EVENTS = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+EVENT = struct.Struct("iIII")
+READ_SIZE = 65536
+
+Event = collections.namedtuple("Event", ["wd", "mask", "cookie", "name"])
+
+
+class Inotify:
+
+    # ---------------------------------------------------------------
+    #  Minimal binding of the Linux inotify API through libc. Raises
+    #  OSError where the system calls fail, e.g. with ENOSPC once the
+    #  fs.inotify.max_user_watches limit is reached
+    # ---------------------------------------------------------------
+
+    def __init__(self) -> None:
+
+        self._libc = _libc()
+        fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if fd < 0:
+            _raise()
+
+        self.fd = fd
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def add_watch(self, path, mask = TREE_EVENTS) -> int:
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            _raise(path)
+
+        return wd
+
+    def rm_watch(self, wd) -> None:
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout = None) -> list:
+
+        # - events available within timeout seconds, [] if none
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        return list(parse(data))
+
+    def close(self) -> None:
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def parse(data: bytes):
+
+    # - inotify_event structures: wd, mask, cookie, len and a name
+    # - padded with NUL bytes to len
+
+    offset = 0
+    while offset + EVENT.size <= len(data):
+        wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        name = data[offset:offset + length].rstrip(b"\0")
+        offset += length
+        yield Event(wd, mask, cookie, os.fsdecode(name))
+
+
+def is_supported() -> bool:
+    try:
+        _libc()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _libc():
+
+    name = ctypes.util.find_library("c") or "libc.so.6"
+    lib = ctypes.CDLL(name, use_errno = True)
+    lib.inotify_init1.argtypes = [ctypes.c_int]
+    lib.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    lib.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return lib
+
+
+def _raise(path = None):
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), path)
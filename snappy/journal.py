@@ -0,0 +1,456 @@
+import os
+import json
+import time
+import uuid
+import errno
+import hashlib
+import logging
+import threading
+
+from .config import cache_loc
+from .fingerprint import options_digest
+from . import inotify
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.5
+
+# - a longer journal starts a new epoch, i.e. the next snapshot of
+# - the source walks it all
+
+MAX_JOURNAL = 64 * 1024 ** 2
+
+WATCH_MASK = inotify.TREE_EVENTS | inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW | inotify.IN_EXCL_UNLINK
+
+# - kinds of journal entries: a changed path, and a folder created or
+# - moved into the source whose whole tree has to be sent
+
+CHANGED = "f"
+TREE = "t"
+
+
+class Journal:
+
+    # ---------------------------------------------------------------
+    #  Changes to one source folder, written by `snappy watch` to the
+    #  snappy cache folder. changes is an append-only list of paths
+    #  relative to the source, each prefixed with its kind and ended
+    #  by NUL. state.json has the pid of the watcher and the epoch of
+    #  the journal, which is new whenever the list starts over. ready
+    #  is False until every folder is watched, or once changes may
+    #  have been missed
+    # ---------------------------------------------------------------
+
+    version = 1
+
+    def __init__(self, src, cache_dir = None) -> None:
+
+        self.src = ut.normalize_path(src).rstrip(os.path.sep) or os.path.sep
+        cache_dir = os.path.join(cache_loc(), "journal") if cache_dir is None else cache_dir
+        key = hashlib.sha1(self.src.encode("utf8", errors = "surrogateescape")).hexdigest()
+        self.folder = os.path.join(cache_dir, key)
+
+    @property
+    def state_file(self) -> str:
+        return os.path.join(self.folder, "state.json")
+
+    @property
+    def changes_file(self) -> str:
+        return os.path.join(self.folder, "changes")
+
+    def state(self):
+
+        try:
+            with open(self.state_file, "r", encoding = "utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (data.get("version") != self.version) or (data.get("src") != self.src):
+            return None
+
+        return data
+
+    def reset(self, pid, ready = False) -> str:
+
+        # - the new epoch is saved before the list is emptied, so that a
+        # - reader never takes the new list for the old one
+
+        epoch = uuid.uuid4().hex
+        self._save_state(pid, epoch, False)
+        with open(self.changes_file, "wb"):
+            pass
+
+        if ready:
+            self._save_state(pid, epoch, True)
+
+        return epoch
+
+    def set_ready(self, ready) -> None:
+
+        state = self.state()
+        if state is not None:
+            self._save_state(state["pid"] if ready else None, state["epoch"], ready)
+
+    def append(self, changes) -> None:
+
+        data = b"".join(kind.encode() + os.fsencode(rel) + b"\0" for rel, kind in changes.items())
+        with open(self.changes_file, "ab") as f:
+            f.write(data)
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.changes_file)
+        except FileNotFoundError:
+            return 0
+
+    def read(self, start, end):
+
+        # - changes between two offsets, as {path : kind}, and the offset
+        # - where the last complete entry ends
+
+        with open(self.changes_file, "rb") as f:
+            f.seek(start)
+            data = f.read(max(end - start, 0))
+
+        complete = data.rfind(b"\0") + 1
+        changes = {}
+        for entry in data[:complete].split(b"\0")[:-1]:
+            kind, rel = entry[:1].decode(), os.fsdecode(entry[1:])
+            if changes.get(rel) != TREE:
+                changes[rel] = kind
+
+        return changes, start + complete
+
+    def _save_state(self, pid, epoch, ready) -> None:
+
+        data = {
+            "version" : self.version,
+            "src" : self.src,
+            "pid" : pid,
+            "epoch" : epoch,
+            "ready" : ready,
+        }
+        ut.write_atomic(self.state_file, json.dumps(data, indent = 1))
+
+
+class Watcher:
+
+    # ------------------------------------------------------------------
+    #  Watches every folder under the sources with inotify and appends
+    #  the changed paths to their journals every flush_interval seconds.
+    #  A new epoch starts for every source when the watcher starts and
+    #  when the kernel queue overflows, after which the sources are
+    #  walked again to watch new folders. A source that cannot be fully
+    #  watched, e.g. past fs.inotify.max_user_watches, is not ready and
+    #  is walked by rsync as usual
+    # ------------------------------------------------------------------
+
+    def __init__(self, sources, cache_dir = None, flush_interval = FLUSH_INTERVAL, max_size = MAX_JOURNAL) -> None:
+
+        self.journals = [Journal(src, cache_dir) for src in sources]
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._ino = None
+        self._wds = {}
+        self._pending = {}
+        self._failed = set()
+
+    def run(self, stop = None) -> None:
+
+        stop = threading.Event() if stop is None else stop
+        pid = os.getpid()
+
+        with inotify.Inotify() as ino:
+            self._ino = ino
+            try:
+                for idx, journal in enumerate(self.journals):
+                    journal.reset(pid)
+                    if not os.path.isdir(journal.src) or os.path.islink(journal.src):
+                        logger.warning(f"Only folders are watched. Source {journal.src} is not")
+                        self._failed.add(idx)
+                        continue
+
+                    self._watch(idx, journal.src, "")
+                    if idx not in self._failed:
+                        journal.set_ready(True)
+                        logger.info(f"Watching {journal.src}")
+
+                last = time.monotonic()
+                while not stop.is_set():
+                    for event in ino.read(self.flush_interval):
+                        self._handle(event)
+
+                    if time.monotonic() - last >= self.flush_interval:
+                        self.flush()
+                        last = time.monotonic()
+
+                self.flush()
+
+            finally:
+                for journal in self.journals:
+                    journal.set_ready(False)
+                self._ino = None
+
+    def flush(self) -> None:
+
+        pending, self._pending = self._pending, {}
+        for idx, changes in pending.items():
+            journal = self.journals[idx]
+            journal.append(changes)
+            if journal.size() > self.max_size:
+                logger.info(f"Journal of {journal.src} is full. Starting a new one")
+                journal.reset(os.getpid(), ready = True)
+
+    def _handle(self, event) -> None:
+
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            logger.warning("Too many changes at once. The next snapshot of every source walks it all")
+            self._pending = {}
+            for idx, journal in enumerate(self.journals):
+                if idx not in self._failed:
+                    self._rewatch(idx)
+            return None
+
+        targets = self._wds.get(event.wd)
+        if targets is None:
+            return None
+
+        if event.mask & inotify.IN_IGNORED:
+            del self._wds[event.wd]
+            return None
+
+        for idx, rel in list(targets.items()):
+
+            # - a folder reports its own changes, which its parent
+            # - folder also reports by name, except for the source
+
+            if not event.name:
+                if rel != "":
+                    continue
+
+                if event.mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                    logger.warning(f"Source {self.journals[idx].src} was moved or deleted. It is no longer watched")
+                    self._fail(idx)
+                elif event.mask & inotify.IN_ATTRIB:
+                    self._record(idx, rel, CHANGED)
+                continue
+
+            path = _join(rel, event.name)
+            if (event.mask & inotify.IN_ISDIR) and (event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO)):
+                self._record(idx, path, TREE)
+                self._watch(idx, os.path.join(self.journals[idx].src, path), path)
+            else:
+                self._record(idx, path, CHANGED)
+
+    def _record(self, idx, rel, kind) -> None:
+
+        if idx in self._failed:
+            return None
+
+        changes = self._pending.setdefault(idx, {})
+        if changes.get(rel) != TREE:
+            changes[rel] = kind
+
+    def _watch(self, idx, path, rel) -> None:
+
+        # - path and every folder under it. A folder watched again, e.g.
+        # - after a rename, keeps its descriptor with the new path
+
+        pending = [(path, rel)]
+        while pending and (idx not in self._failed):
+            path, rel = pending.pop()
+            try:
+                wd = self._ino.add_watch(path, WATCH_MASK)
+                self._wds.setdefault(wd, {})[idx] = rel
+                with os.scandir(path) as it:
+                    subdirs = [e.name for e in it if e.is_dir(follow_symlinks = False)]
+            except OSError as err:
+                self._watch_error(idx, path, err)
+                continue
+
+            for name in subdirs:
+                pending.append((os.path.join(path, name), _join(rel, name)))
+
+    def _rewatch(self, idx) -> None:
+
+        # - folders created while events were lost have no watch yet.
+        # - The journal is only ready again once they do
+
+        journal = self.journals[idx]
+        journal.reset(os.getpid())
+        self._watch(idx, journal.src, "")
+        if idx not in self._failed:
+            journal.set_ready(True)
+
+    def _watch_error(self, idx, path, err) -> None:
+
+        # - a folder removed meanwhile is reported by its parent
+
+        if err.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+
+        src = self.journals[idx].src
+        if err.errno == errno.ENOSPC:
+            logger.error(f"Cannot watch {path}: too many folders. Increase fs.inotify.max_user_watches to watch {src}")
+        else:
+            logger.error(f"Cannot watch {path}: {err}. Source {src} is no longer watched")
+
+        self._fail(idx)
+
+    def _fail(self, idx) -> None:
+
+        self._failed.add(idx)
+        self._pending.pop(idx, None)
+        self.journals[idx].set_ready(False)
+
+
+class JournalPath:
+
+    # ----------------------------------------------------------------
+    #  Decides which sources can be snapshotted from their journal.
+    #  mark takes the position of the journal of a source before the
+    #  snapshot starts. A source is sent from its journal when the
+    #  position saved by the previous snapshot is of the same epoch,
+    #  with the same rsync options: the paths in between are all that
+    #  changed since then. Positions are saved by commit once the run
+    #  succeeds, per source and backup folder
+    # ----------------------------------------------------------------
+
+    version = 1
+
+    def __init__(self, folder, previous = None, rsync_args = None, cache_dir = None) -> None:
+
+        self.folder = os.path.abspath(folder)
+        self.previous = previous
+        self.options = options_digest(rsync_args or [])
+        self.cache_dir = cache_dir
+        self._marks = {}
+
+    def mark(self, src) -> bool:
+
+        journal = Journal(src, self.cache_dir)
+        state = journal.state()
+        if (state is None) or (not state.get("ready")) or (not _is_running(state.get("pid"))):
+            return False
+
+        self._marks[journal.src] = [state["epoch"], journal.size()]
+        return True
+
+    def check(self, src):
+
+        # - (previous subtree or None, changes, reason)
+
+        journal = Journal(src, self.cache_dir)
+        if src.endswith(os.path.sep) and journal.src != os.path.sep:
+            return None, None, "its contents are merged into the snapshot root"
+
+        mark = self._marks.get(journal.src)
+        if mark is None:
+            return None, None, "snappy watch is not running for it"
+
+        if self.previous is None:
+            return None, None, "there is no previous snapshot"
+
+        cursor = self._load(journal.src)
+        if cursor is None:
+            return None, None, "it has no journal position"
+
+        if cursor.get("snapshot") != self.previous:
+            return None, None, f"its journal position is not from the previous snapshot {self.previous}"
+
+        if cursor.get("options") != self.options:
+            return None, None, "the rsync options changed"
+
+        if cursor.get("epoch") != mark[0]:
+            return None, None, "its journal started over since the previous snapshot"
+
+        old = os.path.join(self.folder, self.previous, os.path.basename(journal.src))
+        if not os.path.lexists(old):
+            return None, None, "it is missing from the previous snapshot"
+
+        try:
+            changes, mark[1] = journal.read(cursor["offset"], mark[1])
+        except OSError as err:
+            return None, None, f"cannot read its journal: {err}"
+
+        # - the journal must not have started over while it was read
+
+        state = journal.state()
+        if (state is None) or (state.get("epoch") != mark[0]) or (not state.get("ready")):
+            return None, None, "its journal started over since the previous snapshot"
+
+        return old, changes, f"{len(changes)} paths changed since snapshot {self.previous}"
+
+    def commit(self, snapshot) -> None:
+
+        for src, (epoch, offset) in self._marks.items():
+            data = {
+                "version" : self.version,
+                "src" : src,
+                "folder" : self.folder,
+                "snapshot" : snapshot,
+                "options" : self.options,
+                "epoch" : epoch,
+                "offset" : offset,
+            }
+
+            try:
+                ut.write_atomic(self._file(src), json.dumps(data, indent = 1))
+            except OSError as err:
+                logger.warning(f"Cannot save journal position of {src}: {err}")
+
+        self._marks = {}
+
+    def _file(self, src):
+        key = hashlib.sha1(self.folder.encode("utf8", errors = "surrogateescape")).hexdigest()
+        return os.path.join(Journal(src, self.cache_dir).folder, f"position-{key}.json")
+
+    def _load(self, src):
+
+        try:
+            with open(self._file(src), "r", encoding = "utf8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logger.warning(f"Ignoring unreadable journal position of {src}: {err}")
+            return None
+
+        if (data.get("version") != self.version) or (data.get("src") != src) or (data.get("folder") != self.folder):
+            return None
+
+        return data
+
+
+def watch(sources, cache_dir = None, stop = None) -> None:
+
+    # - runs until stop is set
+
+    Watcher(sources, cache_dir).run(stop)
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _join(rel, name):
+    return os.path.join(rel, name) if rel else name
+
+
+def _is_running(pid):
+
+    if not pid:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
@@ -0,0 +1,58 @@
+import os
+import fcntl
+import hashlib
+
+from .config import cache_loc
+
+
+class LockedError(RuntimeError):
+    pass
+
+
+class DestinationLock:
+
+    # ---------------------------------------------------------------
+    #  Lock held while a snapshot of a destination is created, so that
+    #  a scheduled run and a manual one never overlap. It is a flock
+    #  on a file of the snappy cache folder, released by the system if
+    #  the process dies. acquire raises LockedError if it is taken
+    # ---------------------------------------------------------------
+
+    def __init__(self, destination, cache_dir = None) -> None:
+
+        self.destination = str(destination)
+        cache_dir = os.path.join(cache_loc(), "locks") if cache_dir is None else cache_dir
+        key = hashlib.sha1(self.destination.encode("utf8")).hexdigest()
+        self.path = os.path.join(cache_dir, f"{key}.lock")
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    @property
+    def locked(self) -> bool:
+        return self._file is not None
+
+    def acquire(self) -> None:
+
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        f = open(self.path, "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise LockedError(f"Another snapshot of {self.destination} is running") from None
+
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._file = f
+
+    def release(self) -> None:
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
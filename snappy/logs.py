@@ -0,0 +1,413 @@
+import os
+import time
+import zlib
+import queue
+import shutil
+import logging
+import threading
+import logging.handlers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = ("gzip", "zstd", "none")
+EXTENSIONS = {"gzip" : ".log.gz", "zstd" : ".log.zst", "none" : ".log"}
+DEFAULT_LEVELS = {"gzip" : 6, "zstd" : 3, "none" : None}
+
+# - the compressed stream is flushed at least this often, and after
+# - every warning, so that a crashed run leaves a readable log
+
+FLUSH_INTERVAL = 1.0
+READ_SIZE = 65536
+
+# - records written by the background thread in one go, and seconds
+# - between refreshes of the console summary
+
+BATCH_SIZE = 512
+SUMMARY_INTERVAL = 0.5
+
+# - records waiting for the background thread, past which callers
+# - block, and seconds between checks that the thread is alive
+
+MAX_QUEUED = 65536
+WRITER_POLL = 1.0
+CONSOLE_MODES = ("full", "summary")
+
+
+class CompressedFileHandler(logging.Handler):
+
+    # ------------------------------------------------------------------
+    #  Logging handler that compresses records as they are written.
+    #  The file is created on the first record and can be renamed while
+    #  open (see rename). Every flush ends a compressed block, so a file
+    #  cut short by a crash can still be read up to the last flush with
+    #  read_log, zcat or zstdcat
+    # ------------------------------------------------------------------
+
+    def __init__(self, filename, compression = "gzip", level = None, encoding = "utf8", flush_interval = FLUSH_INTERVAL) -> None:
+
+        logging.Handler.__init__(self)
+
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Invalid log compression '{compression}'. Choose one of {', '.join(COMPRESSIONS)}")
+
+        if (compression == "zstd") and (zstandard is None):
+            logger.warning("Package zstandard is not installed. Compressing logs with gzip")
+            compression = "gzip"
+            level = None
+
+        self.baseFilename = os.path.abspath(filename)
+        self.compression = compression
+        self.compresslevel = DEFAULT_LEVELS[compression] if level is None else level
+        self.encoding = encoding
+        self.flush_interval = flush_interval
+        self.stream = None
+        self._last_flush = 0.0
+
+    def emit(self, record) -> None:
+
+        try:
+            msg = self.format(record) + "\n"
+            if self.stream is None:
+                self.stream = _open(self.baseFilename, self.compression, self.compresslevel)
+
+            self.stream.write(msg.encode(self.encoding))
+            now = time.monotonic()
+            if (record.levelno >= logging.WARNING) or (now - self._last_flush >= self.flush_interval):
+                self.stream.flush()
+                self._last_flush = now
+
+        except Exception:
+            self.handleError(record)
+
+    def rename(self, filename) -> None:
+
+        # - the open stream keeps writing to the renamed file
+
+        filename = os.path.abspath(filename)
+        self.acquire()
+        try:
+            if self.stream is not None:
+                os.replace(self.baseFilename, filename)
+            self.baseFilename = filename
+        finally:
+            self.release()
+
+    def flush(self) -> None:
+
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self) -> None:
+
+        self.acquire()
+        try:
+            if self.stream is not None:
+                stream = self.stream
+                self.stream = None
+                stream.close()
+        finally:
+            self.release()
+            logging.Handler.close(self)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    # ----------------------------------------------------------------
+    #  Hands records to a background thread that writes them to the
+    #  wrapped handlers in batches, so that the caller (e.g. the rsync
+    #  output pump) only pays for putting the record in a queue, up to
+    #  max_queued records. Closing the handler writes the pending
+    #  records. If the thread is gone, callers write their records
+    # ----------------------------------------------------------------
+
+    def __init__(self, handlers, batch_size = BATCH_SIZE, max_queued = MAX_QUEUED) -> None:
+
+        logging.handlers.QueueHandler.__init__(self, queue.Queue(max_queued))
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self._thread = threading.Thread(target = self._write, name = "snappy-log-writer", daemon = True)
+        self._thread.start()
+
+    def prepare(self, record):
+
+        # - the queue never leaves the process, so records are passed
+        # - as they are instead of being formatted and copied here
+
+        return record
+
+    def enqueue(self, record) -> None:
+        if not self._put(record):
+            self._handle([record])
+
+    def flush(self) -> None:
+
+        # - waits until the records queued so far are written
+
+        done = threading.Event()
+        if self._put(done):
+            while not done.wait(WRITER_POLL):
+                if not self._writing():
+                    return None
+
+    def close(self) -> None:
+
+        self.acquire()
+        try:
+            thread = self._thread
+            self._thread = None
+        finally:
+            self.release()
+
+        if thread is not None:
+            while thread.is_alive():
+                try:
+                    self.queue.put(None, timeout = WRITER_POLL)
+                    break
+                except queue.Full:
+                    continue
+
+            thread.join()
+            for hl in self.handlers:
+                hl.close()
+
+        logging.handlers.QueueHandler.close(self)
+
+    def _writing(self) -> bool:
+        thread = self._thread
+        return (thread is not None) and thread.is_alive()
+
+    def _put(self, item) -> bool:
+
+        # - False if no thread is left to write item
+
+        while self._writing():
+            try:
+                self.queue.put(item, timeout = WRITER_POLL)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _write(self):
+
+        # - None stops the thread, an Event is set once the records
+        # - before it are written and flushed. Otherwise the handlers
+        # - flush on their own, e.g. every FLUSH_INTERVAL
+
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            flush = any(isinstance(r, threading.Event) for r in batch)
+            try:
+                self._handle([r for r in batch if isinstance(r, logging.LogRecord)], flush)
+            finally:
+                for done in batch:
+                    if isinstance(done, threading.Event):
+                        done.set()
+
+    def _handle(self, records, flush = True):
+
+        # - a failing handler, e.g. on a full disk, is reported as
+        # - logging does and does not stop the others
+
+        for record in records:
+            for hl in self.handlers:
+                if record.levelno >= hl.level:
+                    try:
+                        hl.handle(record)
+                    except Exception:
+                        hl.handleError(record)
+
+        if not flush:
+            return None
+
+        for hl in self.handlers:
+            try:
+                hl.flush()
+            except Exception:
+                if records:
+                    hl.handleError(records[-1])
+
+
+class SummaryStreamHandler(logging.StreamHandler):
+
+    # --------------------------------------------------------------
+    #  Console handler that collapses the per-file lines of rsync
+    #  into one summary line, refreshed every `interval` seconds.
+    #  Any other record ends the summary and is written as usual
+    # --------------------------------------------------------------
+
+    def __init__(self, stream = None, collapse = "snappy.rsync", interval = SUMMARY_INTERVAL) -> None:
+
+        logging.StreamHandler.__init__(self, stream)
+        self.collapse = collapse
+        self.interval = interval
+        self.count = 0
+        self.last = ""
+        self._refreshed = None
+        self._width = 0
+        self._shown = 0
+
+    def emit(self, record) -> None:
+
+        if (record.name == self.collapse) and (record.levelno <= logging.INFO):
+            self.count += 1
+            self.last = record.getMessage()
+            now = time.monotonic()
+            if (self._refreshed is None) or (now - self._refreshed >= self.interval):
+                self._refresh()
+                self._refreshed = now
+            return None
+
+        self._finish()
+        logging.StreamHandler.emit(self, record)
+
+    def flush(self) -> None:
+
+        # - flush is called whenever the log is flushed, so the
+        # - summary is only finished by other records or by close
+
+        logging.StreamHandler.flush(self)
+
+    def close(self) -> None:
+
+        self.acquire()
+        try:
+            self._finish()
+        finally:
+            self.release()
+            logging.StreamHandler.close(self)
+
+    def _line(self):
+        return f"{self.count} rsync lines, last: {self.last}"
+
+    def _refresh(self):
+
+        try:
+            if self._isatty():
+                columns = shutil.get_terminal_size().columns - 1
+                line = self._line()[:columns]
+                self.stream.write("\r" + line.ljust(self._width))
+                self._width = len(line)
+            else:
+                self.stream.write(self._line() + self.terminator)
+            self.stream.flush()
+            self._shown = self.count
+        except Exception:
+            pass
+
+    def _finish(self):
+
+        if self.count == 0:
+            return None
+
+        if self._isatty():
+            self._refresh()
+            self.stream.write(self.terminator)
+        elif self._shown != self.count:
+            self._refresh()
+
+        self.count = 0
+        self.last = ""
+        self._width = 0
+        self._refreshed = None
+        self._shown = 0
+
+    def _isatty(self):
+        isatty = getattr(self.stream, "isatty", None)
+        return (isatty is not None) and isatty()
+
+
+def extension(compression) -> str:
+    return EXTENSIONS[compression if (compression != "zstd") or (zstandard is not None) else "gzip"]
+
+
+def read_log(file) -> str:
+
+    # - reads a log written by CompressedFileHandler, including the
+    # - readable part of a file left unfinished by a crash
+
+    if file.endswith(".gz"):
+        dec = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    elif file.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("Package zstandard is needed to read zstd logs")
+        dec = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        dec = None
+
+    data = []
+    with open(file, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            data.append(chunk if dec is None else dec.decompress(chunk))
+
+    return b"".join(data).decode("utf8", errors = "replace")
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+class _Writer:
+
+    # - compressed stream over a raw file. flush ends the current
+    # - compressed block and pushes it to the file
+
+    def __init__(self, raw, compressor = None, flush_block = None) -> None:
+
+        self.raw = raw
+        self.compressor = compressor
+        self.flush_block = flush_block
+
+    def write(self, data) -> None:
+        self.raw.write(data if self.compressor is None else self.compressor.compress(data))
+
+    def flush(self) -> None:
+
+        if self.compressor is not None:
+            self.raw.write(self.compressor.flush(self.flush_block))
+        self.raw.flush()
+
+    def close(self) -> None:
+
+        try:
+            if self.compressor is not None:
+                self.raw.write(self.compressor.flush())
+        finally:
+            self.raw.close()
+
+
+def _open(file, compression, level):
+
+    raw = open(file, "wb")
+    if compression == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return _Writer(raw, compressor, zlib.Z_SYNC_FLUSH)
+
+    if compression == "zstd":
+        compressor = zstandard.ZstdCompressor(level = level).compressobj()
+        return _Writer(raw, compressor, zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    return _Writer(raw)
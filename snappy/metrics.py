@@ -0,0 +1,207 @@
+import os
+import re
+import time
+import shutil
+import logging
+from .destination import is_remote
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+# - name: (type, help) of every metric family written by snappy
+
+METRICS = {
+    "snappy_last_run_timestamp_seconds" : ("gauge", "Time the last backup run finished"),
+    "snappy_last_success_timestamp_seconds" : ("gauge", "Time the last successful backup finished"),
+    "snappy_failures_total" : ("counter", "Failed backup runs by exit code"),
+    "snappy_phase_duration_seconds" : ("gauge", "Duration of each phase of the last successful backup"),
+    "snappy_source_duration_seconds" : ("gauge", "rsync duration of each source in the last successful backup"),
+    "snappy_source_transferred_bytes" : ("gauge", "Bytes transferred for each source in the last successful backup"),
+    "snappy_source_paused_seconds" : ("gauge", "Time each source was paused because of system pressure in the last successful backup"),
+    "snappy_transferred_bytes" : ("gauge", "Bytes transferred in the last successful backup"),
+    "snappy_snapshot_bytes" : ("gauge", "Size of the files in the last successful snapshot"),
+    "snappy_unchanged_bytes" : ("gauge", "Bytes of files not transferred by the last successful backup, hard linked if a previous snapshot has them"),
+    "snappy_snapshots" : ("gauge", "Number of complete snapshots in the backup folder"),
+    "snappy_backup_root_used_bytes" : ("gauge", "Used bytes in the file system of the backup folder"),
+    "snappy_backup_root_free_bytes" : ("gauge", "Free bytes in the file system of the backup folder"),
+    "snappy_prune_duration_seconds" : ("gauge", "Time spent deleting old snapshots in the last successful backup"),
+}
+
+SAMPLE_LINE = re.compile(r"^(?P<key>(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?) (?P<value>\S+)$")
+
+
+class TextFile:
+
+    # ------------------------------------------------------------------
+    #  Metrics in the Prometheus text format, as read by the node
+    #  exporter textfile collector. The previous file is read first so
+    #  that counters and the last success survive failed runs, and the
+    #  new file atomically replaces it
+    # ------------------------------------------------------------------
+
+    def __init__(self, file: os.PathLike) -> None:
+
+        self.file = ut.normalize_path(file)
+        self.samples = _read_samples(self.file)
+
+    def set(self, name, value, **labels) -> None:
+        self.samples[_key(name, labels)] = float(value)
+
+    def inc(self, name, value = 1, **labels) -> None:
+        key = _key(name, labels)
+        self.samples[key] = self.samples.get(key, 0.0) + value
+
+    def clear(self, name) -> None:
+        for key in [k for k in self.samples if _name(k) == name]:
+            self.samples.pop(key)
+
+    def text(self) -> str:
+
+        lines = []
+        for name, (mtype, help) in METRICS.items():
+            keys = sorted(k for k in self.samples if _name(k) == name)
+            if not keys:
+                continue
+
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {mtype}")
+            for k in keys:
+                lines.append(f"{k} {_format(self.samples[k])}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> None:
+        ut.write_atomic(self.file, self.text())
+
+
+def textfile(config) -> str:
+
+    # - metrics are enabled by the textfile key of the [metrics] section
+
+    file = config.get("metrics", "textfile", fallback = "").strip()
+    return file if file != "" else None
+
+
+def record_success(file, result, snapshots = None) -> None:
+
+    tf = TextFile(file)
+    now = time.time()
+
+    tf.set("snappy_last_run_timestamp_seconds", now)
+    tf.set("snappy_last_success_timestamp_seconds", now)
+
+    # - per run values are replaced as a whole, so that removed sources
+    # - do not linger in the file
+
+    for name in [
+        "snappy_phase_duration_seconds",
+        "snappy_source_duration_seconds",
+        "snappy_source_transferred_bytes",
+        "snappy_source_paused_seconds",
+        "snappy_prune_duration_seconds",
+    ]:
+        tf.clear(name)
+
+    for phase, seconds in result.phases.items():
+        tf.set("snappy_phase_duration_seconds", seconds, phase = phase)
+
+    for src in result.sources:
+        tf.set("snappy_source_duration_seconds", src.seconds, source = src.source)
+        tf.set("snappy_source_transferred_bytes", src.transferred_size, source = src.source)
+        tf.set("snappy_source_paused_seconds", src.paused, source = src.source)
+
+    total = result.total
+    tf.set("snappy_transferred_bytes", total.transferred_size)
+    tf.set("snappy_snapshot_bytes", total.total_size)
+    tf.set("snappy_unchanged_bytes", total.unchanged_size)
+
+    if "prune" in result.phases:
+        tf.set("snappy_prune_duration_seconds", result.phases["prune"])
+
+    if snapshots is not None:
+        tf.set("snappy_snapshots", snapshots)
+
+    if (result.folder is not None) and not is_remote(result.folder):
+        try:
+            usage = shutil.disk_usage(result.folder)
+        except OSError as err:
+            logger.warning(f"Cannot get disk usage of '{result.folder}': {err}")
+            tf.clear("snappy_backup_root_used_bytes")
+            tf.clear("snappy_backup_root_free_bytes")
+        else:
+            tf.set("snappy_backup_root_used_bytes", usage.used)
+            tf.set("snappy_backup_root_free_bytes", usage.free)
+
+    _write(tf)
+
+
+def record_failure(file, code) -> None:
+
+    tf = TextFile(file)
+    tf.set("snappy_last_run_timestamp_seconds", time.time())
+    tf.inc("snappy_failures_total", code = str(code))
+    _write(tf)
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _write(tf):
+
+    # - metrics must never break a backup
+
+    try:
+        tf.write()
+    except OSError as err:
+        logger.error(f"Could not write metrics to '{tf.file}': {err}")
+        return None
+
+    logger.info(f"Metrics written to '{tf.file}'")
+
+
+def _read_samples(file):
+
+    samples = {}
+    try:
+        with open(file, "r", encoding = "utf8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return samples
+    except OSError as err:
+        logger.warning(f"Cannot read previous metrics from '{file}': {err}")
+        return samples
+
+    for line in lines:
+        m = SAMPLE_LINE.match(line)
+        if (m is None) or (m.group("name") not in METRICS):
+            continue
+        try:
+            samples[m.group("key")] = float(m.group("value"))
+        except ValueError:
+            continue
+
+    return samples
+
+
+def _key(name, labels):
+
+    if not labels:
+        return name
+
+    items = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{items}}}"
+
+
+def _name(key):
+    return key.split("{", 1)[0]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value):
+    return str(int(value)) if value.is_integer() else repr(value)
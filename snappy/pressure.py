@@ -0,0 +1,213 @@
+import os
+import time
+import signal
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+PSI_LOC = "/proc/pressure"
+INTERVAL = 1.0
+
+
+class PressureGate:
+
+    # ------------------------------------------------------------------
+    #  Thresholds from the [pressure] section of the configuration file:
+    #  * io / cpu: "some" avg10 of /proc/pressure/io and cpu, in percent
+    #  * load: 1 minute load average per CPU
+    #  * interval: seconds between checks
+    #  * max_pause: seconds a source can be paused in total, after which
+    #    it runs regardless of the pressure. None for no limit
+    #  rsync to a remote host is only delayed before it starts, never
+    #  stopped, since its ssh session could time out
+    #  Unset thresholds (None) are not checked
+    # ------------------------------------------------------------------
+
+    def __init__(self, io = None, cpu = None, load = None, interval = INTERVAL, max_pause = None) -> None:
+
+        for name, value in [("io", io), ("cpu", cpu), ("load", load), ("max_pause", max_pause)]:
+            if (value is not None) and (value <= 0):
+                raise ValueError(f"Invalid pressure threshold {name}={value}. It must be positive")
+
+        if interval <= 0:
+            raise ValueError(f"Invalid pressure interval {interval}. It must be positive")
+
+        self.io = io
+        self.cpu = cpu
+        self.load = load
+        self.interval = interval
+        self.max_pause = max_pause
+
+        for resource in ["io", "cpu"]:
+            if (getattr(self, resource) is not None) and (read_psi(resource) is None):
+                logger.warning(f"Cannot read {os.path.join(PSI_LOC, resource)}. Its threshold is ignored")
+
+    @classmethod
+    def from_config(cls, config):
+
+        # - None if no threshold is set. Raises ValueError if a value
+        # - is invalid
+
+        def value(key):
+            v = config.get("pressure", key, fallback = "")
+            v = "" if v is None else v.strip()
+            return float(v) if v != "" else None
+
+        io, cpu, load = value("io"), value("cpu"), value("load")
+        if (io is None) and (cpu is None) and (load is None):
+            return None
+
+        interval = value("interval")
+        return cls(io, cpu, load, INTERVAL if interval is None else interval, value("max_pause"))
+
+    def reasons(self) -> list:
+
+        # - descriptions of the thresholds currently exceeded
+
+        out = []
+        for resource in ["io", "cpu"]:
+            limit = getattr(self, resource)
+            if limit is None:
+                continue
+
+            value = read_psi(resource)
+            if (value is not None) and (value > limit):
+                out.append(f"{resource} pressure {value:.1f}% > {limit:g}%")
+
+        if self.load is not None:
+            value = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if value > self.load:
+                out.append(f"load {value:.2f} per CPU > {self.load:g}")
+
+        return out
+
+    def watch(self):
+        return PressureWatch(self)
+
+
+class PressureWatch:
+
+    # --------------------------------------------------------------
+    #  Pauses one source while the pressure is too high: wait delays
+    #  its start and attach stops and continues its rsync process
+    #  group. Seconds are added up in `waited` and `stopped`
+    # --------------------------------------------------------------
+
+    def __init__(self, gate) -> None:
+
+        self.gate = gate
+        self.waited = 0.0
+        self.stopped = 0.0
+        self._proc = None
+        self._thread = None
+        self._log = logger
+        self._done = threading.Event()
+
+    @property
+    def paused(self) -> float:
+        return self.waited + self.stopped
+
+    def wait(self, log = None) -> None:
+
+        log = log or logger
+        start = time.monotonic()
+        reasons = self._reasons()
+        if not reasons:
+            return None
+
+        log.warning(f"Delaying start: {', '.join(reasons)}")
+        while reasons:
+            time.sleep(self.gate.interval)
+            reasons = self._reasons(time.monotonic() - start)
+
+        elapsed = time.monotonic() - start
+        self.waited += elapsed
+        log.info(f"Starting after waiting {elapsed:.1f}s for the pressure to drop")
+
+    def attach(self, proc, log = None) -> None:
+
+        # - proc must lead its own process group (start_new_session)
+        # - so that every rsync process is paused
+
+        self._proc = proc
+        self._log = log or logger
+        self._done.clear()
+        self._thread = threading.Thread(target = self._run, name = "snappy-pressure", daemon = True)
+        self._thread.start()
+
+    def detach(self) -> None:
+
+        if self._thread is None:
+            return None
+
+        self._done.set()
+        self._thread.join()
+        self._thread = None
+        self._proc = None
+
+    def _reasons(self, extra = 0.0):
+
+        # - no pausing once the budget is spent
+
+        if (self.gate.max_pause is not None) and (self.paused + extra >= self.gate.max_pause):
+            return []
+
+        return self.gate.reasons()
+
+    def _run(self):
+
+        stopped = None
+        try:
+            while not self._done.wait(self.gate.interval):
+
+                extra = 0.0 if stopped is None else time.monotonic() - stopped
+                reasons = self._reasons(extra)
+                if reasons and (stopped is None):
+                    self._log.warning(f"Pausing rsync: {', '.join(reasons)}")
+                    self._signal(signal.SIGSTOP)
+                    stopped = time.monotonic()
+
+                elif (not reasons) and (stopped is not None):
+                    self._signal(signal.SIGCONT)
+                    elapsed = time.monotonic() - stopped
+                    self.stopped += elapsed
+                    stopped = None
+                    self._log.info(f"Resuming rsync after {elapsed:.1f}s")
+
+        finally:
+
+            # - always continue the processes, also to let them exit
+            # - if they were killed while stopped
+
+            if stopped is not None:
+                self._signal(signal.SIGCONT)
+                self.stopped += time.monotonic() - stopped
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self._proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def read_psi(resource):
+
+    # - "some" avg10 of a PSI file, None if it cannot be read
+
+    try:
+        with open(os.path.join(PSI_LOC, resource), "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    for line in lines:
+        if line.startswith("some "):
+            fields = dict(kv.split("=", 1) for kv in line.split()[1:])
+            try:
+                return float(fields["avg10"])
+            except (KeyError, ValueError):
+                return None
+
+    return None
@@ -0,0 +1,248 @@
+import os
+import sys
+import stat
+import time
+import fcntl
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+logger = logging.getLogger(__name__)
+
+TRASH = ".trash"
+PRUNE_WORKERS = 4
+PRUNE_MODES = ("inline", "background", "deferred")
+
+
+class PruneStats:
+
+    def __init__(self) -> None:
+
+        self.folders = 0
+        self.inodes = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, other) -> None:
+
+        self.folders += other.folders
+        self.inodes += other.inodes
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+
+    @property
+    def inodes_per_second(self) -> float:
+        return self.inodes / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        mb = self.bytes / 1024 ** 2
+        return (
+            f"{self.inodes} inodes and {mb:.1f} MB freed in {self.seconds:.1f}s "
+            f"({self.inodes_per_second:.0f} inodes/s, {self.bytes_per_second / 1024 ** 2:.1f} MB/s)"
+        )
+
+
+class RateLimiter:
+
+    # - spaces calls to acquire so that at most `rate` of them happen
+    # - per second, across all threads
+
+    def __init__(self, rate) -> None:
+
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now)
+            delay = self._next - now
+            self._next += 1 / self.rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def trash_loc(path: os.PathLike) -> str:
+    return os.path.join(os.path.abspath(path), TRASH)
+
+
+def move_to_trash(path: os.PathLike, folder: os.PathLike) -> str:
+
+    # - a rename is atomic, so the snapshot disappears from the
+    # - backup folder at once and can be deleted later on
+
+    trash = trash_loc(path)
+    os.makedirs(trash, exist_ok = True)
+
+    name = os.path.basename(folder.rstrip(os.path.sep))
+    dst = os.path.join(trash, name)
+    idx = 1
+    while os.path.lexists(dst):
+        dst = os.path.join(trash, f"{name}.{idx}")
+        idx += 1
+
+    os.rename(folder, dst)
+    return dst
+
+
+def reap(path: os.PathLike, workers = PRUNE_WORKERS, max_rate = None) -> PruneStats:
+
+    # -----------------------------------------------------
+    #  Delete everything in the trash of the backup folder
+    #  path. Only one reaper runs at a time per trash, at
+    #  most max_rate entries per second if given
+    # -----------------------------------------------------
+
+    total = PruneStats()
+    trash = trash_loc(path)
+    if not os.path.isdir(trash):
+        logger.info("Nothing to prune")
+        return total
+
+    lock = open(os.path.join(trash, ".lock"), "w")
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Another process is already pruning {trash}")
+            return total
+
+        limiter = RateLimiter(max_rate) if max_rate else None
+        for name in sorted(os.listdir(trash)):
+            if name.startswith("."):
+                continue
+
+            logger.info(f"Pruning backup {name}")
+            stats = remove_tree(os.path.join(trash, name), workers, limiter)
+            logger.info(f"Pruned backup {name}: {stats}")
+            total.add(stats)
+
+    finally:
+        lock.close()
+
+    if total.folders > 0:
+        logger.info(f"Pruned {total.folders} backups: {total}")
+    else:
+        logger.info("Nothing to prune")
+
+    return total
+
+
+def reap_in_background(path: os.PathLike, workers = PRUNE_WORKERS, max_rate = None) -> subprocess.Popen:
+
+    # - the reaper runs as `snappy prune` in its own session so that
+    # - it outlives the backup process. It inherits the CPU and I/O
+    # - priority of this process
+
+    path = os.path.abspath(path)
+    cmd = [sys.executable, "-m", "snappy", "prune", "--folder", path, "--workers", str(workers), "--max-rate", str(max_rate or 0), "--quiet"]
+    logger.info(f"Pruning {trash_loc(path)} in the background")
+    return subprocess.Popen(
+        cmd,
+        stdin = subprocess.DEVNULL,
+        stdout = subprocess.DEVNULL,
+        stderr = subprocess.DEVNULL,
+        start_new_session = True,
+    )
+
+
+def remove_tree(path: os.PathLike, workers = PRUNE_WORKERS, limiter = None) -> PruneStats:
+
+    # -------------------------------------------------------------
+    #  Like shutil.rmtree, but folders are emptied by a thread pool
+    #  and then removed deepest first. Inodes and bytes are only
+    #  counted when their last link is removed. Every removed entry
+    #  waits for the limiter, a RateLimiter or None
+    # -------------------------------------------------------------
+
+    stats = PruneStats()
+    start = time.monotonic()
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        stats.inodes, stats.bytes = _unlink(path, limiter)
+        stats.seconds = time.monotonic() - start
+        return stats
+
+    folders = [(0, path)]
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+
+        pending = {pool.submit(_empty_folder, path, 0, limiter)}
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for fut in done:
+                subdirs, inodes, size = fut.result()
+                stats.inodes += inodes
+                stats.bytes += size
+                for depth, sub in subdirs:
+                    folders.append((depth, sub))
+                    pending.add(pool.submit(_empty_folder, sub, depth, limiter))
+
+    folders.sort(key = lambda x: x[0], reverse = True)
+    for _, folder in folders:
+        if limiter is not None:
+            limiter.acquire()
+        os.rmdir(folder)
+        stats.inodes += 1
+
+    stats.folders = 1
+    stats.seconds = time.monotonic() - start
+    return stats
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _empty_folder(folder, depth, limiter = None):
+
+    # - remove every non-folder entry and return the sub folders
+
+    subdirs = []
+    inodes = 0
+    size = 0
+
+    # - snapshots keep the source permissions, so the folder might
+    # - not be readable or writable by its owner
+
+    mode = os.lstat(folder).st_mode
+    if (mode & stat.S_IRWXU) != stat.S_IRWXU:
+        os.chmod(folder, stat.S_IMODE(mode) | stat.S_IRWXU)
+
+    with os.scandir(folder) as it:
+        entries = list(it)
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks = False):
+            subdirs.append((depth + 1, entry.path))
+            continue
+
+        n, b = _unlink(entry.path, limiter)
+        inodes += n
+        size += b
+
+    return subdirs, inodes, size
+
+
+def _unlink(path, limiter = None):
+
+    if limiter is not None:
+        limiter.acquire()
+
+    # - a hard link to another snapshot frees nothing
+
+    st = os.lstat(path)
+    os.unlink(path)
+    if st.st_nlink > 1:
+        return 0, 0
+
+    return 1, st.st_blocks * 512
@@ -0,0 +1,122 @@
+import os
+import re
+import logging
+import subprocess
+
+
+logger = logging.getLogger(__name__)
+
+IONICE_CLASSES = {"realtime" : 1, "best-effort" : 2, "idle" : 3}
+BWLIMIT = re.compile(r"^[0-9]+(\.[0-9]+)?[KMGkmg]?$")
+
+
+class Resources:
+
+    # ------------------------------------------------------------------
+    #  Limits from the [resources] section of the configuration file:
+    #  * nice: CPU niceness (0 to 19) of snappy and its children
+    #  * ionice_class / ionice_level: I/O scheduling class and level
+    #  * bwlimit: value of rsync --bwlimit (KB/s or with a K/M/G unit)
+    #  * max_delete_rate: entries deleted per second when pruning a local
+    #    folder. A remote trash is deleted with rm at full speed
+    #  Unset values (None) leave the default behaviour
+    # ------------------------------------------------------------------
+
+    def __init__(self, nice = None, ionice_class = None, ionice_level = None, bwlimit = None, max_delete_rate = None) -> None:
+
+        if (nice is not None) and not (0 <= nice <= 19):
+            raise ValueError(f"Invalid nice level {nice}. It must be between 0 and 19")
+
+        if (ionice_class is not None) and (ionice_class not in IONICE_CLASSES):
+            raise ValueError(f"Invalid ionice class '{ionice_class}'. Choose one of {', '.join(IONICE_CLASSES)}")
+
+        if (ionice_level is not None) and not (0 <= ionice_level <= 7):
+            raise ValueError(f"Invalid ionice level {ionice_level}. It must be between 0 and 7")
+
+        if (bwlimit is not None) and (BWLIMIT.match(bwlimit) is None):
+            raise ValueError(f"Invalid bandwidth limit '{bwlimit}'")
+
+        if (max_delete_rate is not None) and (max_delete_rate <= 0):
+            raise ValueError(f"Invalid deletion rate {max_delete_rate}. It must be positive")
+
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+        self.bwlimit = bwlimit
+        self.max_delete_rate = max_delete_rate
+
+    @classmethod
+    def from_config(cls, config):
+
+        # - raises ValueError if a value is invalid
+
+        def value(key, convert = str):
+            v = config.get("resources", key, fallback = "")
+            v = "" if v is None else v.strip()
+            return convert(v) if v != "" else None
+
+        return cls(
+            nice = value("nice", int),
+            ionice_class = value("ionice_class"),
+            ionice_level = value("ionice_level", int),
+            bwlimit = value("bwlimit"),
+            max_delete_rate = value("max_delete_rate", float),
+        )
+
+    def rsync_args(self) -> list:
+        return [] if self.bwlimit is None else [f"--bwlimit={self.bwlimit}"]
+
+    def apply(self) -> None:
+
+        # - priorities are set on the current process before any thread
+        # - or child is started, so that both inherit them
+
+        if self.nice is not None:
+            _set_nice(self.nice)
+
+        if (self.ionice_class is not None) or (self.ionice_level is not None):
+            _set_ionice(self.ionice_class or "best-effort", self.ionice_level)
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _set_nice(level):
+
+    current = os.getpriority(os.PRIO_PROCESS, 0)
+    if current == level:
+        return None
+
+    try:
+        os.nice(level - current)
+    except PermissionError:
+        logger.warning(f"Cannot lower nice level from {current} to {level} without privileges")
+        return None
+
+    logger.info(f"Running with nice level {level}")
+
+
+def _set_ionice(cls, level):
+
+    # - there is no ioprio_set in the standard library, so the
+    # - util-linux ionice command is used on the current process
+
+    cmd = ["ionice", "-c", str(IONICE_CLASSES[cls])]
+    if (level is not None) and (cls != "idle"):
+        cmd += ["-n", str(level)]
+    cmd += ["-p", str(os.getpid())]
+
+    try:
+        out = subprocess.run(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    except FileNotFoundError:
+        logger.warning("Command ionice cannot be found. I/O priority is not changed")
+        return None
+
+    if out.returncode != 0:
+        msg = out.stderr.decode("utf8", errors = "replace").strip()
+        logger.warning(f"Cannot set I/O priority: {msg}")
+        return None
+
+    logger.info(f"Running with I/O class {cls}" + (f" and level {level}" if (level is not None) and (cls != "idle") else ""))
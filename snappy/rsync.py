@@ -1,13 +1,46 @@
+import os
+import re
+import json
+import codecs
+import shutil
 import logging
-import datetime
+import selectors
 import subprocess
+import collections
 from subprocess import PIPE
 from .cmd import _fs_cmd_args
-from .utils import substitute_tilde
+from .utils import substitute_tilde, write_atomic
+from .destination import is_remote
 
 
 logger = logging.getLogger(__name__)
 
+READ_SIZE = 65536
+MAX_CAPTURED_LINES = 1000
+
+# - rsync accepts at most 20 --link-dest folders
+
+MAX_LINK_DEST = 20
+
+# - rsync versions that added the options snappy can use
+
+INFO_VERSION = (3, 1, 0)
+CHOICE_VERSION = (3, 2, 0)
+OPEN_NOATIME_VERSION = (3, 2, 3)
+
+# - algorithms from fastest to slowest
+
+COMPRESS_ORDER = ["zstd", "lz4", "zlibx", "zlib"]
+CHECKSUM_ORDER = ["xxh128", "xxh3", "xxh64", "md5", "md4"]
+
+PROBE_TIMEOUT = 3
+
+VERSION_LINE = re.compile(r"rsync\s+version\s+v?(?P<version>[0-9][0-9.]*)\S*\s+protocol version (?P<protocol>[0-9]+)")
+
+# - probes of this process, by binary
+
+_probed = {}
+
 
 class NoRsyncError(FileNotFoundError):
     pass
@@ -17,39 +50,326 @@ class RsyncError(RuntimeError):
     pass
 
 
+class RsyncInfo:
+
+    # ---------------------------------------------------------------
+    #  What an rsync binary supports, from `rsync --version`: version,
+    #  protocol, compression and checksum algorithms. The lists are
+    #  empty for versions before 3.2.0, which have no choice options
+    # ---------------------------------------------------------------
+
+    def __init__(self, path, version = None, protocol = None, compress = None, checksum = None) -> None:
+
+        self.path = path
+        self.version = version
+        self.protocol = protocol
+        self.compress = compress or []
+        self.checksum = checksum or []
+
+    @classmethod
+    def parse(cls, path, text):
+
+        info = cls(path)
+        m = VERSION_LINE.search(text)
+        if m is not None:
+            info.version = tuple(int(v) for v in m.group("version").strip(".").split("."))
+            info.protocol = int(m.group("protocol"))
+
+        # - lists are indented under their title, e.g. "Compress list:"
+
+        section = None
+        for line in text.split("\n"):
+            if not line.startswith((" ", "\t")):
+                section = line.strip().rstrip(":").lower()
+                continue
+
+            words = [w for w in line.split() if not w.startswith("(")]
+            if section == "compress list":
+                info.compress += words
+            elif section == "checksum list":
+                info.checksum += words
+
+        return info
+
+    @classmethod
+    def from_dict(cls, data):
+        version = tuple(data["version"]) if data.get("version") is not None else None
+        return cls(data["path"], version, data.get("protocol"), data.get("compress"), data.get("checksum"))
+
+    def to_dict(self) -> dict:
+        return {
+            "path" : self.path,
+            "version" : list(self.version) if self.version is not None else None,
+            "protocol" : self.protocol,
+            "compress" : self.compress,
+            "checksum" : self.checksum,
+        }
+
+    def at_least(self, version) -> bool:
+        return (self.version is not None) and (self.version >= version)
+
+    @property
+    def progress2(self) -> bool:
+        return self.at_least(INFO_VERSION)
+
+    @property
+    def open_noatime(self) -> bool:
+        return self.at_least(OPEN_NOATIME_VERSION)
+
+    def best_compress(self):
+        return next((c for c in COMPRESS_ORDER if c in self.compress), None)
+
+    def best_checksum(self):
+        return next((c for c in CHECKSUM_ORDER if c in self.checksum), None)
+
+
+def probe(cache_dir = None):
+
+    # -----------------------------------------------------------------
+    #  RsyncInfo of the rsync in PATH, None if there is none. rsync is
+    #  only run for a binary not seen before: the result is kept by
+    #  path, mtime and size in memory and in the snappy cache folder.
+    #  If `rsync --version` fails, nothing is known about the binary
+    #  and options are used as they are
+    # -----------------------------------------------------------------
+
+    path = shutil.which("rsync")
+    if path is None:
+        return None
+
+    path = os.path.realpath(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    key = (path, st.st_mtime_ns, st.st_size)
+    info = _probed.get(key)
+    if info is not None:
+        return info
+
+    file = _probe_file(cache_dir)
+    info = _load_probe(file, key)
+    if info is None:
+        try:
+            out = subprocess.run([path, "--version"], capture_output = True, text = True, errors = "replace", timeout = PROBE_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as err:
+            out = subprocess.CompletedProcess(path, -1, "", str(err))
+
+        if out.returncode == 0:
+            info = RsyncInfo.parse(path, out.stdout)
+            _save_probe(file, key, info)
+        else:
+            logger.warning(f"Cannot get the version of {path}: {out.stderr.strip()}")
+            info = RsyncInfo(path)
+
+    _probed[key] = info
+    return info
+
+
 def is_rsync_installed() -> bool:
-    cmd = ["which", "rsync"]
-    out = subprocess.run(cmd, capture_output = True)
-    return (out.returncode == 0)
+    return shutil.which("rsync") is not None
 
 
-def rsync(src, dst, options = None):
+def select_options(options, info = None, remote = False) -> list:
 
-    args = _fs_cmd_args(src, dst, options)
-    default = "-av"
+    # ---------------------------------------------------------------
+    #  Options for the probed rsync: newer options are left out of
+    #  older versions, where --compress still uses zlib. A choice the
+    #  local rsync does not support is replaced by the fastest one it
+    #  does, or by auto for a remote transfer, whose rsync negotiates
+    #  it. auto is kept as it is. Root reads local sources with
+    #  --open-noatime, which fails for files of other users otherwise.
+    #  It is not added for a remote rsync, which might not know it
+    # ---------------------------------------------------------------
+
+    if (info is None) or (info.version is None):
+        return list(options)
 
-    opt = [default] + args.options
-    cmd = ["rsync"] + opt + [args.src, args.dst]
-    logger.debug(f"Running command {cmd}")
+    choices = {
+        "--compress-choice" : (info.compress, info.best_compress),
+        "--checksum-choice" : (info.checksum, info.best_checksum),
+    }
 
-    out = subprocess.Popen(cmd, stdout = PIPE, stderr = PIPE, encoding = "utf8")
-    now = datetime.datetime.now()
-    while True:
+    out = []
+    for opt in options:
+        name, _, value = opt.partition("=")
+        if name in choices:
+            supported, best = choices[name]
+            if not supported:
+                continue
+            if (value != "auto") and (value not in supported):
+                value = "auto" if remote else best()
+        elif (name == "--open-noatime") and not info.open_noatime:
+            continue
+        elif (name == "--info") and not info.at_least(INFO_VERSION):
+            continue
 
-        elapsed = datetime.datetime.now() - now
-        s = out.stdout.readline()
-        
-        if s.endswith("\n"):
-            s = s[:-1]
+        out.append(f"{name}={value}" if value else opt)
 
-        if s != "":
-            logger.info(s)
-        
-        if (out.poll() is not None) and (elapsed.seconds > 1) and (s == ""):
-            break
+    if info.open_noatime and (not remote) and (os.geteuid() == 0) and ("--open-noatime" not in out):
+        out.append("--open-noatime")
 
     return out
 
 
+def rsync(src, dst, options = None, log = None, on_line = None, pressure = None):
+
+    # - pressure is a PressureWatch that pauses rsync while the system
+    # - is under pressure. rsync then runs in its own process group.
+    # - Transfers to a remote host are not paused, see _pausable
+
+    if log is None:
+        log = logger
+
+    args = _fs_cmd_args(src, dst, options)
+    if is_remote(dst):
+        args.dst = dst
+
+    pressure = _pausable(pressure, dst, log)
+
+    default = "-av"
+
+    info = probe()
+    opt = [default] + select_options(args.options, info, is_remote(dst))
+    cmd = [info.path if info is not None else "rsync"] + opt + [args.src, args.dst]
+    log.debug(f"Running command {cmd}")
+
+    proc = subprocess.Popen(cmd, stdout = PIPE, stderr = PIPE, start_new_session = pressure is not None)
+    if pressure is not None:
+        pressure.attach(proc, log)
+
+    try:
+        stdout, stderr = _pump(proc, log, on_line = on_line)
+    finally:
+        if pressure is not None:
+            pressure.detach()
+
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
 def exclude_from_rsync(src):
     return [f"--exclude={substitute_tilde(s)}" for s in src]
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _pausable(pressure, dst, log = None):
+
+    # - stopping the process group of a remote transfer stops its ssh
+    # - client as well, so the server can drop the stalled session.
+    # - Such transfers only wait for the pressure before they start
+
+    if (pressure is not None) and is_remote(dst):
+        (log or logger).debug(f"rsync to {dst} is not paused under pressure")
+        return None
+
+    return pressure
+
+
+def _probe_file(cache_dir = None):
+
+    # - config imports this module
+
+    from .config import cache_loc
+    return os.path.join(cache_loc() if cache_dir is None else cache_dir, "rsync.json")
+
+
+def _load_probe(file, key):
+
+    try:
+        with open(file, "r", encoding = "utf8") as f:
+            data = json.load(f)
+        if data.get("key") != list(key):
+            return None
+        return RsyncInfo.from_dict(data["info"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _save_probe(file, key, info) -> None:
+
+    data = {"key" : list(key), "info" : info.to_dict()}
+    try:
+        write_atomic(file, json.dumps(data, indent = 1))
+    except OSError as err:
+        logger.warning(f"Cannot save rsync capabilities to {file}: {err}")
+
+
+class _OutputBuffer:
+
+    # - decodes a byte stream into lines, hands every line to a
+    # - callback and keeps only the last `max_lines` of them
+
+    def __init__(self, max_lines, callback) -> None:
+
+        self.lines = collections.deque(maxlen = max_lines)
+        self.callback = callback
+        self._decoder = codecs.getincrementaldecoder("utf8")(errors = "replace")
+        self._partial = ""
+
+    def feed(self, data: bytes, final = False) -> None:
+
+        text = self._partial + self._decoder.decode(data, final)
+        lines = text.split("\n")
+        self._partial = "" if final else lines.pop()
+
+        for line in lines:
+            line = line.rstrip("\r")
+            if line != "":
+                self.lines.append(line)
+                self.callback(line)
+
+    def close(self) -> None:
+        self.feed(b"", final = True)
+
+    def text(self) -> str:
+        return "".join(f"{line}\n" for line in self.lines)
+
+
+def _pump(proc: subprocess.Popen, log, max_lines = MAX_CAPTURED_LINES, on_line = None):
+
+    # - multiplex stdout and stderr so that neither pipe can fill up
+    # - and block the child. stdout lines are logged as they arrive
+    # - and only the tail of each stream is kept in memory
+
+    def stdout_line(line):
+        log.info(line)
+        if on_line is not None:
+            on_line(line)
+
+    buffers = {
+        proc.stdout: _OutputBuffer(max_lines, stdout_line),
+        proc.stderr: _OutputBuffer(max_lines, log.debug),
+    }
+
+    sel = selectors.DefaultSelector()
+    try:
+        for f in buffers:
+            sel.register(f, selectors.EVENT_READ)
+
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, READ_SIZE)
+                if data:
+                    buffers[key.fileobj].feed(data)
+                else:
+                    sel.unregister(key.fileobj)
+                    buffers[key.fileobj].close()
+
+        proc.wait()
+
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+
+    finally:
+        sel.close()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    return buffers[proc.stdout].text(), buffers[proc.stderr].text()
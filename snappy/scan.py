@@ -0,0 +1,379 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .config import cache_loc
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+SCAN_WORKERS = 8
+RACY_SECONDS = 2
+
+# - an index is saved whenever its source is scanned. One that was not
+# - for this long, e.g. of a removed or temporary source, is removed
+
+INDEX_MAX_AGE = 30 * 24 * 3600
+
+# - indexes kept in memory by a long-running process, see keep_in_memory
+
+_memory = None
+
+
+class ExcludeMatcher:
+
+    # ---------------------------------------------------------
+    #  Subset of rsync's exclude pattern rules:
+    #  * a leading / anchors the pattern to the transfer root
+    #  * a trailing / only matches directories
+    #  * patterns without / are matched against the file name,
+    #    otherwise against the end of the path
+    #  * `*` and `?` stop at /, `**` matches anything
+    # ---------------------------------------------------------
+
+    def __init__(self, patterns = None) -> None:
+
+        self.patterns = []
+        for p in (patterns or []):
+            p = p.strip()
+            if p != "":
+                self.patterns.append(_compile_pattern(p))
+
+    def __bool__(self) -> bool:
+        return len(self.patterns) > 0
+
+    def match(self, path: str, is_dir: bool) -> bool:
+
+        # - path is relative to the transfer root and starts with /
+
+        for regex, dir_only in self.patterns:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(path):
+                return True
+
+        return False
+
+
+def transfer_root(src: str) -> str:
+
+    # - rsync copies the folder itself unless the source ends with /,
+    # - in which case only its contents are copied
+
+    if src.endswith(os.path.sep):
+        return ""
+
+    return os.path.sep + os.path.basename(src)
+
+
+def iter_non_readable(src, exclude = None, max_workers = SCAN_WORKERS):
+
+    # --------------------------------------------------------------
+    #  Yield the paths (relative to src and starting with /) of the
+    #  files and folders under src that the current user cannot read.
+    #  Folders are walked by a thread pool and excluded subtrees are
+    #  never entered. A non-readable file source yields ""
+    # --------------------------------------------------------------
+
+    src = os.path.abspath(os.path.expanduser(src)) + (os.path.sep if src.endswith(os.path.sep) else "")
+    base = src.rstrip(os.path.sep) or os.path.sep
+    root = transfer_root(src)
+    matcher = exclude if isinstance(exclude, ExcludeMatcher) else ExcludeMatcher(exclude)
+
+    if not os.path.isdir(base):
+        if os.path.isfile(base) and not os.access(base, os.R_OK):
+            yield ""
+        return None
+
+    if not _readable_dir(base):
+        logger.warning(f"Cannot read folder {base}")
+        return None
+
+    def visit(path, rel):
+        return _scan_dir(path, rel, root, matcher)
+
+    yield from _walk(base, visit, max_workers)
+
+
+class NonReadableIndex:
+
+    # ------------------------------------------------------------------
+    #  Persistent cache of the non-readable scan of one source. Each
+    #  folder is stored with its mtime and inode together with the
+    #  non-readable entries and sub folders found in it, so that only
+    #  folders whose mtime changed are listed again on the next scan.
+    #
+    #  Changing the permissions of a file does not touch the mtime of
+    #  its folder, so files that *become* non-readable are only found
+    #  once their folder changes or when a full rescan is requested,
+    #  which snappy snap does when rsync cannot read a file. Cached
+    #  entries are always checked again, so files that become readable
+    #  are picked up right away.
+    # ------------------------------------------------------------------
+
+    version = 1
+
+    def __init__(self, src, exclude = None, cache_dir = None) -> None:
+
+        self.src = os.path.abspath(os.path.expanduser(src)) + (os.path.sep if src.endswith(os.path.sep) else "")
+        self.exclude = [e for e in (exclude or []) if e.strip() != ""]
+
+        if cache_dir is None:
+            cache_dir = os.path.join(cache_loc(), "scan")
+
+        key = "\n".join([self.src] + self.exclude)
+        key = hashlib.sha1(key.encode("utf8")).hexdigest()
+        self.path = os.path.join(cache_dir, f"{key}.json")
+
+        self.reused = 0
+        self.scanned = 0
+
+    def scan(self, rescan = False, max_workers = SCAN_WORKERS) -> list:
+
+        base = self.src.rstrip(os.path.sep) or os.path.sep
+        if not os.path.isdir(base):
+            return list(iter_non_readable(self.src, self.exclude, max_workers))
+
+        old = {} if rescan else self._load()
+        new = {}
+        root = transfer_root(self.src)
+        matcher = ExcludeMatcher(self.exclude)
+        started = time.time()
+
+        def visit(path, rel):
+
+            try:
+                st = os.stat(path)
+            except OSError as err:
+                logger.warning(f"Cannot scan folder {path}: {err}")
+                return [], []
+
+            cached = old.get(rel)
+            if (cached is not None) and (cached[0] == st.st_mtime_ns) and (cached[1] == st.st_ino):
+                if not any(_readable(os.path.join(path, name)) for name in cached[2]):
+                    self.reused += 1
+                    new[rel] = cached
+                    bad = [rel + os.path.sep + name for name in cached[2]]
+                    subdirs = [rel + os.path.sep + name for name in cached[3]]
+                    return bad, subdirs
+
+            self.scanned += 1
+            bad, subdirs = _scan_dir(path, rel, root, matcher)
+
+            # - a folder modified while we scan it might change again within
+            # - the same mtime tick, so it is not trusted on the next run
+
+            mtime = st.st_mtime_ns
+            if (started - st.st_mtime) < RACY_SECONDS:
+                mtime = -1
+
+            names = [os.path.basename(b) for b in bad]
+            folders = [os.path.basename(d) for d in subdirs]
+            new[rel] = [mtime, st.st_ino, names, folders]
+            return bad, subdirs
+
+        if not _readable_dir(base):
+            logger.warning(f"Cannot read folder {base}")
+            return []
+
+        files = list(_walk(base, visit, max_workers))
+        self._save(new)
+
+        logger.debug(f"Non-readable index of {self.src}: {self.reused} folders reused, {self.scanned} scanned")
+        return files
+
+    def _load(self) -> dict:
+
+        data = _memory.get(self.path) if _memory is not None else None
+        try:
+            if data is None:
+                with open(self.path, "r", encoding = "utf8") as f:
+                    data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            logger.warning(f"Ignoring unreadable scan index {self.path}: {err}")
+            return {}
+
+        if (data.get("version") != self.version) or (data.get("src") != self.src) or (data.get("exclude") != self.exclude):
+            return {}
+
+        return data.get("folders", {})
+
+    def _save(self, folders) -> None:
+
+        data = {
+            "version" : self.version,
+            "src" : self.src,
+            "exclude" : self.exclude,
+            "folders" : folders,
+        }
+
+        if _memory is not None:
+            _memory[self.path] = data
+
+        try:
+            ut.write_atomic(self.path, json.dumps(data, separators = (",", ":")))
+        except OSError as err:
+            logger.warning(f"Cannot save scan index {self.path}: {err}")
+
+
+def remove_old_indexes(cache_dir = None, max_age = INDEX_MAX_AGE) -> int:
+
+    # - files of the index folder older than max_age seconds. Returns
+    # - the number of files removed
+
+    cache_dir = os.path.join(cache_loc(), "scan") if cache_dir is None else cache_dir
+    oldest = time.time() - max_age
+    removed = 0
+
+    try:
+        with os.scandir(cache_dir) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        return 0
+
+    for entry in entries:
+        try:
+            if not (entry.is_file(follow_symlinks = False) and (entry.stat(follow_symlinks = False).st_mtime < oldest)):
+                continue
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            continue
+
+        removed += 1
+        if _memory is not None:
+            _memory.pop(entry.path, None)
+
+    if removed:
+        logger.debug(f"Removed {removed} unused scan indexes from {cache_dir}")
+
+    return removed
+
+
+def keep_in_memory() -> None:
+
+    # - indexes are then saved in memory as well and not read again.
+    # - An index written meanwhile by another process is older than
+    # - the one in memory, and both are checked against the folders
+
+    global _memory
+    if _memory is None:
+        _memory = {}
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _compile_pattern(pattern):
+
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = pattern.startswith("/")
+    pattern = pattern.lstrip("/")
+
+    regex = ""
+    idx = 0
+    while idx < len(pattern):
+        c = pattern[idx]
+        if pattern.startswith("**", idx):
+            regex += ".*"
+            idx += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", idx + 1)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                chars = pattern[idx + 1:end].replace("\\", "\\\\")
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += "[" + chars + "]"
+                idx = end
+        else:
+            regex += re.escape(c)
+        idx += 1
+
+    if anchored:
+        regex = "^/" + regex + "$"
+    else:
+        regex = "(^|/)" + regex + "$"
+
+    return re.compile(regex), dir_only
+
+
+def _readable_dir(path):
+    return os.access(path, os.R_OK | os.X_OK)
+
+
+def _readable(path):
+    if os.path.isdir(path):
+        return _readable_dir(path)
+    return os.access(path, os.R_OK)
+
+
+def _walk(base, visit, max_workers):
+
+    # - visit(path, rel) lists one folder and returns the non-readable
+    # - entries and the sub folders to walk next, all relative to base
+
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+
+        pending = {pool.submit(visit, base, "")}
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for fut in done:
+                bad, subdirs = fut.result()
+                for rel in subdirs:
+                    path = base.rstrip(os.path.sep) + rel
+                    pending.add(pool.submit(visit, path, rel))
+
+                yield from bad
+
+
+def _scan_dir(path, rel, root, matcher):
+
+    bad = []
+    subdirs = []
+    access = os.access
+    sep = os.path.sep
+
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError as err:
+        logger.warning(f"Cannot scan folder {path}: {err}")
+        return bad, subdirs
+
+    for entry in entries:
+
+        try:
+            is_dir = entry.is_dir(follow_symlinks = False)
+            if (not is_dir) and (not entry.is_file(follow_symlinks = False)):
+                continue
+        except OSError:
+            continue
+
+        entry_rel = rel + sep + entry.name
+        if matcher and matcher.match(root + entry_rel, is_dir):
+            continue
+
+        if is_dir:
+            if access(entry.path, os.R_OK | os.X_OK):
+                subdirs.append(entry_rel)
+            else:
+                bad.append(entry_rel)
+        elif not access(entry.path, os.R_OK):
+            bad.append(entry_rel)
+
+    return bad, subdirs
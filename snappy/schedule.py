@@ -0,0 +1,121 @@
+import datetime
+
+
+# - name, lowest and highest value of the fields of a cron expression
+
+FIELDS = [
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 6),
+]
+
+ALIASES = {
+    "@hourly" : "0 * * * *",
+    "@daily" : "0 0 * * *",
+    "@midnight" : "0 0 * * *",
+    "@weekly" : "0 0 * * 0",
+    "@monthly" : "0 0 1 * *",
+    "@yearly" : "0 0 1 1 *",
+    "@annually" : "0 0 1 1 *",
+}
+
+# - next() gives up after this many years without a match, e.g. for
+# - the 31st of February
+
+MAX_YEARS = 5
+
+
+class Cron:
+
+    # -------------------------------------------------------------------
+    #  A cron expression: minute, hour, day of month, month and day of
+    #  week, where Sunday is 0 or 7. Each field is *, a value, a range
+    #  a-b or a list of them, optionally with a /step. As in cron, a day
+    #  matches either restricted day field when both are restricted. A
+    #  field starting with *, such as */2, is not restricted, as in
+    #  vixie cron. Raises ValueError for an invalid expression
+    # -------------------------------------------------------------------
+
+    def __init__(self, expr: str) -> None:
+
+        self.expr = expr.strip()
+        fields = ALIASES.get(self.expr, self.expr).split()
+        if len(fields) != len(FIELDS):
+            raise ValueError(f"Invalid cron expression '{expr}'. It must have {len(FIELDS)} fields")
+
+        values = []
+        for text, (name, low, high) in zip(fields, FIELDS):
+            high = 7 if name == "weekday" else high
+            values.append(_parse_field(text, name, low, high))
+
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        self.weekdays = {d % 7 for d in weekdays}
+        self._any_day = fields[2].startswith("*")
+        self._any_weekday = fields[4].startswith("*")
+
+    def __str__(self) -> str:
+        return self.expr
+
+    def matches(self, dt: datetime.datetime) -> bool:
+        return (dt.minute in self.minutes) and (dt.hour in self.hours) and (dt.month in self.months) and self._day_matches(dt)
+
+    def next(self, after: datetime.datetime) -> datetime.datetime:
+
+        # - first matching minute after `after`
+
+        dt = after.replace(second = 0, microsecond = 0) + datetime.timedelta(minutes = 1)
+        limit = dt.replace(year = dt.year + MAX_YEARS, day = 1)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day = 1, hour = 0, minute = 0) + datetime.timedelta(days = 32)).replace(day = 1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour = 0, minute = 0) + datetime.timedelta(days = 1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute = 0) + datetime.timedelta(hours = 1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes = 1)
+            else:
+                return dt
+
+        return None
+
+    def _day_matches(self, dt) -> bool:
+
+        day = dt.day in self.days
+        weekday = ((dt.weekday() + 1) % 7) in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _parse_field(text, name, low, high) -> set:
+
+    values = set()
+    for part in text.split(","):
+        rng, _, step = part.partition("/")
+        try:
+            step = int(step) if step else 1
+            if rng == "*":
+                start, end = low, high
+            elif "-" in rng:
+                start, end = (int(v) for v in rng.split("-", 1))
+            else:
+                start = int(rng)
+                end = high if step > 1 else start
+        except ValueError:
+            raise ValueError(f"Invalid {name} '{part}' in cron expression") from None
+
+        if (step < 1) or not (low <= start <= end <= high):
+            raise ValueError(f"Invalid {name} '{part}' in cron expression. Values go from {low} to {high}")
+
+        values.update(range(start, end + 1, step))
+
+    return values
@@ -1,182 +1,995 @@
 import os
 import re
-import datetime
+import stat
+import time
 import shutil
-import hashlib
+import datetime
+import socket
 import logging
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
 from .rsync import (
+    logger as rsync_logger,
     NoRsyncError,
     RsyncError,
     is_rsync_installed,
     rsync,
     exclude_from_rsync,
+    MAX_LINK_DEST,
 )
 
-from .cmd import mv, find_non_readable
+from .prune import (
+    PRUNE_MODES,
+    PRUNE_WORKERS,
+    PruneStats,
+    reap,
+    reap_in_background,
+)
+from .catalog import Catalog, SNAPSHOT_FORMAT, TMP_PATTERN, is_running, tmp_name, now as catalog_now
+from .destination import get_destination, is_remote
+from .fingerprint import FastPath, link_tree, snapshot_stats
+from .journal import JournalPath, TREE
+from .stats import TransferStats, SnapshotResult
+from .spans import span
+from . import scan
 from . import utils as ut
 
 
 logger = logging.getLogger(__name__)
 
+# - rsync exit code of a partial transfer, e.g. unreadable files
+
+RSYNC_PARTIAL = 23
+
 
 def get_backup_folders(path: os.PathLike) -> list:
 
-    path = os.path.abspath(path)
-    folders = os.listdir(path)
-    folders = (os.path.join(path, f) for f in folders)
-    folders = [f for f in folders if os.path.isdir(f)]
-    folders.sort()
-    return folders
+    # - complete snapshots from oldest to newest, as recorded in the
+    # - catalog or, if there is none, as found on disk. path can also
+    # - be a remote [user@]host:/path or a destination
+
+    dest = get_destination(path)
+    catalog = Catalog.load(dest.path, dest)
+    return [dest.join(e["name"]) for e in catalog.snapshots()]
 
 
-def create_snapshot(sources: list, destination: os.PathLike, rsync_args = None) -> None:
+def create_snapshot(sources: list, destination: os.PathLike, rsync_args = None, max_workers = 1, rescan = False, pressure = None, batch = False, fast_path = None, journal = None) -> list:
 
     # ------------------------------------------------
     #  Create a backup of each source to destination
-    #  Destination will contain each source
+    #  Destination will contain each source. With a
+    #  PressureGate, sources wait and rsync is paused
+    #  while the system is under pressure. In batch
+    #  mode all sources are sent by a single rsync.
+    #  With a FastPath, unchanged sources are linked
+    #  from the previous snapshot without rsync. With
+    #  a JournalPath, rsync only sends the paths that
+    #  changed since then and links the rest
     # ------------------------------------------------
 
     if rsync_args is None:
         rsync_args = []
 
-    dst = ut.normalize_path(destination)
+    # - remote destinations are left as they are for rsync
+
+    dst = destination if is_remote(destination) else ut.normalize_path(destination)
     if dst[-1] != os.path.sep:
         dst += os.path.sep
-    
-    for src in sources:
 
-        src = ut.normalize_path(src)
-        ftype = "folder" if os.path.isdir(src) else "file"
-        logger.info(f"Backing up {ftype} {src}")
+    sources = _check_sources(sources)
+    linked = []
+    if fast_path is not None:
+        sources, linked = _link_unchanged(sources, dst, fast_path)
+        if not sources:
+            return linked
 
-        if not os.path.exists(src):
-            logger.error(f"{ftype.capitalize()} {src} cannot be found")
-            logger.error("Stopping snapshot")
-            raise FileNotFoundError(f"Location {src} cannot be found. Stopping snapshot creation.")
-        
-        try:
-            non_readable = _list_non_readable_files(src)
-            for idx, nr in enumerate(non_readable):
-                nr = re.sub(f"^{src}", "", nr)
-                if not nr.startswith(os.path.sep):
-                    nr = os.path.sep + nr
+    if journal is not None:
+        sources, synced = _sync_changed(sources, dst, rsync_args, journal)
+        linked += synced
+        if not sources:
+            return linked
 
-                non_readable[idx] = nr
-        except Exception as err:
-            logger.error(f"There was an error when trying to find non-readable files in {src}")
-            _log_error(str(err))
-            raise RsyncError(str(err)) from err
+    if batch and (len(sources) > 1):
+        return linked + [_snapshot_batch(sources, dst, rsync_args, rescan, pressure)]
+
+    if (max_workers <= 1) or (len(sources) <= 1):
+        return linked + [_snapshot_source(src, dst, rsync_args, rescan = rescan, pressure = pressure) for src in sources]
+
+    # - run sources concurrently, each one logging with its own prefix
+
+    max_workers = min(max_workers, len(sources))
+    logger.info(f"Backing up {len(sources)} sources with {max_workers} workers")
+
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+
+        futures = {}
+        for src in sources:
+            fut = pool.submit(_snapshot_source, src, dst, rsync_args, _source_name(src), rescan, pressure)
+            futures[fut] = src
 
         try:
-            logger.info("Showing rsync logs:")
-            logger.info("-------------------")
-            rsync_excl = exclude_from_rsync(non_readable)
-            for rse in non_readable:
-                logger.warning(f"This file will be excluded from the backup: {rse}")
+            done, pending = wait(futures, return_when = FIRST_EXCEPTION)
+        except KeyboardInterrupt:
+            for f in futures:
+                f.cancel()
+            raise
 
-            output = rsync(src, dst, rsync_args + ["-av", "--delete"] + rsync_excl)
-        except Exception as err:
+        failed = [f for f in done if f.exception() is not None]
+
+        if failed:
+
+            # - do not start new sources, but let the running ones finish
+            # - so that the temporary folder can be safely removed
+
+            for f in pending:
+                f.cancel()
+
+            wait(pending)
+            failed = [f for f in futures if (not f.cancelled()) and (f.exception() is not None)]
+            for f in failed:
+                logger.error(f"Snapshot of {futures[f]} failed")
+
+            raise failed[0].exception()
+
+    return linked + [fut.result() for fut in futures]
+
+
+def snap_backup(
+    sources: list,
+    backup_folder: os.PathLike,
+    max_backups = 3,
+    rsync_args = None,
+    max_workers = 1,
+    rescan = False,
+    prune_mode = "inline",
+    prune_workers = PRUNE_WORKERS,
+    prune_max_rate = None,
+    pressure = None,
+    batch = False,
+    link_dest = 1,
+    fast_path = False,
+    journal = False,
+) -> SnapshotResult:
+
+    # -------------------------------------------------------------
+    #  backup_folder is a local path, a remote [user@]host:/path or
+    #  a destination (see destination.get_destination). A remote
+    #  connection is closed when the backup ends. Unchanged files
+    #  are hard linked from up to link_dest previous snapshots, and
+    #  with fast_path unchanged sources skip rsync altogether. With
+    #  journal, sources watched by `snappy watch` only send the
+    #  paths that changed since the previous snapshot
+    # -------------------------------------------------------------
 
-            error_msg = _log_rsync_error(output)
-            raise RsyncError(error_msg) from err
+    if rsync_args is None:
+        rsync_args = []
+
+    _check_link_dest(link_dest)
+
+    start = datetime.datetime.now()
+    dry_run = "--dry-run" in rsync_args
+
+    with get_destination(backup_folder) as dest:
 
-        if (output.returncode != 0):
-            
-            error_msg = _log_rsync_error(output)
-            logger.error(f"Error code: {output.returncode}")
-            raise RsyncError(error_msg)
+        dest, new, tmp, rsync_args, fast, changes = _begin_backup(dest, sources, rsync_args, dry_run, link_dest, fast_path, journal)
+        try:
+            logger.info("Creating backup snapshot...")
+            with span("snapshot"):
+                stats = create_snapshot(sources, dest.target(tmp), rsync_args, max_workers = max_workers, rescan = rescan, pressure = pressure, batch = batch, fast_path = fast, journal = changes)
         
-        msg = f"{ftype.capitalize()} {src} backed up!"
-        logger.info(msg)
-        logger.info("-" * len(msg))
+        except BaseException as err:
 
+            # - if there is an error we rollback then raise. An interrupt,
+            # - e.g. Ctrl-C or a stopping daemon, is raised as it is
+
+            _rollback(dest, tmp, new)
+            if not isinstance(err, Exception):
+                raise
+            raise RuntimeError from err
+
+        return _end_backup(dest, new, tmp, start, stats, rsync_args, max_backups, prune_mode, prune_workers, prune_max_rate, fast, changes)
+
+
+def clean_backups(path: os.PathLike, n: int, mode = "inline", workers = PRUNE_WORKERS, max_rate = None) -> PruneStats:
+
+    # --------------------------------------------------------------
+    #  Old backups are moved to the trash folder at once and deleted
+    #  according to mode, at most max_rate entries per second:
+    #  * inline: now, with `workers` threads
+    #  * background: by a `snappy prune` process started here
+    #  * deferred: by the next `snappy prune`
+    #  Statistics are only returned for inline deletion of a local
+    #  folder. Remote trash folders are deleted with rm. Temporary
+    #  folders of snapshots that are no longer running go as well
+    # --------------------------------------------------------------
+
+    if mode not in PRUNE_MODES:
+        raise ValueError(f"Invalid prune mode '{mode}'. Choose one of {', '.join(PRUNE_MODES)}")
+
+    dest = get_destination(path)
+    catalog = Catalog.load(dest.path, dest)
+    stale = _trash_stale(dest, catalog)
+
+    backups = [e["name"] for e in catalog.snapshots()]
+    backups.reverse()
+    old = backups[n:] if n > 0 else []
+    if not old:
+        logger.info("No old backups to remove")
+
+    for bk in old:
+        logger.info(f"Removing backup {bk}")
+        try:
+            dest.move_to_trash(dest.join(bk))
+        except FileNotFoundError:
+            logger.warning(f"Backup {bk} is in the catalog but not on disk")
+        catalog.remove(bk)
+
+    catalog.trim_failed()
+    _save_catalog(catalog)
+    if not (old or stale):
+        return None
+
+    if mode == "deferred":
+        logger.info("Old backups will be deleted by `snappy prune`")
+        return None
+
+    # - the new snapshot is complete by now, so a backup that cannot
+    # - be deleted is left in the trash for the next `snappy prune`
+
+    try:
+        if dest.remote:
+            dest.reap(background = mode == "background", max_rate = max_rate)
+        elif mode == "inline":
+            return reap(dest.path, workers, max_rate)
+        else:
+            reap_in_background(dest.path, workers, max_rate)
+    except OSError as err:
+        logger.warning(f"Cannot delete old backups: {err}. They are left in the trash for `snappy prune`")
+
+
+def trash_stale(path: os.PathLike) -> int:
+
+    # - same as in clean_backups, for `snappy prune`
+
+    dest = get_destination(path)
+    catalog = Catalog.load(dest.path, dest)
+    stale = _trash_stale(dest, catalog)
+    if stale:
+        _save_catalog(catalog)
+
+    return stale
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _trash_stale(dest, catalog) -> int:
+
+    # ---------------------------------------------------------------
+    #  Temporary folders left by snapshots that crashed or were killed
+    #  are moved to the trash. Their running entries are marked failed
+    #  and incomplete ones, found when the catalog was rebuilt, are
+    #  removed. Returns the number of folders moved
+    # ---------------------------------------------------------------
+
+    live = set()
+    for e in catalog.snapshots("running"):
+        if is_running(e):
+            live.add(tmp_name(e["name"]))
+        else:
+            logger.warning(f"Snapshot {e['name']} is marked as running but its process is gone")
+            catalog.update(e["name"], status = "failed", end = e["end"] or catalog_now())
+
+    for e in catalog.snapshots("incomplete"):
+        catalog.remove(e["name"])
+
+    moved = 0
+    for name in sorted(dest.folders(dest.path)):
+        if TMP_PATTERN.match(name) and (name not in live):
+            logger.info(f"Removing incomplete snapshot {name}")
+            try:
+                dest.move_to_trash(dest.join(name))
+            except FileNotFoundError:
+                continue
+            moved += 1
+
+    return moved
+
+
+class _SourceLogger(logging.LoggerAdapter):
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['source']}] {msg}", kwargs
+
+
+def _source_name(src):
+    return os.path.basename(src.rstrip(os.path.sep)) or src
+
+
+def _start_backup(backup_folder, sources = None, dry_run = False):
+
+    # - backup_folder as in snap_backup. The returned destination is
+    # - used for every later operation on the backup folder
 
-def snap_backup(sources: list, backup_folder: os.PathLike, max_backups = 3, rsync_args = None) -> str:
-    
     # - If rsync is not installed, abort
 
-    if not is_rsync_installed():
+    with span("check_rsync"):
+        installed = is_rsync_installed()
+
+    if not installed:
         logger.error("Command rsync cannot be found")
         logger.error("Aborting backup")
         raise NoRsyncError("Cannot find rsync in system's PATH")
     
     # - get existing backups and create new backup name
 
-    backup_folder = ut.normalize_path(backup_folder)
-    if not os.path.exists(backup_folder):
-        logger.info(f"Destination folder {backup_folder} not found")
-        logger.info(f"Creating folder {backup_folder}")
-        os.makedirs(backup_folder)
+    dest = get_destination(backup_folder)
+    if not dest.exists(dest.path):
+        logger.info(f"Destination folder {dest} not found")
+        logger.info(f"Creating folder {dest}")
+        dest.makedirs(dest.path)
     
-    backups = get_backup_folders(backup_folder)
+    with span("catalog"):
+        catalog = Catalog.load(dest.path, dest)
+
+    backups = [dest.join(e["name"]) for e in catalog.snapshots()]
+    while backups and not dest.isdir(backups[-1]):
+        logger.warning(f"Backup {backups[-1]} is in the catalog but not on disk")
+        catalog.remove(os.path.basename(backups.pop()))
+
     now = datetime.datetime.now()
-    new = now.strftime("%Y-%m-%d-%H_%M_%S")
+    new = now.strftime(SNAPSHOT_FORMAT)
+
+    if not dry_run:
+        sources = [ut.normalize_path(s) for s in (sources or [])]
+        catalog.update(new, status = "running", start = now.isoformat(timespec = "seconds"), sources = sources, pid = os.getpid(), host = socket.gethostname())
+        _save_catalog(catalog)
 
     # - copy previous backup into tmp
 
-    tmp = hashlib.md5(new.encode("utf8")).hexdigest()
-    tmp = os.path.join(backup_folder, tmp)
+    tmp = dest.join(tmp_name(new))
     logger.info(f"Creating temporay folder {tmp}")
-    os.makedirs(tmp)
+    dest.makedirs(tmp)
 
-    if rsync_args is None:
-        rsync_args = []
+    return dest, backups, new, tmp
+
+
+def _begin_backup(dest, sources, rsync_args, dry_run = False, link_dest = 1, fast_path = False, journal = False):
 
+    # - steps of snap_backup before the first rsync. Returns the
+    # - destination, snapshot name, temporary folder, rsync options,
+    # - FastPath and JournalPath. The backup is rolled back if a step
+    # - after _start_backup fails
+
+    dest, backups, new, tmp = _start_backup(dest, sources, dry_run)
     try:
+        rsync_args = rsync_args + dest.rsync_args()
+        fast = _fast_path(dest, backups, rsync_args, dry_run) if fast_path else None
+        changes = _journal_path(dest, backups, rsync_args, sources, dry_run) if journal else None
+        rsync_args += _link_dest_args(dest, backups, link_dest)
+    except Exception:
+        _rollback(dest, tmp, new)
+        raise
 
-        if backups:
-            logger.info(f"Attempting to link snapshot files to {backups[-1]}")
-            rsync_args.append(f"--link-dest={backups[-1]}")
-        
-        logger.info("Creating backup snapshot...")
-        create_snapshot(sources, tmp, rsync_args)
-    
-    except Exception as err:
+    return dest, new, tmp, rsync_args, fast, changes
 
-        # - if there is an error we rollback then raise
-        
-        logger.error("Starting rollback")
-        logger.error(f"Removing temporary folder {tmp}")
-        shutil.rmtree(tmp)
 
-        raise RuntimeError from err
+def _end_backup(dest, new, tmp, start, stats, rsync_args, max_backups, prune_mode = "inline", prune_workers = PRUNE_WORKERS, prune_max_rate = None, fast = None, changes = None) -> SnapshotResult:
+
+    # - steps of snap_backup after a successful transfer
+
+    dry_run = "--dry-run" in rsync_args
+    result = SnapshotResult(new, str(dest), start, datetime.datetime.now(), dry_run, stats)
+    result.phases["snapshot"] = (result.end - result.start).total_seconds()
+    logger.info(f"Snapshot statistics: {result.total}")
+
+    _finish_backup(dest, tmp, result, max_backups, rsync_args, prune_mode, prune_workers, prune_max_rate)
+    _remove_old_indexes()
+    if (fast is not None) and (not dry_run):
+        fast.commit(result.name)
+    if changes is not None:
+        changes.commit(result.name)
+
+    return result
+
+
+def _check_link_dest(n):
+    if not (1 <= n <= MAX_LINK_DEST):
+        raise ValueError(f"Invalid number of link-dest snapshots {n}. It must be between 1 and {MAX_LINK_DEST}")
+
+
+def _link_dest_args(dest, backups, n = 1) -> list:
+
+    # - up to n previous snapshots, newest first. rsync hard links a
+    # - file from the first of them where it is unchanged, so a file
+    # - missing from or changed in the last snapshot can still be
+    # - linked from an older one. The last snapshot is known to exist
+
+    if not backups:
+        return []
+
+    older = [bk for bk in reversed(backups[-n:-1]) if dest.isdir(bk)] if n > 1 else []
+    candidates = [backups[-1]] + older
+    for bk in candidates:
+        logger.info(f"Attempting to link snapshot files to {bk}")
+
+    return [f"--link-dest={bk}" for bk in candidates]
+
+
+def _fast_path(dest, backups, rsync_args, dry_run = False):
+
+    # - the previous snapshot must be on this host to link from it
+
+    if dry_run:
+        return None
+
+    if dest.remote:
+        logger.info(f"Unchanged sources are not linked for remote destination {dest}")
+        return None
+
+    previous = os.path.basename(backups[-1]) if backups else None
+    return FastPath(dest.path, previous, rsync_args)
+
+
+def _link_unchanged(sources, dst, fast_path):
+
+    # - returns the sources left for rsync and the statistics of the
+    # - sources linked from the previous snapshot
+
+    remaining = []
+    linked = []
+    for src in sources:
+        with span("fingerprint", src):
+            old, reason = fast_path.check(src)
+
+        if old is None:
+            logger.info(f"Backing up {src} with rsync: {reason}")
+            remaining.append(src)
+            continue
+
+        logger.info(f"Linking {src} from the previous snapshot: {reason}")
+        start = time.monotonic()
+        try:
+            with span("link_tree", src):
+                link_tree(old, os.path.join(dst, os.path.basename(src)))
+        except OSError as err:
+
+            # - rsync completes whatever was linked so far
+
+            logger.warning(f"Cannot link {src} from the previous snapshot: {err}. Using rsync")
+            remaining.append(src)
+            continue
+
+        stats = snapshot_stats(src, fast_path.fingerprint(src), time.monotonic() - start)
+        logger.info(f"Transfer statistics: {stats}")
+        linked.append(stats)
+
+    return remaining, linked
+
+
+def _journal_path(dest, backups, rsync_args, sources, dry_run = False):
+
+    # - journals are marked before anything is sent, so that changes
+    # - made during the snapshot are sent by the next one
+
+    if dry_run:
+        return None
+
+    if dest.remote:
+        logger.info(f"Journals are not used for remote destination {dest}")
+        return None
+
+    previous = os.path.basename(backups[-1]) if backups else None
+    journal = JournalPath(dest.path, previous, rsync_args)
+    for src in sources:
+        if not journal.mark(src):
+            logger.info(f"No journal for {src}: snappy watch is not running for it")
+
+    return journal
+
+
+def _sync_changed(sources, dst, rsync_args, journal):
+
+    # - returns the sources left for a full rsync and the statistics
+    # - of the sources sent from their journal
+
+    remaining = []
+    synced = []
+    for src in sources:
+        old, changes, reason = journal.check(src)
+        if old is None:
+            logger.info(f"Backing up {src} with a full rsync: {reason}")
+            remaining.append(src)
+            continue
+
+        logger.info(f"Sending the changes of {src}: {reason}")
+        target = os.path.join(dst, os.path.basename(src))
+        try:
+            synced.append(_snapshot_changes(src, target, old, changes, rsync_args))
+        except (OSError, RsyncError) as err:
+
+            # - the full rsync starts over, since the linked files must
+            # - not be updated in place
+
+            logger.warning(f"Cannot send the changes of {src}: {err}. Using a full rsync")
+            _remove(target)
+            remaining.append(src)
+
+    return remaining, synced
+
+
+def _snapshot_changes(src, target, old, changes, rsync_args) -> TransferStats:
+
+    # - the previous snapshot of src is linked to target, then rsync
+    # - sends the changed paths only. Statistics are those of the
+    # - changed paths, plus the number of linked entries
+
+    stats = TransferStats(src)
+    start = time.monotonic()
+    with span("link_tree", src):
+        linked = link_tree(old, target)
+
+    entries = _changed_entries(src, target, changes)
+    if entries:
+        with tempfile.NamedTemporaryFile(prefix = "snappy-files-") as files:
+            base = _batch_entry(src)
+            files.write(b"".join(os.fsencode(os.path.join(base, rel) if rel else base) + b"\0" for rel in entries))
+            files.flush()
+            options = rsync_args + ["-av", "--stats", "--itemize-changes", "--from0", f"--files-from={files.name}"]
+
+            with span("rsync", src):
+                output = rsync(os.path.sep, os.path.dirname(target) + os.path.sep, options, on_line = stats.feed)
+            _check_rsync_output(src, output, logger)
+
+    stats.files += linked
+    stats.seconds = time.monotonic() - start
+    logger.info(f"Transfer statistics: {stats}")
+    return stats
+
+
+def _changed_entries(src, target, changes) -> list:
+
+    # ---------------------------------------------------------------
+    #  Removes the changed paths from target, which are hard links to
+    #  the previous snapshot and must not be updated in place, and
+    #  returns the ones to send, relative to src. The whole tree of a
+    #  new folder is sent, as well as the folders holding a change,
+    #  whose times changed. Non-readable files are left out
+    # ---------------------------------------------------------------
+
+    entries = set()
+    for rel in sorted(changes):
+        path = os.path.join(src, rel) if rel else src
+        dst = os.path.join(target, rel) if rel else target
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            st = None
+
+        try:
+            old = os.lstat(dst)
+        except FileNotFoundError:
+            old = None
+
+        # - a folder that is still a folder keeps its contents
+
+        folders = (st is not None) and stat.S_ISDIR(st.st_mode) and (old is not None) and stat.S_ISDIR(old.st_mode)
+        if (old is not None) and not (folders and changes[rel] != TREE):
+            _remove(dst)
+
+        if rel:
+            entries.add(os.path.dirname(rel))
+
+        if (st is None) or not _is_readable(path, st):
+            continue
+
+        entries.add(rel)
+        if (changes[rel] != TREE) or not stat.S_ISDIR(st.st_mode):
+            continue
+
+        for root, dirs, files in os.walk(path):
+            base = os.path.relpath(root, src)
+            for name in dirs + files:
+                if _is_readable(os.path.join(root, name)):
+                    entries.add(os.path.join(base, name))
+
+    # - the folder of a path can be gone as well
+
+    return sorted(e for e in entries if os.path.lexists(os.path.join(src, e)))
+
+
+def _is_readable(path, st = None):
+
+    # - rsync cannot copy non-readable files, which are left out
+
+    st = os.lstat(path) if st is None else st
+    if stat.S_ISDIR(st.st_mode) or stat.S_ISLNK(st.st_mode) or os.access(path, os.R_OK):
+        return True
+
+    logger.warning(f"This file will be excluded from the backup: {path}")
+    return False
+
+
+def _remove(path):
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _rollback(dest, tmp, new):
+
+    logger.error("Starting rollback")
+    logger.error(f"Removing temporary folder {tmp}")
+    dest.rmtree(tmp)
+
+    catalog = Catalog.load(dest.path, dest)
+    if catalog.get(new) is not None:
+        catalog.update(new, status = "failed", end = catalog_now())
+        _save_catalog(catalog)
+
+
+def _remove_old_indexes() -> None:
+
+    try:
+        scan.remove_old_indexes()
+    except OSError as err:
+        logger.warning(f"Cannot remove old scan indexes: {err}")
+
+
+def _save_catalog(catalog):
+
+    # - a catalog that cannot be saved is removed, so that it is rebuilt
+    # - from the snapshot folders instead of keeping a wrong status. The
+    # - backup only fails if it cannot be removed either
+
+    try:
+        catalog.save()
+        return None
+    except OSError as err:
+        logger.warning(f"Cannot save snapshot catalog {catalog.file}: {err}")
+
+    try:
+        catalog.fs.remove(catalog.file)
+    except FileNotFoundError:
+        pass
+
+    logger.warning("The catalog will be rebuilt from the snapshot folders")
+
+
+def _finish_backup(dest, tmp, result, max_backups, rsync_args, prune_mode = "inline", prune_workers = PRUNE_WORKERS, prune_max_rate = None):
 
     # - if it succeeds, we rename tmp file and clean old backups
 
     if "--dry-run" in rsync_args:
-        shutil.rmtree(tmp)
-        return new
+        with span("remove_tmp"):
+            dest.rmtree(tmp)
+        return None
 
-    new = os.path.join(backup_folder, new)
+    start = time.monotonic()
+    new = dest.join(result.name)
     logger.info(f"Moving temporary folder {tmp} to {new}")
-    mv(tmp, new)
+    with span("mv"):
+        dest.move(tmp, new)
 
+    with span("catalog"):
+        catalog = Catalog.load(dest.path, dest)
+        catalog.update(result.name, status = "complete", end = catalog_now(), size = result.total.total_size)
+        _save_catalog(catalog)
+    result.phases["finalize"] = time.monotonic() - start
+
+    start = time.monotonic()
     logger.info("Cleaning old backups")
-    clean_backups(backup_folder, max_backups)
-    return os.path.basename(new)
+    with span("clean_backups"):
+        result.prune = clean_backups(dest, max_backups, prune_mode, prune_workers, prune_max_rate)
+    result.phases["prune"] = time.monotonic() - start
 
 
-def clean_backups(path: os.PathLike, n: int) -> None:
+def _check_sources(sources):
 
-    if n <= 0:
-        logger.info("No old backups to remove")
+    # - all sources must exist before any rsync starts
+
+    sources = [ut.normalize_path(src) for src in sources]
+    for src in sources:
+        if not os.path.exists(src):
+            ftype = "folder" if os.path.isdir(src) else "file"
+            logger.error(f"{ftype.capitalize()} {src} cannot be found")
+            logger.error("Stopping snapshot")
+            raise FileNotFoundError(f"Location {src} cannot be found. Stopping snapshot creation.")
+
+    return sources
+
+
+def _source_loggers(prefix = None):
+
+    # - when sources run concurrently, each log line is prefixed
+    # - with the source name so that the output can be told apart
+
+    if prefix is None:
+        return logger, None
+
+    lg = _SourceLogger(logger, {"source" : prefix})
+    rlg = _SourceLogger(rsync_logger, {"source" : prefix})
+    return lg, rlg
+
+
+def _snapshot_source(src, dst, rsync_args, prefix = None, rescan = False, pressure = None) -> TransferStats:
+
+    lg, rlg, options, stats = _start_source(src, rsync_args, prefix, rescan)
+    watch = _wait_pressure(pressure, lg, src)
+
+    try:
+        start = time.monotonic()
+        with span("rsync", src):
+            output = rsync(src, dst, options, log = rlg, on_line = stats.feed, pressure = watch)
+
+        if _needs_rescan(output, rescan):
+            options, stats = _rescan_source(src, rsync_args, lg)
+            with span("rsync", src):
+                output = rsync(src, dst, options, log = rlg, on_line = stats.feed, pressure = watch)
+
+    except Exception as err:
+        raise _transfer_error(lg, err) from err
+
+    _end_source(src, output, stats, lg, time.monotonic() - start, watch)
+    return stats
+
+
+def _start_source(src, rsync_args, prefix = None, rescan = False):
+
+    # - loggers, rsync options and statistics of a source, shared
+    # - with snappy.aio
+
+    lg, rlg = _source_loggers(prefix)
+    with span("scan", src):
+        options = _source_rsync_options(src, rsync_args, lg, rescan)
+
+    return lg, rlg, options, TransferStats(src)
+
+
+def _needs_rescan(output, rescan = False) -> bool:
+
+    # ---------------------------------------------------------------
+    #  The cached scan misses files made non-readable in a folder that
+    #  did not change otherwise. rsync then fails to read them, with a
+    #  partial transfer (code 23) or "Permission denied", and the
+    #  source is sent again once after a full scan
+    # ---------------------------------------------------------------
+
+    if rescan or (output.returncode == 0):
+        return False
+
+    errors = output.stderr if output.stderr else output.stdout
+    return (output.returncode == RSYNC_PARTIAL) or ("Permission denied" in errors)
+
+
+def _rescan_source(src, rsync_args, lg):
+
+    lg.warning(f"rsync could not read some files of {src}. Scanning it again for non-readable files")
+    with span("scan", src):
+        options = _source_rsync_options(src, rsync_args, lg, rescan = True)
+
+    return options, TransferStats(src)
+
+
+def _wait_pressure(pressure, lg, name = None):
+
+    # - the pressure watch of a transfer, once the system allows it
+
+    if pressure is None:
         return None
 
-    backups = get_backup_folders(path)
-    backups.reverse()
-    if len(backups) > n:
-        for bk in backups[n:]:
-            logger.info(f"Removing backup {os.path.basename(bk)}")
-            shutil.rmtree(bk)
-    else:
-        logger.info("No old backups to remove")
+    watch = pressure.watch()
+    with span("pressure_wait", name):
+        watch.wait(lg)
 
+    return watch
 
-# ---------------------
-#  Internal functions
-# ---------------------
+
+def _transfer_error(lg, err) -> RsyncError:
+
+    lg.error("There was an error when running the backup")
+    _log_error(str(err))
+    return RsyncError(str(err))
+
+
+def _end_source(src, output, stats, lg, elapsed, watch = None) -> None:
+
+    _set_times(stats, elapsed, watch)
+    _check_rsync_output(src, output, lg)
+    lg.info(f"Transfer statistics: {stats}")
+
+
+def _snapshot_batch(sources, dst, rsync_args, rescan = False, pressure = None) -> TransferStats:
+
+    # - a single rsync for every source, with the same layout in dst
+    # - as one rsync per source. Statistics are for the whole batch
+
+    excludes, stats = _start_batch(sources, rsync_args, rescan)
+    watch = _wait_pressure(pressure, logger)
+
+    with tempfile.NamedTemporaryFile(prefix = "snappy-files-") as files:
+        files.write(_batch_list(sources))
+        files.flush()
+        options = _batch_rsync_options(rsync_args, files.name) + excludes
+
+        try:
+            start = time.monotonic()
+            with span("rsync", "batch"):
+                output = rsync(os.path.sep, dst, options, on_line = stats.feed, pressure = watch)
+
+            if _needs_rescan(output, rescan):
+                logger.warning("rsync could not read some files. Scanning the sources again for non-readable files")
+                excludes, stats = _start_batch(sources, rsync_args, rescan = True)
+                options = _batch_rsync_options(rsync_args, files.name) + excludes
+                with span("rsync", "batch"):
+                    output = rsync(os.path.sep, dst, options, on_line = stats.feed, pressure = watch)
+
+        except Exception as err:
+            raise _transfer_error(logger, err) from err
+
+    _end_batch(sources, output, stats, time.monotonic() - start, watch)
+    return stats
+
+
+def _start_batch(sources, rsync_args, rescan = False):
+
+    # - exclusions of every source and the batch statistics
+
+    logger.info(f"Backing up {len(sources)} sources with a single rsync")
+    excludes = []
+    for src in sources:
+        with span("scan", src):
+            excludes += _source_excludes(src, rsync_args, logger, rescan)
+
+    return excludes, TransferStats("batch")
+
+
+def _end_batch(sources, output, stats, elapsed, watch = None) -> None:
+
+    _set_times(stats, elapsed, watch)
+    _check_batch_output(sources, output)
+    logger.info(f"Transfer statistics: {stats}")
+
+
+def _batch_list(sources) -> bytes:
+
+    # - NUL separated, for --from0, so that any file name works
+
+    return b"".join(_batch_entry(src).encode("utf8") + b"\0" for src in sources)
+
+
+def _batch_entry(src):
+
+    # - entry of src in the --files-from list, relative to /. The /./
+    # - marks where the path kept in the destination starts, so that
+    # - the layout is the same as `rsync src dst`
+
+    path = src.lstrip(os.path.sep)
+    if src.endswith(os.path.sep):
+        return path + "." + os.path.sep
+
+    head, tail = os.path.split(path)
+    return os.path.join(head, ".", tail) if head else os.path.join(".", tail)
+
+
+def _batch_rsync_options(rsync_args, files):
+
+    # - --files-from implies --relative but not --recursive
+
+    return rsync_args + [
+        "-av",
+        "--recursive",
+        "--delete",
+        "--stats",
+        "--itemize-changes",
+        "--from0",
+        f"--files-from={files}",
+    ]
+
+
+def _check_batch_output(sources, output) -> None:
+
+    # - rsync reports errors with the full path of the file, so they
+    # - are mapped back to the source that contains it
+
+    if output.returncode == 0:
+        for src in sources:
+            ftype = "folder" if os.path.isdir(src) else "file"
+            logger.info(f"{ftype.capitalize()} {src} backed up!")
+        return None
+
+    errors = output.stderr if output.stderr else output.stdout
+    lines = [line.replace("/./", "/") for line in errors.split("\n") if line.strip() != ""]
+
+    failed = []
+    for src in sources:
+        pattern = re.compile(re.escape(src.rstrip(os.path.sep)) + r"(?=[/\"':\s]|$)")
+        matched = [line for line in lines if pattern.search(line)]
+        if not matched:
+            continue
+
+        failed.append(src)
+        lg, _ = _source_loggers(_source_name(src))
+        lg.error(f"There was an error when backing up {src}")
+        for line in matched:
+            lg.error(line)
+
+    unmatched = [line for line in lines if not any(src.rstrip(os.path.sep) in line for src in failed)]
+    for line in unmatched:
+        logger.error(line)
+
+    logger.error(f"Error code: {output.returncode}")
+    if failed:
+        raise RsyncError(f"rsync failed for {', '.join(failed)}")
+
+    raise RsyncError(errors)
+
+
+def _set_times(stats, elapsed, watch = None):
+
+    # - time spent paused is reported apart from the transfer time,
+    # - including the wait before rsync started
+
+    if watch is None:
+        stats.seconds = elapsed
+        return None
+
+    stats.seconds = max(elapsed - watch.stopped, 0.0)
+    stats.paused = watch.paused
+
+
+def _source_rsync_options(src, rsync_args, lg, rescan = False) -> list:
+
+    ftype = "folder" if os.path.isdir(src) else "file"
+    lg.info(f"Backing up {ftype} {src}")
+
+    rsync_excl = _source_excludes(src, rsync_args, lg, rescan)
+    lg.info("Showing rsync logs:")
+    lg.info("-------------------")
+    return rsync_args + ["-av", "--delete", "--stats", "--itemize-changes"] + rsync_excl
+
+
+def _source_excludes(src, rsync_args, lg, rescan = False) -> list:
+
+    # - exclusions are anchored to the transfer root, which includes
+    # - the source folder name unless the source ends with /
+
+    root = scan.transfer_root(src)
+    exclude = [a[len("--exclude="):] for a in rsync_args if a.startswith("--exclude=")]
+
+    try:
+        index = scan.NonReadableIndex(src, exclude)
+        non_readable = [root + nr for nr in index.scan(rescan = rescan)]
+    except Exception as err:
+        lg.error(f"There was an error when trying to find non-readable files in {src}")
+        _log_error(str(err))
+        raise RsyncError(str(err)) from err
+
+    rsync_excl = exclude_from_rsync(non_readable)
+    for rse in non_readable:
+        lg.warning(f"This file will be excluded from the backup: {rse}")
+
+    return rsync_excl
+
+
+def _check_rsync_output(src, output, lg) -> None:
+
+    if (output.returncode != 0):
+
+        error_msg = _log_rsync_error(output)
+        lg.error(f"Error code: {output.returncode}")
+        raise RsyncError(error_msg)
+
+    ftype = "folder" if os.path.isdir(src) else "file"
+    msg = f"{ftype.capitalize()} {src} backed up!"
+    lg.info(msg)
+    lg.info("-" * len(msg))
 
 
 def _log_error(error_msg):
@@ -186,36 +999,29 @@ def _log_error(error_msg):
             logger.error(m)
 
 
-def _log_rsync_error(cmd_output: subprocess.Popen) -> str:
+def _log_rsync_error(cmd_output: subprocess.CompletedProcess) -> str:
 
     logger.error("There was an error when running the backup")
     logger.error("Error message")
 
-    stdout = cmd_output.stdout.readlines()
-    stderr = cmd_output.stderr.readlines()
-    error_msg = stderr if stderr else stdout
-    for msg in error_msg:
-        _log_error(msg)
+    error_msg = cmd_output.stderr if cmd_output.stderr else cmd_output.stdout
+    _log_error(error_msg)
 
     return error_msg
 
 
-def _list_non_readable_files(src):
+def _list_non_readable_files(src, exclude = None):
 
     # - rsync cannot copy non-readable files so we try to identify
     # - those and if so we automatically exclude them from the
     # - rsync sources
 
-    out = find_non_readable(src)
-    if out.returncode != 0:
-        # - there was an error and hence we do not do anything
-        _log_error(out.stderr)
-        return []
+    src = ut.normalize_path(src)
+    base = src.rstrip(os.path.sep)
 
-    if out.stdout is None:
+    try:
+        return [base + f for f in scan.iter_non_readable(src, exclude)]
+    except Exception as err:
+        # - there was an error and hence we do not do anything
+        _log_error(str(err))
         return []
-
-    files = out.stdout.decode("utf-8").split("\n")
-    files = (f.strip() for f in files)
-    files = (f for f in files if f != "")
-    return list(files)
@@ -0,0 +1,106 @@
+import time
+import threading
+import contextlib
+
+
+# -----------------------------------------------------------------
+#  Lightweight tracing of the backup phases. Code is instrumented
+#  with `with span("phase", source = ...)`; while tracing is off the
+#  span is a shared no-op context manager, so the cost is one
+#  attribute lookup per phase. CPU time is the time of the thread
+#  that ran the span, so it does not include the rsync processes
+# -----------------------------------------------------------------
+
+
+class Span:
+
+    __slots__ = ("name", "source", "start", "wall", "cpu")
+
+    def __init__(self, name, source = None) -> None:
+
+        self.name = name
+        self.source = source
+        self.start = None
+        self.wall = 0.0
+        self.cpu = 0.0
+
+
+class Tracer:
+
+    def __init__(self) -> None:
+
+        self.enabled = False
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, source = None):
+
+        sp = Span(name, source)
+        sp.start = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield sp
+        finally:
+            sp.wall = time.perf_counter() - sp.start
+            sp.cpu = time.thread_time() - cpu
+            with self._lock:
+                self.spans.append(sp)
+
+    def summary(self) -> list:
+
+        # - spans with the same name and source are added up, in the
+        # - order in which they first started
+
+        rows = {}
+        for sp in sorted(self.spans, key = lambda s: s.start):
+            key = (sp.name, sp.source)
+            row = rows.setdefault(key, [sp.name, sp.source, 0, 0.0, 0.0])
+            row[2] += 1
+            row[3] += sp.wall
+            row[4] += sp.cpu
+
+        return list(rows.values())
+
+    def table(self) -> str:
+
+        header = ["Phase", "Source", "Calls", "Wall (s)", "CPU (s)"]
+        rows = [header]
+        for name, source, calls, wall, cpu in self.summary():
+            rows.append([name, source or "-", str(calls), f"{wall:.3f}", f"{cpu:.3f}"])
+
+        widths = [max(len(r[idx]) for r in rows) for idx in range(len(header))]
+        lines = []
+        for idx, r in enumerate(rows):
+            cells = [c.ljust(w) if jdx < 2 else c.rjust(w) for jdx, (c, w) in enumerate(zip(r, widths))]
+            lines.append("  ".join(cells).rstrip())
+            if idx == 0:
+                lines.append("-" * len(lines[0]))
+
+        return "\n".join(lines)
+
+
+_NOOP = contextlib.nullcontext()
+
+tracer = Tracer()
+
+
+def span(name, source = None):
+
+    if not tracer.enabled:
+        return _NOOP
+
+    return tracer.span(name, source)
+
+
+def enable() -> None:
+    tracer.reset()
+    tracer.enabled = True
+
+
+def disable() -> None:
+    tracer.enabled = False
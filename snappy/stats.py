@@ -0,0 +1,196 @@
+import re
+import json
+
+
+# - rsync --stats lines and the TransferStats attribute they fill
+
+STATS_FIELDS = {
+    "Number of files" : "files",
+    "Number of created files" : "files_created",
+    "Number of deleted files" : "files_deleted",
+    "Number of regular files transferred" : "files_transferred",
+    "Number of files transferred" : "files_transferred",
+    "Total file size" : "total_size",
+    "Total transferred file size" : "transferred_size",
+    "Literal data" : "literal_data",
+    "Matched data" : "matched_data",
+    "Total bytes sent" : "bytes_sent",
+    "Total bytes received" : "bytes_received",
+}
+
+STATS_LINE = re.compile(r"^(?P<key>[A-Za-z ]+): (?P<value>[0-9][0-9,]*)")
+ITEMIZE_LINE = re.compile(r"^(?P<update>[<>ch.])(?P<type>[fdLDS])(?P<attrs>.{9,10}) ")
+
+
+class TransferStats:
+
+    # -------------------------------------------------------------
+    #  Statistics of one rsync run, taken from the --stats summary
+    #  and the --itemize-changes lines. Sizes are in bytes. seconds
+    #  excludes the time paused because of system pressure, which is
+    #  kept in paused
+    # -------------------------------------------------------------
+
+    fields = [
+        "files",
+        "files_created",
+        "files_deleted",
+        "files_transferred",
+        "total_size",
+        "transferred_size",
+        "literal_data",
+        "matched_data",
+        "bytes_sent",
+        "bytes_received",
+        "itemized_created",
+        "itemized_updated",
+        "itemized_deleted",
+        "itemized_hardlinked",
+    ]
+
+    def __init__(self, source = None) -> None:
+
+        self.source = source
+        self.seconds = 0.0
+        self.paused = 0.0
+        for f in self.fields:
+            setattr(self, f, 0)
+
+    def feed(self, line: str) -> None:
+
+        # - called for every line rsync writes to stdout
+
+        m = STATS_LINE.match(line)
+        if m is not None:
+            field = STATS_FIELDS.get(m.group("key"))
+            if field is not None:
+                setattr(self, field, int(m.group("value").replace(",", "")))
+            return None
+
+        if line.startswith("*deleting "):
+            self.itemized_deleted += 1
+            return None
+
+        m = ITEMIZE_LINE.match(line)
+        if m is None:
+            return None
+
+        # - h is a hard link between files of the transfer (-H). Files
+        # - linked from a --link-dest snapshot are not itemized
+
+        update = m.group("update")
+        attrs = m.group("attrs")
+        if update == "h":
+            self.itemized_hardlinked += 1
+        elif attrs.startswith("+++"):
+            self.itemized_created += 1
+        elif update in "<>c":
+            self.itemized_updated += 1
+
+    def add(self, other) -> None:
+
+        self.seconds += other.seconds
+        self.paused += other.paused
+        for f in self.fields:
+            setattr(self, f, getattr(self, f) + getattr(other, f))
+
+    @property
+    def unchanged_size(self) -> int:
+
+        # - size of the files rsync did not transfer. Those found in a
+        # - --link-dest snapshot are hard linked and take no new space.
+        # - A transferred file counts in full in transferred_size, even
+        # - if the delta transfer only sent part of it (literal_data)
+
+        return max(self.total_size - self.transferred_size, 0)
+
+    @property
+    def copied_size(self) -> int:
+        return self.transferred_size
+
+    @property
+    def mb_per_second(self) -> float:
+
+        # - effective rate: data that ended up in the snapshot per second
+
+        if self.seconds <= 0:
+            return 0.0
+
+        return self.transferred_size / self.seconds / 1024 ** 2
+
+    def to_dict(self) -> dict:
+
+        out = {"source" : self.source, "seconds" : round(self.seconds, 3), "paused" : round(self.paused, 3)}
+        for f in self.fields:
+            out[f] = getattr(self, f)
+
+        out["unchanged_size"] = self.unchanged_size
+        out["copied_size"] = self.copied_size
+        out["mb_per_second"] = round(self.mb_per_second, 3)
+        return out
+
+    def __str__(self) -> str:
+        paused = f", paused {self.paused:.1f}s" if self.paused > 0 else ""
+        return (
+            f"{self.files_transferred} of {self.files} files transferred, "
+            f"{self.transferred_size / 1024 ** 2:.1f} of {self.total_size / 1024 ** 2:.1f} MB "
+            f"in {self.seconds:.1f}s ({self.mb_per_second:.1f} MB/s), "
+            f"{self.unchanged_size / 1024 ** 2:.1f} MB unchanged{paused}"
+        )
+
+
+class SnapshotResult:
+
+    # - returned by snap_backup: the snapshot name, the statistics of
+    # - every source, the seconds spent in each phase and the statistics
+    # - of the old backups deleted afterwards (None if not deleted inline)
+
+    def __init__(self, name, folder = None, start = None, end = None, dry_run = False, sources = None) -> None:
+
+        self.name = name
+        self.folder = folder
+        self.start = start
+        self.end = end
+        self.dry_run = dry_run
+        self.sources = list(sources or [])
+        self.phases = {}
+        self.prune = None
+
+    @property
+    def total(self) -> TransferStats:
+
+        total = TransferStats()
+        for s in self.sources:
+            total.add(s)
+
+        # - sources can run concurrently, so the elapsed time of the
+        # - snapshot is the wall time, pauses included, and not the sum
+
+        if (self.start is not None) and (self.end is not None):
+            total.seconds = (self.end - self.start).total_seconds()
+
+        return total
+
+    def to_dict(self) -> dict:
+        return {
+            "name" : self.name,
+            "folder" : self.folder,
+            "start" : self.start.isoformat() if self.start else None,
+            "end" : self.end.isoformat() if self.end else None,
+            "dry_run" : self.dry_run,
+            "phases" : {k : round(v, 3) for k, v in self.phases.items()},
+            "total" : self.total.to_dict(),
+            "sources" : [s.to_dict() for s in self.sources],
+            "prune" : None if self.prune is None else {
+                "folders" : self.prune.folders,
+                "inodes" : self.prune.inodes,
+                "bytes" : self.prune.bytes,
+                "seconds" : round(self.prune.seconds, 3),
+            },
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent = 1)
+
+    def __str__(self) -> str:
+        return self.name
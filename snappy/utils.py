@@ -1,4 +1,5 @@
 import os
+import stat
 
 
 def substitute_tilde(path):
@@ -10,6 +11,47 @@ def normalize_path(path):
     need_sep = (path[-1] == os.path.sep)
     path = substitute_tilde(path)
     path = os.path.abspath(path)
-    if need_sep:
+    if need_sep and not path.endswith(os.path.sep):
         path += os.path.sep
     return path
+
+
+def human_size(size):
+
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1024 or unit == "TB":
+            break
+        size /= 1024
+
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def write_atomic(path, data, mode = "w"):
+
+    # - write to a temporary file in the same folder and rename it
+    # - over path, so readers never see a partially written file.
+    # - It keeps the permissions of path. A new file is created with
+    # - 0666 so that the kernel applies the umask, which cannot be read
+    # - without changing it for every thread
+
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok = True)
+
+    try:
+        perms = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        perms = None
+
+    tmp = os.path.join(folder, f".tmp-{os.getpid()}-{os.urandom(8).hex()}")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, mode) as f:
+            if perms is not None:
+                os.fchmod(f.fileno(), perms)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
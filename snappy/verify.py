@@ -0,0 +1,378 @@
+import os
+import json
+import stat
+import time
+import logging
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from .catalog import Catalog
+from .destination import get_destination
+from .dedup import hash_file
+from .scan import ExcludeMatcher
+from . import utils as ut
+
+
+logger = logging.getLogger(__name__)
+
+MANIFESTS = ".snappy-manifests"
+VERIFY_WORKERS = 4
+CHUNK_SIZE = 16
+PROGRESS_SECONDS = 10
+VERIFY_MODES = ("sources", "manifest")
+
+
+class VerifyStats:
+
+    # - outcome of verifying one snapshot. The lists hold paths
+    # - relative to the snapshot
+
+    def __init__(self, snapshot = None) -> None:
+
+        self.snapshot = snapshot
+        self.files = 0
+        self.hashed = 0
+        self.reused = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.mismatched = []
+        self.missing = []
+        self.extra = []
+        self.changed = []
+        self.errors = []
+
+    @property
+    def ok(self) -> bool:
+        return not (self.mismatched or self.missing or self.extra or self.errors)
+
+    @property
+    def rate(self) -> float:
+
+        # - bytes hashed per second
+
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.files} files, {self.hashed} hashed ({ut.human_size(self.bytes)} at {ut.human_size(self.rate)}/s), "
+            f"{self.reused} from manifests: {len(self.mismatched)} mismatched, {len(self.missing)} missing, "
+            f"{len(self.extra)} unexpected, {len(self.changed)} changed since the snapshot, {len(self.errors)} errors"
+        )
+
+
+class Manifest:
+
+    # ---------------------------------------------------------------
+    #  Content digests of the regular files of a snapshot, saved as
+    #  JSON in the .snappy-manifests folder of the backup folder.
+    #  files maps a path relative to the snapshot to its digest, size,
+    #  mtime and inode
+    # ---------------------------------------------------------------
+
+    version = 1
+
+    def __init__(self, folder, name) -> None:
+
+        self.folder = folder
+        self.name = name
+        self.files = {}
+
+    @property
+    def file(self) -> str:
+        return os.path.join(self.folder, MANIFESTS, f"{self.name}.json")
+
+    def load(self) -> bool:
+
+        try:
+            with open(self.file, "r", encoding = "utf8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as err:
+            logger.warning(f"Ignoring unreadable manifest {self.file}: {err}")
+            return False
+
+        if (data.get("version") != self.version) or (data.get("snapshot") != self.name):
+            return False
+
+        self.files = data.get("files", {})
+        return True
+
+    def save(self) -> None:
+
+        data = {
+            "version" : self.version,
+            "snapshot" : self.name,
+            "created" : datetime.datetime.now().isoformat(timespec = "seconds"),
+            "files" : self.files,
+        }
+
+        try:
+            ut.write_atomic(self.file, json.dumps(data, separators = (",", ":")))
+        except OSError as err:
+            logger.warning(f"Cannot save manifest {self.file}: {err}")
+
+    def by_inode(self) -> dict:
+        return {e[3] : e for e in self.files.values()}
+
+
+def verify(path: os.PathLike, snapshot = None, mode = "sources", workers = VERIFY_WORKERS, exclude = None) -> VerifyStats:
+
+    # ------------------------------------------------------------------
+    #  Check the contents of a snapshot of the backup folder path, the
+    #  newest one if snapshot is None. In sources mode its files are
+    #  compared with the sources, skipping the ones changed since and
+    #  those matching exclude, and its manifest is saved. A file whose
+    #  inode, size and mtime are in the manifest of the snapshot before
+    #  is a hard link to it and is not hashed again. In manifest mode
+    #  every file is hashed and compared with the saved manifest. Each
+    #  inode is hashed once, by `workers` processes
+    # ------------------------------------------------------------------
+
+    if mode not in VERIFY_MODES:
+        raise ValueError(f"Invalid verify mode '{mode}'. Choose one of {', '.join(VERIFY_MODES)}")
+
+    dest = get_destination(path)
+    if dest.remote:
+        raise ValueError(f"Cannot verify remote folder {dest}. Run snappy verify on the remote host")
+
+    entries = Catalog.load(dest.path).snapshots()
+    names = [e["name"] for e in entries]
+    if not names:
+        raise ValueError(f"There are no complete snapshots in {dest.path}")
+
+    name = names[-1] if snapshot is None else os.path.basename(snapshot.rstrip(os.path.sep))
+    if name not in names:
+        raise ValueError(f"Snapshot {name} is not a complete snapshot of {dest.path}")
+
+    entry = entries[names.index(name)]
+    folder = os.path.join(dest.path, name)
+    stats = VerifyStats(name)
+    start = time.monotonic()
+
+    logger.info(f"Verifying snapshot {name} against its {mode}")
+    files = dict(_snapshot_files(folder))
+    stats.files = len(files)
+
+    if mode == "manifest":
+        manifest = Manifest(dest.path, name)
+        if not manifest.load():
+            raise ValueError(f"Snapshot {name} has no manifest. Verify it against its sources first")
+
+        digests = _hash_snapshot(folder, files, {}, workers, stats)
+        _compare_manifest(manifest, files, digests, stats)
+
+    else:
+        covered = _previous_manifest(dest.path, names[:names.index(name)])
+        digests = _hash_snapshot(folder, files, covered, workers, stats)
+        _compare_sources(entry, files, digests, workers, ExcludeMatcher(exclude), stats)
+
+        manifest = Manifest(dest.path, name)
+        manifest.files = {rel : [digests[rel], st.st_size, st.st_mtime_ns, st.st_ino] for rel, st in files.items() if digests.get(rel) is not None}
+        manifest.save()
+        _remove_manifests(dest.path, names)
+
+    stats.seconds = time.monotonic() - start
+    for kind in ["mismatched", "missing", "extra", "errors"]:
+        for rel in getattr(stats, kind):
+            logger.error(f"{kind.capitalize()}: {rel}")
+
+    logger.info(f"Verified snapshot {name}: {stats}")
+    return stats
+
+
+# ---------------------
+#  Internal functions
+# ---------------------
+
+
+def _snapshot_files(folder, rel = "", matcher = None):
+
+    # - regular files under folder, relative to it, with their stat.
+    # - Entries matching matcher, an ExcludeMatcher, are left out and
+    # - excluded subtrees are never entered
+
+    pending = [(folder, rel)]
+    while pending:
+        path, rel = pending.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as err:
+            logger.warning(f"Cannot scan folder {path}: {err}")
+            continue
+
+        for entry in entries:
+            entry_rel = os.path.join(rel, entry.name) if rel else entry.name
+            try:
+                st = entry.stat(follow_symlinks = False)
+            except OSError:
+                continue
+
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if matcher and matcher.match(os.path.sep + entry_rel, is_dir):
+                continue
+
+            if is_dir:
+                pending.append((entry.path, entry_rel))
+            elif stat.S_ISREG(st.st_mode):
+                yield entry_rel, st
+
+
+def _hash_snapshot(folder, files, covered, workers, stats) -> dict:
+
+    # - digest of every file, hashing each inode at most once
+
+    digests = {}
+    inodes = {}
+    for rel, st in files.items():
+        known = covered.get(st.st_ino)
+        if (known is not None) and (known[1] == st.st_size) and (known[2] == st.st_mtime_ns):
+            digests[rel] = known[0]
+            stats.reused += 1
+        else:
+            inodes.setdefault(st.st_ino, []).append(rel)
+
+    paths = [(os.path.join(folder, rels[0]), files[rels[0]].st_size) for rels in inodes.values()]
+    for rels, digest in zip(inodes.values(), _hash_files(paths, workers, stats, mapped = True)):
+        for rel in rels:
+            digests[rel] = digest
+
+    return digests
+
+
+def _hash_files(paths, workers, stats, mapped = True):
+
+    # - digests of (path, size) pairs in order, logging the progress
+    # - every PROGRESS_SECONDS
+
+    total = sum(size for _, size in paths)
+    files = [p for p, _ in paths]
+    start = time.monotonic()
+    last = start
+    done = 0
+
+    if (workers > 1) and (len(files) > 1):
+        pool = ProcessPoolExecutor(max_workers = workers)
+        digests = pool.map(hash_file, files, [mapped] * len(files), chunksize = CHUNK_SIZE)
+    else:
+        pool = None
+        digests = (hash_file(f, mapped) for f in files)
+
+    try:
+        for (_, size), digest in zip(paths, digests):
+            done += size
+            stats.hashed += 1
+            stats.bytes += size
+
+            now = time.monotonic()
+            if now - last >= PROGRESS_SECONDS:
+                last = now
+                rate = done / (now - start)
+                logger.info(f"Hashed {stats.hashed} files, {ut.human_size(done)} of {ut.human_size(total)} at {ut.human_size(rate)}/s")
+
+            yield digest
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _previous_manifest(folder, earlier) -> dict:
+
+    # - hard links to earlier snapshots are also in the newest of
+    # - them with a manifest
+
+    for name in reversed(earlier):
+        manifest = Manifest(folder, name)
+        if manifest.load():
+            logger.info(f"Reusing digests of snapshot {name}")
+            return manifest.by_inode()
+
+    return {}
+
+
+def _compare_manifest(manifest, files, digests, stats) -> None:
+
+    for rel in files:
+        expected = manifest.files.get(rel)
+        if expected is None:
+            stats.extra.append(rel)
+        elif digests[rel] is None:
+            stats.errors.append(f"{rel}: cannot read file")
+        elif digests[rel] != expected[0]:
+            stats.mismatched.append(rel)
+
+    stats.missing += sorted(rel for rel in manifest.files if rel not in files)
+
+
+def _compare_sources(entry, files, digests, workers, matcher, stats) -> None:
+
+    # ---------------------------------------------------------------
+    #  Source files with the size and mtime of their copy must have
+    #  the same contents. Files missing from the snapshot are only
+    #  reported if they did not change since the snapshot started
+    # ---------------------------------------------------------------
+
+    started = entry.get("start")
+    started = datetime.datetime.fromisoformat(started).timestamp() if started else None
+    pending = []
+
+    sources = entry.get("sources") or []
+    if not sources:
+        logger.warning(f"The catalog has no sources for snapshot {entry['name']}. Only its manifest is saved")
+
+    for src in sources:
+        base = src.rstrip(os.path.sep) or os.path.sep
+        prefix = "" if src.endswith(os.path.sep) else os.path.basename(base)
+        if not os.path.exists(base):
+            logger.warning(f"Source {src} no longer exists")
+            continue
+
+        if os.path.isdir(base):
+            source_files = _snapshot_files(base, prefix, matcher)
+        elif matcher and matcher.match(os.path.sep + prefix, False):
+            source_files = []
+        else:
+            source_files = [(prefix, os.stat(base))]
+
+        for rel, st in source_files:
+            copy = files.get(rel)
+            path = os.path.join(os.path.dirname(base), rel) if prefix else os.path.join(base, rel)
+            if copy is None:
+                if (started is not None) and (max(st.st_mtime, st.st_ctime) < started) and os.access(path, os.R_OK):
+                    stats.missing.append(rel)
+                continue
+
+            if (copy.st_size != st.st_size) or (copy.st_mtime_ns != st.st_mtime_ns):
+                stats.changed.append(rel)
+                continue
+
+            pending.append((rel, path, st.st_size))
+
+    paths = [(path, size) for _, path, size in pending]
+    for (rel, path, _), digest in zip(pending, _hash_files(paths, workers, stats, mapped = False)):
+        if digest is None:
+            stats.errors.append(f"{rel}: cannot read {path}")
+        elif digests.get(rel) is None:
+            stats.errors.append(f"{rel}: cannot read the copy in the snapshot")
+        elif digest != digests[rel]:
+            stats.mismatched.append(rel)
+
+
+def _remove_manifests(folder, names) -> None:
+
+    # - manifests of snapshots that no longer exist
+
+    names = set(names)
+    try:
+        files = os.listdir(os.path.join(folder, MANIFESTS))
+    except FileNotFoundError:
+        return None
+
+    for f in files:
+        if f.endswith(".json") and (f[:-len(".json")] not in names):
+            try:
+                os.unlink(os.path.join(folder, MANIFESTS, f))
+            except OSError as err:
+                logger.warning(f"Cannot remove manifest {f}: {err}")
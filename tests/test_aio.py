@@ -0,0 +1,106 @@
+import os
+import stat
+import time
+import asyncio
+import filecmp
+import tempfile
+import unittest
+import unittest.mock
+from snappy import aio
+from snappy.catalog import Catalog
+
+
+class TestAsyncSnapshot(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.sources = []
+        for name in ["A", "B"]:
+            path = os.path.join(self.folder.name, name)
+            os.makedirs(path)
+            with open(os.path.join(path, f"{name.lower()}.txt"), "w") as f:
+                f.write(f"This is file {name}")
+
+            self.sources.append(path)
+
+        # - scan indexes and other caches go to a temporary home
+
+        self.home = tempfile.TemporaryDirectory()
+        patcher = unittest.mock.patch.dict(os.environ, {"HOME" : self.home.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+        self.home.cleanup()
+
+    def fake_rsync(self, folder):
+
+        # - put a slow `rsync` in front of PATH. Its version is probed
+        # - right away, and saved in the temporary home
+
+        rsync = os.path.join(folder, "rsync")
+        with open(rsync, "w") as f:
+            f.write('#!/bin/sh\n[ "$1" = --version ] && echo "rsync  version 3.2.7  protocol version 31" && exit 0\nexec sleep 30\n')
+
+        os.chmod(rsync, stat.S_IRWXU)
+        return unittest.mock.patch.dict(os.environ, {"PATH" : folder + os.pathsep + os.environ["PATH"]})
+
+    def test_create_snapshot(self):
+
+        files = ["A/a.txt", "B/b.txt"]
+        with tempfile.TemporaryDirectory() as dst:
+            asyncio.run(aio.create_snapshot(self.sources, dst, max_workers = 2))
+            match, mismatch, errors = filecmp.cmpfiles(self.folder.name, dst, files)
+
+        self.assertEqual(match, files)
+
+    def test_cancel_rollback(self):
+
+        async def run(dst):
+            task = asyncio.ensure_future(aio.snap_backup(self.sources, dst, max_workers = 2))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await task
+
+        with tempfile.TemporaryDirectory() as bin_folder, tempfile.TemporaryDirectory() as dst:
+            with self.fake_rsync(bin_folder):
+                with self.assertRaises(asyncio.CancelledError):
+                    asyncio.run(run(dst))
+
+            self.assertEqual([f for f in os.listdir(dst) if not f.startswith(".")], [])
+            entries = Catalog.load(dst).snapshots(status = None)
+            self.assertEqual([e["status"] for e in entries], ["failed"])
+
+    def test_missing_source(self):
+
+        with tempfile.TemporaryDirectory() as dst:
+            with self.assertRaises(FileNotFoundError):
+                missing = os.path.join(self.folder.name, "missing")
+                asyncio.run(aio.create_snapshot(self.sources + [missing], dst))
+
+    def test_cancel_while_starting(self):
+
+        # - the backup started in a thread is rolled back once it ends
+
+        start_backup = aio.snp._start_backup
+
+        def slow_start(*args):
+            time.sleep(0.5)
+            return start_backup(*args)
+
+        async def run(dst):
+            task = asyncio.ensure_future(aio.snap_backup(self.sources, dst))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await task
+
+        with tempfile.TemporaryDirectory() as bin_folder, tempfile.TemporaryDirectory() as dst:
+            with self.fake_rsync(bin_folder), unittest.mock.patch.object(aio.snp, "_start_backup", slow_start):
+                with self.assertRaises(asyncio.CancelledError):
+                    asyncio.run(run(dst))
+
+            self.assertEqual([f for f in os.listdir(dst) if not f.startswith(".")], [])
+            entries = Catalog.load(dst).snapshots(status = None)
+            self.assertEqual([e["status"] for e in entries], ["failed"])
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from snappy import catalog
+from snappy import snappy as snp
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = self.folder.name
+        self.snapshots = ["2023-01-01-00_00_00", "2023-01-02-00_00_00", "2023-01-03-00_00_00"]
+        for name in self.snapshots:
+            os.makedirs(os.path.join(self.root, name))
+
+        # - leftover temporary folder, trash and folders that are not
+        # - snapshots
+
+        os.makedirs(os.path.join(self.root, "0123456789abcdef0123456789abcdef"))
+        os.makedirs(os.path.join(self.root, ".trash", "old"))
+        os.makedirs(os.path.join(self.root, "lost+found"))
+        os.makedirs(os.path.join(self.root, "photos"))
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def test_rebuild(self):
+
+        cat = catalog.Catalog.rebuild(self.root)
+        self.assertEqual([e["name"] for e in cat.snapshots()], self.snapshots)
+        self.assertEqual([e["status"] for e in cat.snapshots(status = "incomplete")], ["incomplete"])
+        self.assertEqual(cat.get(self.snapshots[0])["start"], "2023-01-01T00:00:00")
+        self.assertIsNone(cat.get("lost+found"))
+        self.assertIsNone(cat.get("photos"))
+
+    def test_save_and_load(self):
+
+        cat = catalog.Catalog.rebuild(self.root)
+        cat.update("2023-01-04-00_00_00", status = "failed", sources = ["/a"])
+        cat.save()
+
+        loaded = catalog.Catalog.load(self.root)
+        self.assertEqual(loaded.entries, cat.entries)
+        self.assertFalse(os.path.isdir(loaded.file))
+
+    def test_save_permissions(self):
+
+        # - a new catalog follows the umask, a saved one keeps its mode
+
+        cat = catalog.Catalog.rebuild(self.root)
+        mask = os.umask(0o027)
+        try:
+            cat.save()
+        finally:
+            os.umask(mask)
+        self.assertEqual(os.stat(cat.file).st_mode & 0o777, 0o640)
+
+        os.chmod(cat.file, 0o644)
+        cat.save()
+        self.assertEqual(os.stat(cat.file).st_mode & 0o777, 0o644)
+
+    def test_save_error_removes_catalog(self):
+
+        # - a snapshot that cannot be marked complete is found again
+        # - when the catalog is rebuilt
+
+        cat = catalog.Catalog.rebuild(self.root)
+        cat.update(self.snapshots[-1], status = "running")
+        cat.save()
+
+        cat.update(self.snapshots[-1], status = "complete")
+        with mock.patch.object(catalog.Catalog, "save", side_effect = OSError("No space left on device")):
+            snp._save_catalog(cat)
+
+        self.assertFalse(os.path.exists(cat.file))
+        self.assertEqual(catalog.Catalog.load(self.root).get(self.snapshots[-1])["status"], "complete")
+
+    def test_catalog_is_used_instead_of_disk(self):
+
+        cat = catalog.Catalog(self.root)
+        cat.update(self.snapshots[1], status = "complete")
+        cat.save()
+
+        folders = snp.get_backup_folders(self.root)
+        self.assertEqual(folders, [os.path.join(self.root, self.snapshots[1])])
+
+    def test_corrupt_catalog(self):
+
+        with open(os.path.join(self.root, catalog.CATALOG), "w") as f:
+            f.write("{not json")
+
+        cat = catalog.Catalog.load(self.root)
+        self.assertEqual([e["name"] for e in cat.snapshots()], self.snapshots)
+
+    def test_get_backup_folders_skips_tmp(self):
+
+        folders = snp.get_backup_folders(self.root)
+        expect = [os.path.join(self.root, s) for s in self.snapshots]
+        self.assertEqual(folders, expect)
+
+    def test_clean_backups_updates_catalog(self):
+
+        catalog.Catalog.rebuild(self.root).save()
+        snp.clean_backups(self.root, 1)
+
+        cat = catalog.Catalog.load(self.root)
+        self.assertEqual([e["name"] for e in cat.snapshots()], self.snapshots[-1:])
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.snapshots[0])))
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "lost+found")))
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "photos")))
+
+    def test_clean_backups_missing_folder(self):
+
+        catalog.Catalog.rebuild(self.root).save()
+        os.rmdir(os.path.join(self.root, self.snapshots[0]))
+        snp.clean_backups(self.root, 1)
+
+        cat = catalog.Catalog.load(self.root)
+        self.assertEqual([e["name"] for e in cat.snapshots()], self.snapshots[-1:])
+
+    def test_trim_failed(self):
+
+        cat = catalog.Catalog(self.root)
+        for idx in range(5):
+            cat.update(f"2023-02-0{idx + 1}-00_00_00", status = "failed")
+
+        cat.trim_failed(keep = 2)
+        self.assertEqual([e["name"] for e in cat.snapshots("failed")], ["2023-02-04-00_00_00", "2023-02-05-00_00_00"])
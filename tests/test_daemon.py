@@ -0,0 +1,139 @@
+import os
+import datetime
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from snappy import daemon
+from snappy.lock import DestinationLock, LockedError
+
+
+CONFIG = """[Destination]
+folder={folder}
+
+[Sources]
+{folder}
+
+[backup.quantity]
+3
+
+[rsync.exclude]
+
+[rsync.include]
+
+[daemon]
+snap={snap}
+socket={socket}
+"""
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.home = self.folder.name
+        patcher = mock.patch.dict(os.environ, {"HOME" : self.home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.socket = os.path.join(self.home, "daemon.sock")
+        self.write_config("0 * * * *")
+        self.runs = []
+        jobs = {name : (lambda config, name = name: self.runs.append(name) or 0) for name in daemon.JOBS}
+        self.daemon = daemon.Daemon(jobs)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def write_config(self, snap):
+
+        os.makedirs(os.path.join(self.home, ".config", "snappy"), exist_ok = True)
+        with open(os.path.join(self.home, ".config", "snappy", "snappy.ini"), "w") as f:
+            f.write(CONFIG.format(folder = self.home, snap = snap, socket = self.socket))
+
+    def test_schedule(self):
+
+        self.daemon.load()
+        self.assertEqual(self.daemon.socket_path, self.socket)
+
+        at = datetime.datetime(2023, 1, 1, 5, 0, 10)
+        self.daemon.schedule(at)
+        self.daemon.schedule(at.replace(second = 50))
+        self.daemon.schedule(at.replace(minute = 1))
+        self.assertEqual(self.daemon.status()["queued"], ["snap"])
+
+        self.daemon.run_job(*self.daemon._queue.get_nowait())
+        self.assertEqual(self.runs, ["snap"])
+        self.assertEqual(self.daemon.history["snap"]["code"], 0)
+
+    def test_interrupt(self):
+
+        # - a stop signal interrupts the running job, and only it
+
+        self.daemon.stop(interrupt = True)
+
+        def job(config):
+            self.daemon.stop(interrupt = True)
+            return 0
+
+        self.daemon.jobs["snap"] = job
+        self.assertEqual(self.daemon.run_job("snap", "request"), -1)
+        self.assertIsNone(self.daemon.running)
+
+    def test_reload(self):
+
+        self.daemon.load()
+        self.write_config("30 1 * * *")
+        os.utime(self.daemon.config_file, ns = (0, 0))
+        self.assertTrue(self.daemon.load())
+        self.assertEqual(str(self.daemon.schedules["snap"]), "30 1 * * *")
+
+        # - an invalid change keeps the previous configuration
+
+        self.write_config("61 * * * *")
+        self.assertFalse(self.daemon.load())
+        self.assertEqual(str(self.daemon.schedules["snap"]), "30 1 * * *")
+
+    def test_socket_requests(self):
+
+        thread = threading.Thread(target = self.daemon.run)
+        thread.start()
+        try:
+            self.wait_for(lambda: os.path.exists(self.socket))
+            self.assertEqual(os.stat(self.socket).st_mode & 0o777, 0o600)
+            self.assertEqual(daemon.send("prune", self.socket).strip(), "Job prune queued")
+            self.assertTrue(daemon.send("other", self.socket).startswith("Error: Unknown job"))
+            self.assertIn('"pid"', daemon.send("status", self.socket))
+            self.wait_for(lambda: self.runs)
+        finally:
+            self.daemon.stop()
+            thread.join()
+
+        self.assertEqual(self.runs, ["prune"])
+        self.assertFalse(os.path.exists(self.socket))
+
+    def wait_for(self, condition):
+
+        for _ in range(500):
+            if condition():
+                return None
+            threading.Event().wait(0.01)
+
+        self.fail("Timed out")
+
+
+class TestDestinationLock(unittest.TestCase):
+
+    def test_overlapping_snapshots(self):
+
+        with tempfile.TemporaryDirectory() as folder:
+            with DestinationLock("/backups", folder):
+                with self.assertRaises(LockedError):
+                    DestinationLock("/backups", folder).acquire()
+
+                with DestinationLock("/other", folder):
+                    pass
+
+            with DestinationLock("/backups", folder) as lock:
+                self.assertTrue(lock.locked)
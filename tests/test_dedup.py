@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+import configparser
+from unittest import mock
+from snappy import cli
+from snappy import dedup
+from snappy import destination
+from snappy.stats import SnapshotResult
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = self.folder.name
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def write(self, rel, data, mtime = 1_600_000_000):
+
+        path = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, "wb") as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_renamed_and_copied_files_are_linked(self):
+
+        data = os.urandom(4096)
+        a = self.write("2023-01-01-00_00_00/src/a.bin", data)
+        b = self.write("2023-01-02-00_00_00/src/renamed.bin", data)
+        c = self.write("2023-01-02-00_00_00/other/copy.bin", data)
+        d = self.write("2023-01-02-00_00_00/src/new.bin", os.urandom(4096))
+
+        stats = dedup.dedup(self.root, workers = 2)
+        self.assertEqual((stats.snapshots, stats.files, stats.linked), (2, 4, 2))
+
+        ino = os.stat(a).st_ino
+        self.assertEqual(os.stat(b).st_ino, ino)
+        self.assertEqual(os.stat(c).st_ino, ino)
+        self.assertNotEqual(os.stat(d).st_ino, ino)
+        with open(b, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_runs_are_incremental(self):
+
+        data = os.urandom(4096)
+        a = self.write("2023-01-01-00_00_00/a.bin", data)
+        dedup.dedup(self.root, workers = 1)
+
+        stats = dedup.dedup(self.root, workers = 1)
+        self.assertEqual(stats.snapshots, 0)
+
+        b = self.write("2023-01-02-00_00_00/b.bin", data)
+        stats = dedup.dedup(self.root, workers = 1)
+        self.assertEqual((stats.snapshots, stats.files, stats.linked), (1, 1, 1))
+        self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+
+    def test_different_metadata_is_not_linked(self):
+
+        data = os.urandom(4096)
+        a = self.write("2023-01-01-00_00_00/a.bin", data)
+        b = self.write("2023-01-02-00_00_00/b.bin", data, mtime = 1_700_000_000)
+        small = self.write("2023-01-02-00_00_00/small.txt", b"x")
+
+        stats = dedup.dedup(self.root, workers = 1)
+        self.assertEqual(stats.linked, 0)
+        self.assertEqual(stats.files, 2)
+        self.assertNotEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+        self.assertEqual(os.stat(small).st_nlink, 1)
+
+    def test_folder_mtime_is_kept(self):
+
+        data = os.urandom(4096)
+        self.write("2023-01-01-00_00_00/a.bin", data)
+        b = self.write("2023-01-02-00_00_00/sub/b.bin", data)
+
+        folder = os.path.dirname(b)
+        os.utime(folder, (1_500_000_000, 1_500_000_000))
+        dedup.dedup(self.root, workers = 1)
+
+        self.assertEqual(os.stat(folder).st_mtime, 1_500_000_000)
+        self.assertEqual(sorted(os.listdir(folder)), ["b.bin"])
+
+    def test_remote_folder(self):
+        with self.assertRaises(ValueError):
+            dedup.dedup("nas:/backups")
+
+    @mock.patch("snappy.dedup.dedup", side_effect = OSError(28, "No space left on device"))
+    def test_failure_after_backup(self, mock_dedup):
+
+        # - the backup is complete, so the failure is only a warning
+
+        config = configparser.ConfigParser()
+        result = SnapshotResult("2023-01-01-00_00_00", self.root)
+        with self.assertLogs("snappy", "WARNING"):
+            cli._dedup_after_backup(config, destination.get_destination(self.root), result)
+
+        self.assertEqual(mock_dedup.call_count, 1)
+        self.assertNotIn("dedup", result.phases)
@@ -0,0 +1,181 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+import configparser
+from unittest import mock
+from snappy import destination
+from snappy import snappy as snp
+from snappy.catalog import Catalog
+
+
+# - set to [user@]host of an sshd, e.g. localhost, that accepts
+# - non-interactive logins, to run the remote tests
+
+SSH_HOST = os.environ.get("SNAPPY_TEST_SSH")
+
+
+def completed(returncode = 0, stdout = "", stderr = ""):
+    return subprocess.CompletedProcess([], returncode, stdout, stderr)
+
+
+class TestGetDestination(unittest.TestCase):
+
+    def test_local(self):
+
+        for spec in ["/backups", "./backups", "/a/b:c", "~/backups"]:
+            dest = destination.get_destination(spec)
+            self.assertFalse(dest.remote, spec)
+            self.assertTrue(os.path.isabs(dest.path))
+
+    def test_remote(self):
+
+        dest = destination.get_destination("bob@nas:/backups/", port = 2222, compress = "zstd")
+        self.assertTrue(dest.remote)
+        self.assertEqual((dest.user, dest.host, dest.path, dest.port), ("bob", "nas", "/backups", 2222))
+        self.assertEqual(str(dest), "bob@nas:/backups")
+        self.assertEqual(dest.target(dest.join("tmp")), "bob@nas:/backups/tmp")
+
+        dest = destination.get_destination("nas:/backups")
+        self.assertIsNone(dest.user)
+        self.assertIs(destination.get_destination(dest), dest)
+
+    def test_invalid_remote(self):
+
+        with self.assertRaises(ValueError):
+            destination.get_destination("nas:backups")
+
+        with self.assertRaises(ValueError):
+            destination.get_destination("nas:/backups", compress = "bz2")
+
+    def test_from_config(self):
+
+        config = configparser.ConfigParser()
+        config.read_string("[ssh]\nport=2222\ncompress=lz4\noptions=-o StrictHostKeyChecking=no\n")
+
+        dest = destination.from_config(config, "nas:/backups")
+        self.assertEqual(dest.port, 2222)
+        self.assertEqual(dest.compress, "lz4")
+        self.assertEqual(dest.ssh_options, ["-o", "StrictHostKeyChecking=no"])
+
+        self.assertFalse(destination.from_config(config, "/backups").remote)
+
+
+class TestSshDestination(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        patcher = mock.patch("snappy.destination.subprocess.run", return_value = completed())
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dest = destination.SshDestination("nas", "/backups", "bob", port = 2222, compress = "zstd")
+        self.addCleanup(self.dest.close)
+
+    def test_master_is_opened_once(self):
+
+        self.dest.exists("/backups")
+        self.dest.isdir("/backups")
+
+        cmds = [c.args[0] for c in self.run.call_args_list]
+        self.assertIn("ControlMaster=yes", cmds[0])
+        self.assertEqual(sum("ControlMaster=yes" in c for c in cmds), 1)
+        for cmd in cmds[1:]:
+            self.assertIn(f"ControlPath={self.dest.control_path}", cmd)
+
+    def test_commands_are_quoted(self):
+
+        self.dest.rmtree("/backups/a b; rm -rf /")
+        cmd = self.run.call_args.args[0]
+        self.assertEqual(cmd[-2:], ["bob@nas", "rm -rf -- '/backups/a b; rm -rf /'"])
+
+    def test_rsync_args(self):
+
+        args = self.dest.rsync_args()
+        self.assertEqual(args[0], "-e")
+        self.assertIn(f"ControlPath={self.dest.control_path}", args[1])
+        self.assertIn("-p 2222", args[1])
+        self.assertEqual(args[2:], ["--compress", "--compress-choice=zstd"])
+
+    def test_move_to_trash(self):
+
+        # - names as in prune.move_to_trash, the first one is taken
+
+        def run(cmd, **kws):
+            taken = cmd[-1] == "test -e /backups/.trash/2023-01-01-00_00_00"
+            return completed(0 if taken else 1) if cmd[-1].startswith("test -e") else completed()
+
+        self.dest.open()
+        self.run.side_effect = run
+        dst = self.dest.move_to_trash("/backups/2023-01-01-00_00_00")
+        self.assertEqual(dst, "/backups/.trash/2023-01-01-00_00_00.1")
+        self.assertEqual(self.run.call_args.args[0][-1], "mv -- /backups/2023-01-01-00_00_00 /backups/.trash/2023-01-01-00_00_00.1")
+
+    def test_errors(self):
+
+        self.dest.open()
+        self.run.return_value = completed(1, stderr = "cat: /backups/x: No such file or directory")
+        with self.assertRaises(FileNotFoundError):
+            self.dest.read_text("/backups/x")
+
+        self.run.return_value = completed(255, stderr = "Connection refused")
+        with self.assertRaises(destination.SshError):
+            self.dest.exists("/backups")
+
+    def test_connection_failure(self):
+
+        self.run.return_value = completed(255, stderr = "Connection refused")
+        with self.assertRaises(destination.SshError):
+            self.dest.open()
+
+        self.assertIsNone(self.dest.control_path)
+
+
+@unittest.skipIf(SSH_HOST is None, "SNAPPY_TEST_SSH is not set")
+class TestRemoteBackup(unittest.TestCase):
+
+    # - the sshd runs on this host, so the remote folder is a local
+    # - temporary folder reached over ssh
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.folder.name, "backups")
+        self.dest = destination.get_destination(f"{SSH_HOST}:{self.root}")
+
+    def tearDown(self) -> None:
+        self.dest.close()
+        self.folder.cleanup()
+
+    def test_file_operations(self):
+
+        with self.dest as dest:
+            dest.makedirs(dest.join("a", "b"))
+            self.assertTrue(dest.isdir(dest.join("a")))
+            self.assertEqual(dest.folders(dest.path), ["a"])
+
+            dest.write_text(dest.join("a", "file.txt"), "text")
+            self.assertEqual(dest.read_text(dest.join("a", "file.txt")), "text")
+
+            dest.move(dest.join("a"), dest.join("c"))
+            self.assertFalse(dest.exists(dest.join("a")))
+
+            dest.rmtree(dest.join("c"))
+            self.assertEqual(os.listdir(self.root), [])
+
+    @unittest.skipIf(shutil.which("rsync") is None, "rsync is not installed")
+    def test_snap_backup(self):
+
+        src = os.path.join(self.folder.name, "src")
+        os.makedirs(src)
+        with open(os.path.join(src, "a.txt"), "w") as f:
+            f.write("This is file A")
+
+        snp.snap_backup([src], self.dest, max_backups = 1)
+        time.sleep(1)
+        result = snp.snap_backup([src], self.dest, max_backups = 1)
+
+        self.assertEqual(snp.get_backup_folders(self.dest), [os.path.join(self.root, result.name)])
+        self.assertTrue(os.path.exists(os.path.join(self.root, result.name, "src", "a.txt")))
+        self.assertEqual(len(Catalog.load(self.root).snapshots()), 1)
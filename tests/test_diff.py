@@ -0,0 +1,94 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from snappy import diff
+from snappy.catalog import Catalog
+
+
+class TestDiff(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.backups = os.path.join(self.folder.name, "backups")
+        self.old = os.path.join(self.backups, "2023-01-01-00_00_00")
+        self.new = os.path.join(self.backups, "2023-01-02-00_00_00")
+        self.write(self.old, "same.txt", "Same")
+        self.write(self.old, "changed.txt", "Before")
+        self.write(self.old, "gone.txt", "Removed")
+        self.write(self.old, "old/x.txt", "Removed folder")
+        self.write(self.old, "C/D/deep.txt", "Deep")
+        self.write(self.old, "C/copy.txt", "Copy")
+        os.symlink("same.txt", os.path.join(self.old, "link"))
+
+        # - unchanged files are hard links, as rsync --link-dest makes them
+
+        for rel in ["same.txt", "C/D/deep.txt"]:
+            os.makedirs(os.path.dirname(os.path.join(self.new, rel)), exist_ok = True)
+            os.link(os.path.join(self.old, rel), os.path.join(self.new, rel))
+
+        shutil.copy2(os.path.join(self.old, "C", "copy.txt"), os.path.join(self.new, "C", "copy.txt"))
+        self.write(self.new, "changed.txt", "After", mtime = 1_700_000_000)
+        self.write(self.new, "C/D/added.txt", "Added")
+        self.write(self.new, "new/y.txt", "Added folder")
+        os.symlink("changed.txt", os.path.join(self.new, "link"))
+
+        catalog = Catalog(self.backups)
+        for name in [self.old, self.new]:
+            catalog.update(os.path.basename(name), status = "complete")
+        catalog.save()
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def write(self, root, rel, text, mtime = 1_600_000_000):
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, "w") as f:
+            f.write(text)
+        os.utime(path, (mtime, mtime))
+
+    def test_diff(self):
+
+        stats = diff.DiffStats()
+        entries = list(diff.diff(self.old, self.new, workers = 2, stats = stats))
+
+        # - depth first in name order: the entries under C come before
+        # - changed.txt
+
+        self.assertEqual([(e.status, e.path, e.kind) for e in entries], [
+            ("added", os.path.join("C", "D", "added.txt"), "file"),
+            ("modified", "changed.txt", "file"),
+            ("removed", "gone.txt", "file"),
+            ("modified", "link", "link"),
+            ("added", "new", "dir"),
+            ("removed", "old", "dir"),
+        ])
+        self.assertEqual(stats.to_dict(), {"added" : 2, "removed" : 2, "modified" : 2, "unchanged" : 0})
+
+        # - a copy with the same size and mtime is unchanged
+
+        listed = [e.path for e in diff.diff(self.old, self.new, workers = 1, unchanged = True)]
+        self.assertEqual(listed[:5], ["C", os.path.join("C", "D"), os.path.join("C", "D", "added.txt"), os.path.join("C", "D", "deep.txt"), os.path.join("C", "copy.txt")])
+
+        entries = {e.path : e.status for e in diff.diff(self.old, self.new, workers = 1, unchanged = True)}
+        self.assertEqual(entries[os.path.join("C", "copy.txt")], "unchanged")
+        self.assertEqual(entries["same.txt"], "unchanged")
+        self.assertEqual(entries["C"], "unchanged")
+
+    def test_format_entry(self):
+
+        entry = diff.DiffEntry("added", "new", "dir")
+        self.assertEqual(diff.format_entry(entry), f"+ new{os.path.sep}")
+        self.assertEqual(json.loads(diff.format_entry(entry, as_json = True)), {"status" : "added", "path" : "new", "kind" : "dir"})
+
+    def test_snapshot_folders(self):
+
+        self.assertEqual(diff.snapshot_folders(self.backups), (self.old, self.new))
+        self.assertEqual(diff.snapshot_folders(self.backups, new = "2023-01-02-00_00_00"), (self.old, self.new))
+        with self.assertRaises(ValueError):
+            diff.snapshot_folders(self.backups, new = "2023-01-01-00_00_00")
+        with self.assertRaises(ValueError):
+            diff.snapshot_folders(self.backups, "2023-01-05-00_00_00", "2023-01-02-00_00_00")
@@ -0,0 +1,159 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from snappy import fingerprint
+from snappy import snappy as snp
+
+
+class TestFingerprint(unittest.TestCase):
+
+    # - RACY_SECONDS is 0 so that a tree created by the test can be
+    # - trusted right away
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.folder.name, "src")
+        os.makedirs(os.path.join(self.src, "B"))
+        self.write("a.txt", "This is file A")
+        self.write("B/b.txt", "This is file B")
+
+        patcher = mock.patch.object(fingerprint, "RACY_SECONDS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        time.sleep(0.05)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def write(self, rel, text):
+        with open(os.path.join(self.src, rel), "w") as f:
+            f.write(text)
+
+    def digest(self):
+        fp = fingerprint.Fingerprint(self.src)
+        fp.compute()
+        self.assertFalse(fp.racy)
+        return fp
+
+    def test_unchanged(self):
+
+        fp = self.digest()
+        self.assertEqual(self.digest().digest, fp.digest)
+        self.assertEqual((fp.files, fp.size), (2, 28))
+
+    def test_changes(self):
+
+        digests = {self.digest().digest}
+        changes = [
+            lambda: self.write("B/b.txt", "This is file C"),
+            lambda: os.chmod(os.path.join(self.src, "a.txt"), 0o600),
+            lambda: os.rename(os.path.join(self.src, "a.txt"), os.path.join(self.src, "B", "a.txt")),
+            lambda: os.makedirs(os.path.join(self.src, "B", "C")),
+        ]
+
+        for change in changes:
+            change()
+            time.sleep(0.05)
+            digests.add(self.digest().digest)
+
+        self.assertEqual(len(digests), len(changes) + 1)
+
+    def test_racy(self):
+
+        with mock.patch.object(fingerprint, "RACY_SECONDS", 3600):
+            fp = fingerprint.Fingerprint(self.src)
+            fp.compute()
+
+        self.assertTrue(fp.racy)
+
+
+class TestFastPath(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.folder.name, "src")
+        self.backups = os.path.join(self.folder.name, "backups")
+        self.cache = os.path.join(self.folder.name, "cache")
+
+        os.makedirs(os.path.join(self.src, "B"))
+        with open(os.path.join(self.src, "B", "b.txt"), "w") as f:
+            f.write("This is file B")
+        os.symlink("B/b.txt", os.path.join(self.src, "link"))
+        os.chmod(os.path.join(self.src, "B"), 0o750)
+
+        # - the previous snapshot, as rsync would have made it
+
+        self.previous = os.path.join(self.backups, "2023-01-01-00_00_00")
+        os.makedirs(self.previous)
+        shutil.copytree(self.src, os.path.join(self.previous, "src"), symlinks = True)
+
+        patcher = mock.patch.object(fingerprint, "RACY_SECONDS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        time.sleep(0.05)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def fast_path(self, previous = None, args = None):
+        return fingerprint.FastPath(self.backups, previous, args, cache_dir = self.cache)
+
+    def test_unchanged_source_is_linked(self):
+
+        fp = self.fast_path(args = ["--exclude=x"])
+        self.assertEqual(fp.check(self.src), (None, "there is no previous snapshot"))
+        fp.commit("2023-01-01-00_00_00")
+
+        dst = os.path.join(self.backups, "tmp")
+        os.makedirs(dst)
+        fp = self.fast_path("2023-01-01-00_00_00", ["--exclude=x", "--link-dest=/x"])
+        with mock.patch("snappy.snappy.rsync") as rsync:
+            stats = snp.create_snapshot([self.src], dst, fast_path = fp)
+
+        rsync.assert_not_called()
+        self.assertEqual(stats[0].files, 1)
+
+        old = os.path.join(self.previous, "src")
+        new = os.path.join(dst, "src")
+        self.assertEqual(os.stat(os.path.join(new, "B", "b.txt")).st_ino, os.stat(os.path.join(old, "B", "b.txt")).st_ino)
+        self.assertEqual(os.readlink(os.path.join(new, "link")), "B/b.txt")
+        self.assertEqual(os.stat(os.path.join(new, "B")).st_mode, os.stat(os.path.join(old, "B")).st_mode)
+        self.assertEqual(os.stat(os.path.join(new, "B")).st_mtime_ns, os.stat(os.path.join(old, "B")).st_mtime_ns)
+
+    def test_changed_source(self):
+
+        fp = self.fast_path()
+        fp.check(self.src)
+        fp.commit("2023-01-01-00_00_00")
+
+        with open(os.path.join(self.src, "B", "b.txt"), "a") as f:
+            f.write("changed")
+        time.sleep(0.05)
+
+        old, reason = self.fast_path("2023-01-01-00_00_00").check(self.src)
+        self.assertIsNone(old)
+        self.assertEqual(reason, "it changed since the previous snapshot")
+
+    def test_changed_options(self):
+
+        fp = self.fast_path(args = ["--exclude=x"])
+        fp.check(self.src)
+        fp.commit("2023-01-01-00_00_00")
+
+        old, reason = self.fast_path("2023-01-01-00_00_00", ["--exclude=y"]).check(self.src)
+        self.assertIsNone(old)
+        self.assertEqual(reason, "the rsync options changed")
+
+    def test_other_snapshot(self):
+
+        fp = self.fast_path()
+        fp.check(self.src)
+        fp.commit("2022-12-31-00_00_00")
+
+        old, reason = self.fast_path("2023-01-01-00_00_00").check(self.src)
+        self.assertIsNone(old)
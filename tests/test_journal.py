@@ -0,0 +1,215 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from snappy import inotify
+from snappy import journal
+from snappy import snappy as snp
+
+
+@unittest.skipUnless(inotify.is_supported(), "inotify is not available")
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.folder.name, "src")
+        self.cache = os.path.join(self.folder.name, "cache")
+        os.makedirs(os.path.join(self.src, "B"))
+
+        self.watcher = journal.Watcher([self.src], self.cache, flush_interval = 0.05)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target = self.watcher.run, args = (self.stop,))
+        self.thread.start()
+        self.journal = journal.Journal(self.src, self.cache)
+        self.wait(lambda: (self.journal.state() or {}).get("ready"))
+
+    def tearDown(self) -> None:
+
+        self.stop.set()
+        self.thread.join()
+        self.folder.cleanup()
+
+    def wait(self, condition):
+
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.02)
+
+    def changes(self, *expected):
+        self.wait(lambda: all(rel in self.journal.read(0, self.journal.size())[0] for rel in expected))
+        return self.journal.read(0, self.journal.size())[0]
+
+    def test_changes_are_recorded(self):
+
+        with open(os.path.join(self.src, "B", "b.txt"), "w") as f:
+            f.write("This is file B")
+        os.makedirs(os.path.join(self.src, "C", "D"))
+
+        changes = self.changes("B/b.txt", "C")
+        self.assertEqual(changes["B/b.txt"], journal.CHANGED)
+        self.assertEqual(changes["C"], journal.TREE)
+
+        # - the new folders are watched as well
+
+        with open(os.path.join(self.src, "C", "D", "d.txt"), "w") as f:
+            f.write("This is file D")
+        self.changes("C/D/d.txt")
+
+    def test_renamed_folder(self):
+
+        os.rename(os.path.join(self.src, "B"), os.path.join(self.src, "E"))
+        self.changes("B", "E")
+
+        with open(os.path.join(self.src, "E", "e.txt"), "w") as f:
+            f.write("This is file E")
+        self.changes("E/e.txt")
+
+    def test_overflow(self):
+
+        # - events are lost while a folder is created, then the kernel
+        # - queue overflows. The new folder is watched afterwards
+
+        lost = threading.Event()
+        lost.set()
+        handle = self.watcher._handle
+
+        def lossy(event):
+            if lost.is_set():
+                return None
+            self.watcher._handle = handle
+            handle(inotify.Event(-1, inotify.IN_Q_OVERFLOW, 0, ""))
+            handle(event)
+
+        epoch = self.journal.state()["epoch"]
+        self.watcher._handle = lossy
+        os.makedirs(os.path.join(self.src, "C", "D"))
+        time.sleep(0.2)
+
+        lost.clear()
+        with open(os.path.join(self.src, "B", "b.txt"), "w") as f:
+            f.write("This is file B")
+        self.wait(lambda: self.journal.state()["epoch"] != epoch and self.journal.state()["ready"])
+
+        with open(os.path.join(self.src, "C", "D", "d.txt"), "w") as f:
+            f.write("This is file D")
+        self.changes("C/D/d.txt")
+
+    def test_stopped_watcher_is_not_ready(self):
+
+        epoch = self.journal.state()["epoch"]
+        self.stop.set()
+        self.thread.join()
+
+        state = self.journal.state()
+        self.assertFalse(state["ready"])
+        self.assertEqual(state["epoch"], epoch)
+        self.assertFalse(journal.JournalPath(self.folder.name, cache_dir = self.cache).mark(self.src))
+
+
+class TestJournalPath(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.folder.name, "src")
+        self.backups = os.path.join(self.folder.name, "backups")
+        self.cache = os.path.join(self.folder.name, "cache")
+        os.makedirs(os.path.join(self.src, "B"))
+        os.makedirs(os.path.join(self.backups, "2023-01-01-00_00_00", "src"))
+
+        # - a journal written by a watcher, which is this process
+
+        self.journal = journal.Journal(self.src, self.cache)
+        self.journal.reset(os.getpid(), ready = True)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def journal_path(self, previous = None, args = None):
+        jp = journal.JournalPath(self.backups, previous, args, cache_dir = self.cache)
+        self.assertTrue(jp.mark(self.src))
+        return jp
+
+    def test_changes_since_previous_snapshot(self):
+
+        self.journal.append({"a.txt" : journal.CHANGED})
+        jp = self.journal_path()
+        self.assertEqual(jp.check(self.src), (None, None, "there is no previous snapshot"))
+        jp.commit("2023-01-01-00_00_00")
+
+        self.journal.append({"B/b.txt" : journal.CHANGED, "C" : journal.TREE})
+        self.journal.append({"C" : journal.CHANGED})
+        old, changes, _ = self.journal_path("2023-01-01-00_00_00").check(self.src)
+        self.assertEqual(old, os.path.join(self.backups, "2023-01-01-00_00_00", "src"))
+        self.assertEqual(changes, {"B/b.txt" : journal.CHANGED, "C" : journal.TREE})
+
+    def test_restarted_journal(self):
+
+        self.journal_path().commit("2023-01-01-00_00_00")
+        self.journal.reset(os.getpid(), ready = True)
+
+        old, changes, reason = self.journal_path("2023-01-01-00_00_00").check(self.src)
+        self.assertIsNone(old)
+        self.assertEqual(reason, "its journal started over since the previous snapshot")
+
+    def test_changed_options(self):
+
+        self.journal_path(args = ["--exclude=x"]).commit("2023-01-01-00_00_00")
+        old, _, reason = self.journal_path("2023-01-01-00_00_00", ["--exclude=y"]).check(self.src)
+        self.assertIsNone(old)
+        self.assertEqual(reason, "the rsync options changed")
+
+    def test_watcher_not_running(self):
+
+        self.journal.set_ready(False)
+        jp = journal.JournalPath(self.backups, "2023-01-01-00_00_00", cache_dir = self.cache)
+        self.assertFalse(jp.mark(self.src))
+        self.assertEqual(jp.check(self.src)[2], "snappy watch is not running for it")
+
+
+class TestChangedEntries(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.folder.name, "src")
+        self.target = os.path.join(self.folder.name, "target")
+        os.makedirs(os.path.join(self.src, "B"))
+        self.write("a.txt", "This is file A")
+        self.write("B/b.txt", "This is file B")
+        shutil.copytree(self.src, self.target)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def write(self, rel, text):
+        with open(os.path.join(self.src, rel), "w") as f:
+            f.write(text)
+
+    def test_changed_paths_are_removed_and_sent(self):
+
+        self.write("B/b.txt", "This is file C")
+        os.remove(os.path.join(self.src, "a.txt"))
+        os.makedirs(os.path.join(self.src, "D", "E"))
+        self.write("D/E/e.txt", "This is file E")
+
+        changes = {"B/b.txt" : journal.CHANGED, "a.txt" : journal.CHANGED, "D" : journal.TREE}
+        entries = snp._changed_entries(self.src, self.target, changes)
+
+        self.assertEqual(entries, ["", "B", "B/b.txt", "D", "D/E", "D/E/e.txt"])
+        self.assertFalse(os.path.exists(os.path.join(self.target, "a.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.target, "B", "b.txt")))
+        self.assertTrue(os.path.isdir(os.path.join(self.target, "B")))
+
+    def test_deleted_folder(self):
+
+        shutil.rmtree(os.path.join(self.src, "B"))
+        changes = {"B" : journal.CHANGED, "B/b.txt" : journal.CHANGED}
+        entries = snp._changed_entries(self.src, self.target, changes)
+
+        self.assertEqual(entries, [""])
+        self.assertFalse(os.path.exists(os.path.join(self.target, "B")))
@@ -0,0 +1,202 @@
+import io
+import os
+import gzip
+import logging
+import tempfile
+import unittest
+import unittest.mock
+from snappy import logs
+
+
+class TestCompressedFileHandler(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.logger = logging.getLogger("snappy.tests.logs")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self) -> None:
+
+        for hl in list(self.logger.handlers):
+            self.logger.removeHandler(hl)
+            hl.close()
+
+        self.folder.cleanup()
+
+    def handler(self, compression = "gzip", name = "run"):
+
+        file = os.path.join(self.folder.name, name + logs.extension(compression))
+        hl = logs.CompressedFileHandler(file, compression, flush_interval = 3600)
+        self.logger.addHandler(hl)
+        return hl
+
+    def test_file_created_on_first_record(self):
+
+        hl = self.handler()
+        self.assertFalse(os.path.exists(hl.baseFilename))
+
+        self.logger.info("first")
+        self.assertTrue(os.path.exists(hl.baseFilename))
+
+    def test_gzip_and_rename(self):
+
+        hl = self.handler()
+        self.logger.info("before rename")
+        hl.rename(os.path.join(self.folder.name, "snapshot.log.gz"))
+        self.logger.info("after rename")
+        hl.close()
+
+        self.assertEqual(os.listdir(self.folder.name), ["snapshot.log.gz"])
+        with gzip.open(hl.baseFilename, "rt") as f:
+            self.assertEqual(f.read(), "before rename\nafter rename\n")
+
+    def test_partial_stream_is_readable(self):
+
+        # - the handler is never closed, as if the process was killed,
+        # - but the warning forces a flush
+
+        hl = self.handler()
+        self.logger.info("info line")
+        self.logger.warning("warning line")
+        self.logger.info("not flushed")
+
+        text = logs.read_log(hl.baseFilename)
+        self.assertEqual(text, "info line\nwarning line\n")
+
+    def test_no_compression(self):
+
+        hl = self.handler("none")
+        self.logger.info("plain")
+        hl.close()
+
+        self.assertTrue(hl.baseFilename.endswith(".log"))
+        self.assertEqual(logs.read_log(hl.baseFilename), "plain\n")
+
+    @unittest.skipIf(logs.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+
+        hl = self.handler("zstd")
+        self.logger.warning("compressed")
+        self.assertEqual(logs.read_log(hl.baseFilename), "compressed\n")
+
+    def test_invalid_compression(self):
+        with self.assertRaises(ValueError):
+            logs.CompressedFileHandler(os.path.join(self.folder.name, "x"), "bz2")
+
+
+class TestQueueHandler(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.logger = logging.getLogger("snappy.tests.queue")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self) -> None:
+        for hl in list(self.logger.handlers):
+            self.logger.removeHandler(hl)
+            hl.close()
+
+    def test_records_are_written_in_order(self):
+
+        stream = io.StringIO()
+        info = logging.StreamHandler(stream)
+        warning = logging.StreamHandler(io.StringIO())
+        warning.setLevel(logging.WARNING)
+
+        qhl = logs.QueueHandler([info, warning], batch_size = 7)
+        self.logger.addHandler(qhl)
+        for idx in range(100):
+            self.logger.info(f"line {idx}")
+        self.logger.warning("done")
+
+        qhl.flush()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines, [f"line {idx}" for idx in range(100)] + ["done"])
+        self.assertEqual(warning.stream.getvalue(), "done\n")
+
+    def test_handlers_flush_on_request(self):
+
+        # - batches do not flush the handlers, e.g. a compressed file
+        # - flushes on its own interval. flush does
+
+        class Counting(logging.Handler):
+            flushes = 0
+            def emit(self, record):
+                pass
+            def flush(self):
+                Counting.flushes += 1
+
+        qhl = logs.QueueHandler([Counting()], batch_size = 7)
+        self.logger.addHandler(qhl)
+        for idx in range(100):
+            self.logger.info(f"line {idx}")
+
+        qhl.flush()
+        self.assertEqual(Counting.flushes, 1)
+
+    def test_close_writes_pending_records(self):
+
+        stream = io.StringIO()
+        qhl = logs.QueueHandler([logging.StreamHandler(stream)])
+        self.logger.addHandler(qhl)
+        self.logger.info("pending")
+
+        self.logger.removeHandler(qhl)
+        qhl.close()
+        self.assertEqual(stream.getvalue(), "pending\n")
+
+
+    @unittest.mock.patch("logging.raiseExceptions", False)
+    def test_failing_handler(self):
+
+        # - e.g. a full disk: the other handlers still get the records
+        # - and flush does not wait forever
+
+        class FullDisk(logging.Handler):
+            def emit(self, record):
+                raise OSError(28, "No space left on device")
+            def flush(self):
+                raise OSError(28, "No space left on device")
+
+        stream = io.StringIO()
+        qhl = logs.QueueHandler([FullDisk(), logging.StreamHandler(stream)])
+        self.logger.addHandler(qhl)
+        self.logger.info("first")
+        qhl.flush()
+        self.logger.info("second")
+        qhl.flush()
+        self.assertEqual(stream.getvalue(), "first\nsecond\n")
+        self.assertTrue(qhl._thread.is_alive())
+
+    def test_dead_writer(self):
+
+        # - records are written by the caller once the thread is gone
+
+        stream = io.StringIO()
+        qhl = logs.QueueHandler([logging.StreamHandler(stream)])
+        qhl.queue.put(None)
+        qhl._thread.join()
+
+        self.logger.addHandler(qhl)
+        self.logger.info("direct")
+        qhl.flush()
+        self.assertEqual(stream.getvalue(), "direct\n")
+
+
+class TestSummaryStreamHandler(unittest.TestCase):
+
+    def test_rsync_lines_are_collapsed(self):
+
+        stream = io.StringIO()
+        hl = logs.SummaryStreamHandler(stream, collapse = "snappy.rsync", interval = 3600)
+
+        for idx in range(10):
+            hl.handle(logging.LogRecord("snappy.rsync", logging.INFO, "", 0, f"file{idx}", None, None))
+        hl.handle(logging.LogRecord("snappy.snappy", logging.INFO, "", 0, "backed up", None, None))
+        hl.close()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines, ["1 rsync lines, last: file0", "10 rsync lines, last: file9", "backed up"])
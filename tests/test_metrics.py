@@ -0,0 +1,95 @@
+import os
+import datetime
+import configparser
+import tempfile
+import unittest
+from unittest import mock
+from snappy import metrics
+from snappy import stats
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.folder.name, "prom", "snappy.prom")
+
+        start = datetime.datetime(2023, 1, 1, 0, 0, 0)
+        end = start + datetime.timedelta(seconds = 10)
+        src = stats.TransferStats('/home/user/we"ird')
+        src.seconds = 8.5
+        src.transferred_size = 2048
+        src.total_size = 4096
+
+        self.result = stats.SnapshotResult("2023-01-01-00_00_00", self.folder.name, start, end, False, [src])
+        self.result.phases = {"snapshot" : 10.0, "finalize" : 0.5, "prune" : 1.25}
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def read(self):
+        with open(self.file, "r") as f:
+            return f.read()
+
+    def test_record_success(self):
+
+        metrics.record_success(self.file, self.result, snapshots = 3)
+        text = self.read()
+
+        self.assertIn("# TYPE snappy_last_success_timestamp_seconds gauge", text)
+        self.assertIn('snappy_phase_duration_seconds{phase="prune"} 1.25', text)
+        self.assertIn('snappy_source_transferred_bytes{source="/home/user/we\\"ird"} 2048', text)
+        self.assertIn("snappy_transferred_bytes 2048", text)
+        self.assertIn("snappy_snapshots 3", text)
+        self.assertIn("snappy_prune_duration_seconds 1.25", text)
+        self.assertIn("snappy_backup_root_free_bytes ", text)
+        self.assertEqual(os.listdir(os.path.dirname(self.file)), ["snappy.prom"])
+
+    def test_disk_usage_error(self):
+
+        # - the gauges are left out, the rest is written
+
+        metrics.record_success(self.file, self.result)
+        with mock.patch("snappy.metrics.shutil.disk_usage", side_effect = PermissionError("Permission denied")):
+            metrics.record_success(self.file, self.result, snapshots = 3)
+
+        text = self.read()
+        self.assertIn("snappy_snapshots 3", text)
+        self.assertNotIn("snappy_backup_root_free_bytes", text)
+
+    def test_failures_are_counted(self):
+
+        metrics.record_success(self.file, self.result)
+        metrics.record_failure(self.file, 2)
+        metrics.record_failure(self.file, 2)
+        metrics.record_failure(self.file, 1)
+        text = self.read()
+
+        self.assertIn('snappy_failures_total{code="1"} 1', text)
+        self.assertIn('snappy_failures_total{code="2"} 2', text)
+
+        # - the last success survives failed runs
+
+        self.assertIn("snappy_last_success_timestamp_seconds ", text)
+
+    def test_sources_are_replaced(self):
+
+        metrics.record_success(self.file, self.result)
+        self.result.sources[0].source = "/other"
+        metrics.record_success(self.file, self.result)
+        text = self.read()
+
+        self.assertIn('snappy_source_duration_seconds{source="/other"} 8.5', text)
+        self.assertNotIn("we\\\"ird", text)
+
+    def test_textfile_config(self):
+
+        config = configparser.ConfigParser()
+        self.assertIsNone(metrics.textfile(config))
+
+        config.read_string("[metrics]\ntextfile=\n")
+        self.assertIsNone(metrics.textfile(config))
+
+        config.read_string("[metrics]\ntextfile=/tmp/snappy.prom\n")
+        self.assertEqual(metrics.textfile(config), "/tmp/snappy.prom")
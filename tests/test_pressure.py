@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import threading
+import subprocess
+import configparser
+from unittest import mock
+from snappy import pressure
+from snappy import rsync
+
+
+class FakeGate(pressure.PressureGate):
+
+    # - the pressure is high while `high` is True
+
+    def __init__(self, **kws) -> None:
+        self.high = True
+        super().__init__(load = 1, interval = 0.05, **kws)
+
+    def reasons(self):
+        return ["fake pressure"] if self.high else []
+
+
+def process_state(pid):
+    with open(f"/proc/{pid}/stat", "r") as f:
+        return f.read().rsplit(")", 1)[1].split()[0]
+
+
+class TestPressure(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def test_read_psi(self):
+
+        with open(os.path.join(self.folder.name, "io"), "w") as f:
+            f.write("some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n")
+            f.write("full avg10=2.00 avg60=1.00 avg300=0.50 total=50\n")
+
+        with mock.patch.object(pressure, "PSI_LOC", self.folder.name):
+            self.assertEqual(pressure.read_psi("io"), 12.5)
+            self.assertIsNone(pressure.read_psi("cpu"))
+
+            gate = pressure.PressureGate(io = 10)
+            self.assertEqual(gate.reasons(), ["io pressure 12.5% > 10%"])
+
+            gate = pressure.PressureGate(io = 20)
+            self.assertEqual(gate.reasons(), [])
+
+    def test_from_config(self):
+
+        config = configparser.ConfigParser()
+        config.read_string("[pressure]\nio=\ncpu=\nload=\ninterval=1\n")
+        self.assertIsNone(pressure.PressureGate.from_config(config))
+
+        config.read_string("[pressure]\nload=2\ninterval=0.5\nmax_pause=60\n")
+        gate = pressure.PressureGate.from_config(config)
+        self.assertEqual((gate.load, gate.interval, gate.max_pause), (2, 0.5, 60))
+
+        config.read_string("[pressure]\nload=-1\n")
+        with self.assertRaises(ValueError):
+            pressure.PressureGate.from_config(config)
+
+    def test_wait(self):
+
+        gate = FakeGate()
+        watch = gate.watch()
+
+        def release():
+            time.sleep(0.2)
+            gate.high = False
+
+        thread = threading.Thread(target = release)
+        thread.start()
+        watch.wait()
+        thread.join()
+
+        self.assertGreaterEqual(watch.waited, 0.2)
+        self.assertEqual(watch.stopped, 0)
+
+    def test_max_pause(self):
+
+        watch = FakeGate(max_pause = 0.1).watch()
+        watch.wait()
+        self.assertLess(watch.waited, 1)
+
+    def test_stop_and_continue(self):
+
+        gate = FakeGate()
+        proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"], start_new_session = True)
+        watch = gate.watch()
+        try:
+            watch.attach(proc)
+            time.sleep(0.3)
+            self.assertEqual(process_state(proc.pid), "T")
+
+            gate.high = False
+            time.sleep(0.3)
+            self.assertNotEqual(process_state(proc.pid), "T")
+        finally:
+            watch.detach()
+            proc.kill()
+            proc.wait()
+
+        self.assertGreater(watch.stopped, 0.1)
+
+    def test_detach_continues_stopped_process(self):
+
+        gate = FakeGate()
+        proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"], start_new_session = True)
+        watch = gate.watch()
+        try:
+            watch.attach(proc)
+            time.sleep(0.3)
+            watch.detach()
+            self.assertNotEqual(process_state(proc.pid), "T")
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def test_remote_transfers_are_not_paused(self):
+
+        watch = FakeGate().watch()
+        self.assertIsNone(rsync._pausable(watch, "user@host:/backups/"))
+        self.assertIs(rsync._pausable(watch, self.folder.name), watch)
@@ -0,0 +1,150 @@
+import os
+import stat
+import time
+import fcntl
+import tempfile
+import unittest
+from unittest import mock
+from snappy import cli
+from snappy import prune
+from snappy import snappy as snp
+from snappy.lock import DestinationLock
+
+
+class TestPrune(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = self.folder.name
+
+        # - `snappy prune` started in the background inherits the home
+        # - and writes its log there
+
+        self.home = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict(os.environ, {"HOME" : self.home.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ["2023-01-01-00_00_00", "2023-01-02-00_00_00", "2023-01-03-00_00_00"]:
+            path = os.path.join(self.root, name, "a", "b")
+            os.makedirs(path)
+            for idx in range(5):
+                with open(os.path.join(path, f"f{idx}.txt"), "w") as f:
+                    f.write("x" * 5000)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+        self.home.cleanup()
+
+    def test_remove_tree(self):
+
+        path = os.path.join(self.root, "2023-01-01-00_00_00")
+        stats = prune.remove_tree(path, workers = 2)
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(stats.inodes, 5 + 3)
+        self.assertGreater(stats.bytes, 0)
+        self.assertEqual(stats.folders, 1)
+
+    def test_remove_tree_hard_links(self):
+
+        # - bytes are only freed when the last link goes away
+
+        old = os.path.join(self.root, "2023-01-01-00_00_00", "a", "b", "f0.txt")
+        new = os.path.join(self.root, "2023-01-02-00_00_00", "a", "b", "linked.txt")
+        os.link(old, new)
+
+        path = os.path.join(self.root, "2023-01-01-00_00_00")
+        stats = prune.remove_tree(path)
+        full = prune.remove_tree(os.path.join(self.root, "2023-01-03-00_00_00"))
+
+        self.assertLess(stats.bytes, full.bytes)
+        self.assertEqual(stats.inodes, full.inodes - 1)
+        self.assertTrue(os.path.exists(new))
+
+    def test_remove_tree_read_only(self):
+
+        path = os.path.join(self.root, "2023-01-01-00_00_00")
+        os.chmod(os.path.join(path, "a", "b"), stat.S_IRUSR | stat.S_IXUSR)
+        os.chmod(os.path.join(path, "a"), 0)
+
+        prune.remove_tree(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_remove_tree_rate_limit(self):
+
+        # - 8 inodes at 40 per second take at least 7 intervals
+
+        path = os.path.join(self.root, "2023-01-01-00_00_00")
+        start = time.monotonic()
+        stats = prune.remove_tree(path, workers = 4, limiter = prune.RateLimiter(40))
+
+        self.assertEqual(stats.inodes, 8)
+        self.assertGreaterEqual(time.monotonic() - start, 7 / 40)
+        self.assertFalse(os.path.exists(path))
+
+    def test_trash_is_not_a_backup(self):
+
+        path = os.path.join(self.root, "2023-01-01-00_00_00")
+        moved = prune.move_to_trash(self.root, path)
+
+        self.assertTrue(os.path.exists(moved))
+        self.assertEqual(len(snp.get_backup_folders(self.root)), 2)
+
+    def test_move_to_trash_name_clash(self):
+
+        os.makedirs(os.path.join(prune.trash_loc(self.root), "2023-01-01-00_00_00"))
+        moved = prune.move_to_trash(self.root, os.path.join(self.root, "2023-01-01-00_00_00"))
+        self.assertEqual(os.path.basename(moved), "2023-01-01-00_00_00.1")
+
+    def test_clean_backups_deferred(self):
+
+        snp.clean_backups(self.root, 1, mode = "deferred")
+        self.assertEqual(len(snp.get_backup_folders(self.root)), 1)
+        self.assertEqual(len(os.listdir(prune.trash_loc(self.root))), 2)
+
+        stats = prune.reap(self.root)
+        self.assertEqual(stats.folders, 2)
+        self.assertEqual([f for f in os.listdir(prune.trash_loc(self.root)) if not f.startswith(".")], [])
+
+    def test_clean_backups_background(self):
+
+        snp.clean_backups(self.root, 1, mode = "deferred")
+        proc = prune.reap_in_background(self.root, workers = 2, max_rate = 1000)
+        proc.wait(timeout = 60)
+
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual([f for f in os.listdir(prune.trash_loc(self.root)) if not f.startswith(".")], [])
+
+    def test_reap_is_locked(self):
+
+        snp.clean_backups(self.root, 1, mode = "deferred")
+        with open(os.path.join(prune.trash_loc(self.root), ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = prune.reap(self.root)
+
+        self.assertEqual(stats.folders, 0)
+        self.assertEqual(len(os.listdir(prune.trash_loc(self.root))), 3)
+
+    @mock.patch("snappy.cli._configure_logger")
+    def test_prune_is_locked(self, _):
+
+        # - a stale temporary folder is only trashed while no snapshot
+        # - of the folder is running. The trash is deleted anyway
+
+        snp.clean_backups(self.root, 2, mode = "deferred")
+        stale = os.path.join(self.root, snp.tmp_name("2023-01-04-00_00_00"))
+        os.makedirs(stale)
+
+        with DestinationLock(snp.get_destination(self.root)):
+            cli.run_prune(False, self.root, workers = 1, max_rate = 0)
+        self.assertTrue(os.path.isdir(stale))
+        self.assertEqual([f for f in os.listdir(prune.trash_loc(self.root)) if not f.startswith(".")], [])
+
+        cli.run_prune(False, self.root, workers = 1, max_rate = 0)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_invalid_mode(self):
+
+        with self.assertRaises(ValueError):
+            snp.clean_backups(self.root, 1, mode = "later")
@@ -0,0 +1,47 @@
+import os
+import sys
+import subprocess
+import configparser
+import unittest
+from snappy.resources import Resources
+
+
+class TestResources(unittest.TestCase):
+
+    def config(self, text):
+        config = configparser.ConfigParser()
+        config.read_string(text)
+        return config
+
+    def test_empty_section(self):
+
+        res = Resources.from_config(self.config("[resources]\nnice=\nbwlimit=\n"))
+        self.assertIsNone(res.nice)
+        self.assertEqual(res.rsync_args(), [])
+
+        res = Resources.from_config(self.config(""))
+        self.assertIsNone(res.max_delete_rate)
+
+    def test_values(self):
+
+        res = Resources.from_config(self.config(
+            "[resources]\nnice=10\nionice_class=idle\nbwlimit=20m\nmax_delete_rate=500\n"
+        ))
+        self.assertEqual(res.nice, 10)
+        self.assertEqual(res.ionice_class, "idle")
+        self.assertEqual(res.rsync_args(), ["--bwlimit=20m"])
+        self.assertEqual(res.max_delete_rate, 500.0)
+
+    def test_invalid_values(self):
+
+        for text in ["nice=20", "nice=x", "ionice_class=fast", "ionice_level=8", "bwlimit=fast", "max_delete_rate=0"]:
+            with self.assertRaises(ValueError):
+                Resources.from_config(self.config(f"[resources]\n{text}\n"))
+
+    def test_apply_nice(self):
+
+        # - run in a child process so that the test runner keeps its priority
+
+        code = "import os; from snappy.resources import Resources; Resources(nice = 15).apply(); print(os.nice(0))"
+        out = subprocess.run([sys.executable, "-c", code], stdout = subprocess.PIPE, cwd = os.getcwd())
+        self.assertEqual(out.stdout.decode().strip(), "15")
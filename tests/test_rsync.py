@@ -2,7 +2,11 @@ import os
 import filecmp
 import tempfile
 import unittest
+import sys
 import shutil
+import logging
+import subprocess
+from unittest import mock
 from snappy import rsync
 
 
@@ -85,3 +89,124 @@ class TestRsync(unittest.TestCase):
         expect = shutil.which("rsync") is not None
         output = rsync.is_rsync_installed()
         self.assertEqual(expect, output)
+
+    def test_pump_drains_both_streams(self):
+
+        # - a child writing a lot to stderr must not block and only
+        # - the tail of the output is kept
+
+        code = (
+            "import sys\n"
+            "for i in range(20000):\n"
+            "    sys.stderr.write(f'err {i}\\n')\n"
+            "    sys.stdout.write(f'out {i}\\n')\n"
+            "sys.exit(3)\n"
+        )
+
+        proc = subprocess.Popen([sys.executable, "-c", code], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        log = logging.getLogger("test_pump")
+        log.disabled = True
+        stdout, stderr = rsync._pump(proc, log, max_lines = 10)
+
+        self.assertEqual(proc.returncode, 3)
+        self.assertEqual(stderr.splitlines(), [f"err {i}" for i in range(19990, 20000)])
+        self.assertEqual(stdout.splitlines(), [f"out {i}" for i in range(19990, 20000)])
+
+
+VERSION_327 = """rsync  version 3.2.7  protocol version 31
+Copyright (C) 1996-2022 by Andrew Tridgell, Wayne Davison, and others.
+Web site: https://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, symlinks, symtimes, hardlinks, hardlink-specials,
+    xattrs, optional secluded-args, iconv, prealloc, stop-at, no crtimes
+Optimizations:
+    SIMD-roll, no asm-roll, openssl-crypto, no asm-MD5
+Checksum list:
+    xxh128 xxh3 xxh64 (xxhash) md5 md4 sha1 none
+Compress list:
+    zstd lz4 zlibx zlib none
+Daemon auth list:
+    sha512 sha256 sha1 md5 md4
+"""
+
+VERSION_313 = """rsync  version 3.1.3  protocol version 31
+Copyright (C) 1996-2018 by Andrew Tridgell, Wayne Davison, and others.
+Web site: http://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, hardlinks, symlinks, IPv6, batchfiles, inplace,
+    append, ACLs, xattrs, iconv, symtimes, prealloc
+"""
+
+
+class TestRsyncInfo(unittest.TestCase):
+
+    def test_parse(self):
+
+        info = rsync.RsyncInfo.parse("/usr/bin/rsync", VERSION_327)
+        self.assertEqual((info.version, info.protocol), ((3, 2, 7), 31))
+        self.assertEqual(info.compress, ["zstd", "lz4", "zlibx", "zlib", "none"])
+        self.assertEqual(info.best_checksum(), "xxh128")
+        self.assertTrue(info.progress2 and info.open_noatime)
+
+        old = rsync.RsyncInfo.parse("/usr/bin/rsync", VERSION_313)
+        self.assertEqual(old.version, (3, 1, 3))
+        self.assertEqual((old.compress, old.checksum), ([], []))
+        self.assertTrue(old.progress2)
+        self.assertFalse(old.open_noatime)
+
+    def test_select_options(self):
+
+        new = rsync.RsyncInfo.parse("/usr/bin/rsync", VERSION_327)
+        old = rsync.RsyncInfo.parse("/usr/bin/rsync", VERSION_313)
+        options = ["--compress", "--compress-choice=auto", "--checksum-choice=xxh3", "--open-noatime"]
+
+        with mock.patch("os.geteuid", return_value = 1000):
+            self.assertEqual(rsync.select_options(options, new), ["--compress", "--compress-choice=auto", "--checksum-choice=xxh3", "--open-noatime"])
+            self.assertEqual(rsync.select_options(["--compress-choice=brotli"], new), ["--compress-choice=zstd"])
+            self.assertEqual(rsync.select_options(options, old), ["--compress"])
+            self.assertEqual(rsync.select_options(["-a"], new), ["-a"])
+
+        with mock.patch("os.geteuid", return_value = 0):
+            self.assertEqual(rsync.select_options(["-a"], new), ["-a", "--open-noatime"])
+            self.assertEqual(rsync.select_options(["-a"], old), ["-a"])
+
+        # - nothing is known about an rsync whose version cannot be read
+
+        self.assertEqual(rsync.select_options(options, rsync.RsyncInfo("/usr/bin/rsync")), options)
+
+    def test_select_remote_options(self):
+
+        # - the remote rsync negotiates the choices and might not know
+        # - --open-noatime
+
+        new = rsync.RsyncInfo.parse("/usr/bin/rsync", VERSION_327)
+        options = ["--compress", "--compress-choice=auto", "--checksum-choice=brotli"]
+
+        with mock.patch("os.geteuid", return_value = 0):
+            self.assertEqual(rsync.select_options(options, new, remote = True), ["--compress", "--compress-choice=auto", "--checksum-choice=auto"])
+            self.assertEqual(rsync.select_options(["--compress-choice=lz4"], new, remote = True), ["--compress-choice=lz4"])
+            self.assertEqual(rsync.select_options(["-a"], new, remote = True), ["-a"])
+
+    def test_probe_is_cached(self):
+
+        # - a fake rsync that counts how many times it runs
+
+        with tempfile.TemporaryDirectory() as folder:
+            count = os.path.join(folder, "count")
+            binary = os.path.join(folder, "rsync")
+            with open(binary, "w") as f:
+                f.write(f"#!/bin/sh\necho x >> {count}\ncat <<'EOF'\n{VERSION_313}EOF\n")
+            os.chmod(binary, 0o755)
+
+            with mock.patch.dict(os.environ, {"PATH" : folder + os.pathsep + os.environ["PATH"]}), mock.patch.object(rsync, "_probed", {}):
+                info = rsync.probe(folder)
+                self.assertEqual(info.version, (3, 1, 3))
+                self.assertIs(rsync.probe(folder), info)
+
+            with mock.patch.dict(os.environ, {"PATH" : folder + os.pathsep + os.environ["PATH"]}), mock.patch.object(rsync, "_probed", {}):
+                self.assertEqual(rsync.probe(folder).version, (3, 1, 3))
+
+            with open(count) as f:
+                self.assertEqual(len(f.readlines()), 1)
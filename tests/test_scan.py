@@ -0,0 +1,169 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+from snappy import scan
+
+
+def fake_access(path, mode):
+
+    # - running as root makes every file readable, so we fake it
+
+    return not os.path.basename(path).startswith("bad")
+
+
+class TestExcludeMatcher(unittest.TestCase):
+
+    def test_name_pattern(self):
+
+        m = scan.ExcludeMatcher(["*.tmp"])
+        self.assertTrue(m.match("/a/b/file.tmp", False))
+        self.assertFalse(m.match("/a/b/file.txt", False))
+
+    def test_anchored_pattern(self):
+
+        m = scan.ExcludeMatcher(["/src/cache"])
+        self.assertTrue(m.match("/src/cache", True))
+        self.assertFalse(m.match("/other/src/cache", True))
+
+    def test_directory_pattern(self):
+
+        m = scan.ExcludeMatcher(["build/"])
+        self.assertTrue(m.match("/src/build", True))
+        self.assertFalse(m.match("/src/build", False))
+
+    def test_star_does_not_cross_folders(self):
+
+        m = scan.ExcludeMatcher(["/src/*.log", "/deep/**/x"])
+        self.assertTrue(m.match("/src/a.log", False))
+        self.assertFalse(m.match("/src/sub/a.log", False))
+        self.assertTrue(m.match("/deep/a/b/c/x", False))
+
+    def test_empty(self):
+
+        m = scan.ExcludeMatcher(["", "  "])
+        self.assertFalse(m)
+
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.folder.name, "src")
+        files = [
+            "a.txt",
+            "bad1.txt",
+            "B/b.txt",
+            "B/bad2.txt",
+            "B/C/bad3.txt",
+            "skip/bad4.txt",
+            "bad_folder/x.txt",
+        ]
+        for f in files:
+            path = os.path.join(self.src, f)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path, "w") as fw:
+                fw.write(f)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    @unittest.mock.patch("snappy.scan.os.access", side_effect = fake_access)
+    def test_non_readable(self, mock):
+
+        found = set(scan.iter_non_readable(self.src))
+        expect = {"/bad1.txt", "/B/bad2.txt", "/B/C/bad3.txt", "/skip/bad4.txt", "/bad_folder"}
+        self.assertEqual(found, expect)
+
+    @unittest.mock.patch("snappy.scan.os.access", side_effect = fake_access)
+    def test_excluded_subtree_not_scanned(self, mock):
+
+        found = set(scan.iter_non_readable(self.src, ["/src/skip", "C/"]))
+        self.assertEqual(found, {"/bad1.txt", "/B/bad2.txt", "/bad_folder"})
+
+        scanned = {os.path.dirname(c.args[0]) for c in mock.call_args_list}
+        self.assertNotIn(os.path.join(self.src, "skip"), scanned)
+
+    @unittest.mock.patch("snappy.scan.os.access", side_effect = fake_access)
+    def test_trailing_slash_anchor(self, mock):
+
+        found = set(scan.iter_non_readable(self.src + os.path.sep, ["/skip"]))
+        self.assertNotIn("/skip/bad4.txt", found)
+        self.assertIn("/B/bad2.txt", found)
+
+    def test_transfer_root(self):
+
+        self.assertEqual(scan.transfer_root("/a/b"), "/b")
+        self.assertEqual(scan.transfer_root("/a/b/"), "")
+
+
+@unittest.mock.patch("snappy.scan.RACY_SECONDS", 0)
+@unittest.mock.patch("snappy.scan.os.access", side_effect = fake_access)
+class TestNonReadableIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.folder.name, "cache")
+        self.src = os.path.join(self.folder.name, "src")
+        for f in ["a.txt", "bad1.txt", "B/b.txt", "B/C/bad2.txt"]:
+            path = os.path.join(self.src, f)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path, "w") as fw:
+                fw.write(f)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def index(self):
+        return scan.NonReadableIndex(self.src, cache_dir = self.cache)
+
+    def test_second_scan_reuses_folders(self, mock):
+
+        first = self.index()
+        self.assertEqual(set(first.scan()), {"/bad1.txt", "/B/C/bad2.txt"})
+        self.assertEqual(first.scanned, 3)
+        self.assertTrue(os.path.exists(first.path))
+
+        second = self.index()
+        self.assertEqual(set(second.scan()), {"/bad1.txt", "/B/C/bad2.txt"})
+        self.assertEqual(second.scanned, 0)
+        self.assertEqual(second.reused, 3)
+
+    def test_changed_folder_is_scanned(self, mock):
+
+        self.index().scan()
+        with open(os.path.join(self.src, "B", "bad3.txt"), "w") as f:
+            f.write("new")
+
+        index = self.index()
+        self.assertEqual(set(index.scan()), {"/bad1.txt", "/B/bad3.txt", "/B/C/bad2.txt"})
+        self.assertEqual(index.scanned, 1)
+
+    def test_rescan(self, mock):
+
+        self.index().scan()
+        index = self.index()
+        index.scan(rescan = True)
+        self.assertEqual(index.reused, 0)
+        self.assertEqual(index.scanned, 3)
+
+    def test_exclude_changes_invalidate(self, mock):
+
+        self.index().scan()
+        index = scan.NonReadableIndex(self.src, ["C/"], cache_dir = self.cache)
+        self.assertEqual(index.scan(), ["/bad1.txt"])
+        self.assertEqual(index.reused, 0)
+
+    def test_remove_old_indexes(self, mock):
+
+        self.index().scan()
+        old = scan.NonReadableIndex(os.path.join(self.folder.name, "removed"), cache_dir = self.cache)
+        with open(old.path, "w") as f:
+            f.write("{}")
+        os.utime(old.path, (0, 0))
+
+        self.assertEqual(scan.remove_old_indexes(self.cache), 1)
+        self.assertEqual(os.listdir(self.cache), [os.path.basename(self.index().path)])
+        self.assertEqual(scan.remove_old_indexes(os.path.join(self.folder.name, "missing")), 0)
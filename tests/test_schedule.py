@@ -0,0 +1,49 @@
+import datetime
+import unittest
+from snappy.schedule import Cron
+
+
+class TestCron(unittest.TestCase):
+
+    def test_fields(self):
+
+        cron = Cron("*/15 9-17 * * 1-5")
+        self.assertEqual(cron.minutes, {0, 15, 30, 45})
+        self.assertEqual(cron.hours, set(range(9, 18)))
+        self.assertEqual(cron.weekdays, {1, 2, 3, 4, 5})
+
+        self.assertEqual(Cron("0 0 * * 7").weekdays, {0})
+        self.assertEqual(Cron("@daily").minutes, {0})
+
+    def test_invalid(self):
+        for expr in ["* * * *", "60 * * * *", "a * * * *", "*/0 * * * *", "5-1 * * * *"]:
+            with self.assertRaises(ValueError):
+                Cron(expr)
+
+    def test_matches(self):
+
+        cron = Cron("30 2 * * 0")
+        self.assertTrue(cron.matches(datetime.datetime(2023, 1, 1, 2, 30)))
+        self.assertFalse(cron.matches(datetime.datetime(2023, 1, 2, 2, 30)))
+
+        # - either day field matches when both are restricted
+
+        cron = Cron("0 0 13 * 5")
+        self.assertTrue(cron.matches(datetime.datetime(2023, 1, 13)))
+        self.assertTrue(cron.matches(datetime.datetime(2023, 1, 6)))
+        self.assertFalse(cron.matches(datetime.datetime(2023, 1, 7)))
+
+        # - a stepped * is not a restriction, as in vixie cron
+
+        cron = Cron("0 0 */2 * 1")
+        self.assertTrue(cron.matches(datetime.datetime(2023, 1, 9)))
+        self.assertFalse(cron.matches(datetime.datetime(2023, 1, 3)))
+        self.assertFalse(cron.matches(datetime.datetime(2023, 1, 2)))
+
+    def test_next(self):
+
+        now = datetime.datetime(2023, 1, 31, 23, 59, 30)
+        self.assertEqual(Cron("* * * * *").next(now), datetime.datetime(2023, 2, 1, 0, 0))
+        self.assertEqual(Cron("0 3 1 * *").next(now), datetime.datetime(2023, 2, 1, 3, 0))
+        self.assertEqual(Cron("0 0 29 2 *").next(now), datetime.datetime(2024, 2, 29, 0, 0))
+        self.assertIsNone(Cron("0 0 31 2 *").next(now))
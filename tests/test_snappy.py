@@ -2,9 +2,11 @@ import os
 import sys
 import time
 import stat
+import socket
 import unittest
 import tempfile
 import filecmp
+import subprocess
 import unittest.mock
 from snappy import snappy as snp
 
@@ -14,7 +16,7 @@ class TestFolders(unittest.TestCase):
     def setUp(self) -> None:
         
         self.folder = tempfile.TemporaryDirectory()
-        self.folders = ["a", "b", "c", "e", "g"]
+        self.folders = [f"2024-01-0{d}-00_00_00" for d in [1, 2, 3, 5, 7]]
         self.files = ["d", "f"]
 
         for f in self.folders:
@@ -62,9 +64,44 @@ class TestFolders(unittest.TestCase):
         for f in fl[:size]:
             self.assertTrue(os.path.exists(os.path.join(self.folder.name, f)))
 
-        for f in fl[size]:
+        for f in fl[size:]:
             self.assertFalse(os.path.exists(os.path.join(self.folder.name, f)))
 
+    def test_clean_backups_stale_snapshots(self):
+
+        # - a killed snapshot, a running one and a folder left behind
+        # - by a crash without a catalog entry
+
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+
+        catalog = snp.Catalog.load(self.folder.name)
+        for name, pid in [("2023-01-01-00_00_00", dead.pid), ("2023-01-02-00_00_00", os.getpid())]:
+            catalog.update(name, status = "running", pid = pid, host = socket.gethostname())
+            os.mkdir(os.path.join(self.folder.name, snp.tmp_name(name)))
+        catalog.save()
+
+        orphan = snp.tmp_name("2022-12-31-00_00_00")
+        os.mkdir(os.path.join(self.folder.name, orphan))
+
+        snp.clean_backups(self.folder.name, 10, mode = "deferred")
+        trash = sorted(os.listdir(os.path.join(self.folder.name, ".trash")))
+        self.assertEqual(trash, sorted([snp.tmp_name("2023-01-01-00_00_00"), orphan]))
+        self.assertTrue(os.path.isdir(os.path.join(self.folder.name, snp.tmp_name("2023-01-02-00_00_00"))))
+
+        entries = {e["name"] : e["status"] for e in snp.Catalog.load(self.folder.name).snapshots(status = None)}
+        self.assertEqual(entries["2023-01-01-00_00_00"], "failed")
+        self.assertEqual(entries["2023-01-02-00_00_00"], "running")
+
+    @unittest.mock.patch("snappy.snappy.reap", side_effect = PermissionError("Permission denied"))
+    def test_clean_backups_reap_error(self, mock):
+
+        # - old backups that cannot be deleted stay in the trash
+
+        self.assertIsNone(snp.clean_backups(self.folder.name, 3))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder.name, ".trash"))), self.folders[:2])
+        self.assertEqual(mock.call_count, 1)
+
     def test_clean_backups_delete_n_is_one(self):
 
         size = 1
@@ -76,9 +113,23 @@ class TestFolders(unittest.TestCase):
         for f in fl[:size]:
             self.assertTrue(os.path.exists(os.path.join(self.folder.name, f)))
 
-        for f in fl[size]:
+        for f in fl[size:]:
             self.assertFalse(os.path.exists(os.path.join(self.folder.name, f)))
 
+    def test_link_dest_args(self):
+
+        backups = [os.path.join(self.folder.name, f) for f in self.folders]
+        dest = snp.get_destination(self.folder.name)
+        os.rmdir(backups[1])
+
+        args = snp._link_dest_args(dest, backups, 4)
+        self.assertEqual(args, [f"--link-dest={backups[idx]}" for idx in [4, 3, 2]])
+        self.assertEqual(snp._link_dest_args(dest, backups), [f"--link-dest={backups[-1]}"])
+        self.assertEqual(snp._link_dest_args(dest, [], 4), [])
+
+        with self.assertRaises(ValueError):
+            snp.snap_backup([], self.folder.name, link_dest = 21)
+
     def test_list_non_readable_empty(self):
 
         file = "a.txt"
@@ -154,8 +205,16 @@ class TestCreateSnapshot(unittest.TestCase):
         self.sources = ["A", "B"]
         self.create_test_folders(self.folder.name)
 
+        # - scan indexes and other caches go to a temporary home
+
+        self.home = tempfile.TemporaryDirectory()
+        patcher = unittest.mock.patch.dict(os.environ, {"HOME" : self.home.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def tearDown(self) -> None:
         self.folder.cleanup()
+        self.home.cleanup()
 
     def test_destination_no_trailing_slash(self):
 
@@ -193,6 +252,121 @@ class TestCreateSnapshot(unittest.TestCase):
             with self.assertRaises(FileNotFoundError):
                 snp.create_snapshot(src, dst)
         
+    def test_parallel_sources(self):
+
+        src = [os.path.join(self.folder.name, s) for s in self.sources]
+        files = ["A/a.txt", "B/b.txt", "B/C/c.txt"]
+
+        with tempfile.TemporaryDirectory() as dst:
+            snp.create_snapshot(src, dst, max_workers = 2)
+            match, mismatch, errors = filecmp.cmpfiles(self.folder.name, dst, files)
+
+        self.assertEqual(match, files)
+
+    @unittest.mock.patch("snappy.snappy.rsync")
+    def test_parallel_sources_failure(self, mock):
+
+        def fake_rsync(src, dst, options = None, log = None, on_line = None, pressure = None):
+            returncode = 23 if src.endswith("A") else 0
+            return subprocess.CompletedProcess([src, dst], returncode, "", "failed")
+
+        mock.side_effect = fake_rsync
+        src = [os.path.join(self.folder.name, s) for s in self.sources]
+
+        with tempfile.TemporaryDirectory() as dst:
+            with self.assertRaises(snp.RsyncError):
+                snp.create_snapshot(src, dst, max_workers = 2)
+
+        # - A is sent again once after a full scan
+
+        self.assertEqual(mock.call_count, 3)
+
+    @unittest.mock.patch("snappy.scan.RACY_SECONDS", 0)
+    @unittest.mock.patch("snappy.snappy.rsync")
+    def test_file_made_non_readable_is_rescanned(self, mock):
+
+        # - a chmod does not change the folder, so the cached scan
+        # - misses the file until rsync fails to read it
+
+        src = os.path.abspath(os.path.join(self.folder.name, "A"))
+        bad = os.path.join(src, "a.txt")
+        readable = {bad : True}
+        calls = []
+
+        def fake_rsync(src, dst, options = None, log = None, on_line = None, pressure = None):
+            calls.append(options)
+            excluded = any(opt.endswith("/A/a.txt") for opt in options if opt.startswith("--exclude="))
+            if readable[bad] or excluded:
+                return subprocess.CompletedProcess([src, dst], 0, "", "")
+            return subprocess.CompletedProcess([src, dst], 23, "", f'rsync: send_files failed to open "{bad}": Permission denied (13)')
+
+        mock.side_effect = fake_rsync
+        access = lambda path, mode: readable.get(path, True)
+
+        with tempfile.TemporaryDirectory() as cache, tempfile.TemporaryDirectory() as dst:
+            with unittest.mock.patch("snappy.scan.cache_loc", return_value = cache), unittest.mock.patch("snappy.scan.os.access", side_effect = access):
+                snp.create_snapshot([src], dst)
+                readable[bad] = False
+                snp.create_snapshot([src], dst)
+
+        self.assertEqual(len(calls), 3)
+        self.assertFalse(any(opt.startswith("--exclude=") for opt in calls[1]))
+        self.assertIn("--exclude=/A/a.txt", calls[2])
+
+    @unittest.mock.patch("snappy.snappy.is_rsync_installed", return_value = True)
+    @unittest.mock.patch("snappy.snappy.create_snapshot", side_effect = KeyboardInterrupt)
+    def test_interrupt_rollback(self, mock, _):
+
+        # - Ctrl-C, or a stopping daemon, removes the temporary folder
+
+        src = [os.path.join(self.folder.name, s) for s in self.sources]
+        with tempfile.TemporaryDirectory() as dst:
+            with self.assertRaises(KeyboardInterrupt):
+                snp.snap_backup(src, dst)
+
+            self.assertEqual([f for f in os.listdir(dst) if not f.startswith(".")], [])
+            entries = snp.Catalog.load(dst).snapshots(status = None)
+            self.assertEqual([e["status"] for e in entries], ["failed"])
+
+    def test_batch_entry(self):
+
+        self.assertEqual(snp._batch_entry("/home/u/docs"), "home/u/./docs")
+        self.assertEqual(snp._batch_entry("/home/u/docs/"), "home/u/docs/./")
+        self.assertEqual(snp._batch_entry("/etc"), "./etc")
+
+    @unittest.mock.patch("snappy.snappy.rsync")
+    def test_batch_sources(self, mock):
+
+        listed = []
+
+        def fake_rsync(src, dst, options = None, log = None, on_line = None, pressure = None):
+            files = [opt.split("=", 1)[1] for opt in options if opt.startswith("--files-from=")]
+            with open(files[0], "rb") as f:
+                listed.extend(f.read().split(b"\0")[:-1])
+            return subprocess.CompletedProcess([src, dst], 0, "", "")
+
+        mock.side_effect = fake_rsync
+        src = [os.path.join(self.folder.name, s) for s in self.sources]
+
+        with tempfile.TemporaryDirectory() as dst:
+            stats = snp.create_snapshot(src, dst, batch = True)
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(listed, [snp._batch_entry(os.path.abspath(s)).encode("utf8") for s in src])
+
+    def test_batch_errors_are_mapped_to_sources(self):
+
+        src = [os.path.join(self.folder.name, s) for s in self.sources]
+        stderr = f'rsync: [sender] send_files failed to open "{src[0]}/./a.txt": Permission denied (13)\n'
+        output = subprocess.CompletedProcess([], 23, "", stderr)
+
+        with self.assertRaisesRegex(snp.RsyncError, "rsync failed for") as ctx:
+            snp._check_batch_output(src, output)
+
+        self.assertIn(src[0], str(ctx.exception))
+        self.assertNotIn(src[1], str(ctx.exception))
+
     def test_expand_tilde(self):
 
         files = ["A/a.txt", "B/b.txt", "B/C/c.txt"]
@@ -0,0 +1,56 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from snappy import spans
+
+
+class TestSpans(unittest.TestCase):
+
+    def tearDown(self) -> None:
+        spans.disable()
+        spans.tracer.reset()
+
+    def test_disabled(self):
+
+        with spans.span("phase"):
+            pass
+
+        self.assertIs(spans.span("phase"), spans.span("other"))
+        self.assertEqual(spans.tracer.spans, [])
+
+    def test_summary(self):
+
+        spans.enable()
+        with spans.span("scan", "/a"):
+            sum(range(10000))
+        with spans.span("scan", "/a"):
+            pass
+        with spans.span("rsync", "/a"):
+            pass
+
+        rows = spans.tracer.summary()
+        self.assertEqual([(r[0], r[1], r[2]) for r in rows], [("scan", "/a", 2), ("rsync", "/a", 1)])
+        self.assertTrue(all(r[3] >= 0 and r[4] >= 0 for r in rows))
+
+    def test_threads(self):
+
+        spans.enable()
+
+        def work(src):
+            with spans.span("rsync", src):
+                pass
+
+        with ThreadPoolExecutor(max_workers = 4) as pool:
+            list(pool.map(work, [f"/src{idx}" for idx in range(20)]))
+
+        self.assertEqual(len(spans.tracer.summary()), 20)
+
+    def test_table(self):
+
+        spans.enable()
+        with spans.span("mv"):
+            pass
+
+        lines = spans.tracer.table().split("\n")
+        self.assertTrue(lines[0].startswith("Phase"))
+        self.assertTrue(lines[2].startswith("mv"))
+        self.assertIn(" - ", lines[2])
@@ -0,0 +1,107 @@
+import json
+import datetime
+import unittest
+from snappy import stats
+
+
+OUTPUT = """sending incremental file list
+>f+++++++++ A/a.txt
+cd+++++++++ A/B/
+>f.st...... A/changed.txt
+*deleting   A/old.txt
+hf+++++++++ A/linked.txt
+
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 10 (reg: 10)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 11
+Total file size: 123,456,789 bytes
+Total transferred file size: 1,048,576 bytes
+Literal data: 1,000,000 bytes
+Matched data: 48,576 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 1,100,000
+Total bytes received: 300
+
+sent 1,100,000 bytes  received 300 bytes  2,200,600.00 bytes/sec
+total size is 123,456,789  speedup is 112.20
+"""
+
+OLD_OUTPUT = """Number of files: 20
+Number of files transferred: 5
+Total file size: 2048 bytes
+Total transferred file size: 512 bytes
+Literal data: 512 bytes
+Matched data: 0 bytes
+"""
+
+
+class TestTransferStats(unittest.TestCase):
+
+    def parse(self, text, seconds = 2.0):
+
+        st = stats.TransferStats("/src")
+        for line in text.splitlines():
+            st.feed(line)
+        st.seconds = seconds
+        return st
+
+    def test_parse_summary(self):
+
+        st = self.parse(OUTPUT)
+        self.assertEqual(st.files, 1234)
+        self.assertEqual(st.files_created, 10)
+        self.assertEqual(st.files_deleted, 1)
+        self.assertEqual(st.files_transferred, 11)
+        self.assertEqual(st.total_size, 123456789)
+        self.assertEqual(st.transferred_size, 1048576)
+        self.assertEqual(st.literal_data, 1000000)
+        self.assertEqual(st.matched_data, 48576)
+        self.assertEqual(st.bytes_sent, 1100000)
+        self.assertEqual(st.bytes_received, 300)
+        self.assertAlmostEqual(st.mb_per_second, 0.5)
+
+    def test_parse_itemized(self):
+
+        st = self.parse(OUTPUT)
+        self.assertEqual(st.itemized_created, 2)
+        self.assertEqual(st.itemized_updated, 1)
+        self.assertEqual(st.itemized_deleted, 1)
+        self.assertEqual(st.itemized_hardlinked, 1)
+
+    def test_unchanged_and_copied(self):
+
+        # - a changed file counts in full, though only its literal data
+        # - was sent
+
+        st = self.parse(OUTPUT)
+        self.assertEqual(st.copied_size, 1048576)
+        self.assertEqual(st.unchanged_size, 123456789 - 1048576)
+        self.assertEqual(st.to_dict()["unchanged_size"], st.unchanged_size)
+        self.assertNotIn("linked_size", st.to_dict())
+        self.assertIn("MB unchanged", str(st))
+
+    def test_parse_old_rsync(self):
+
+        st = self.parse(OLD_OUTPUT)
+        self.assertEqual(st.files, 20)
+        self.assertEqual(st.files_transferred, 5)
+        self.assertEqual(st.total_size, 2048)
+
+    def test_snapshot_result(self):
+
+        start = datetime.datetime(2023, 1, 1, 0, 0, 0)
+        end = start + datetime.timedelta(seconds = 3)
+        sources = [self.parse(OUTPUT), self.parse(OLD_OUTPUT)]
+        result = stats.SnapshotResult("2023-01-01-00_00_00", "/backup", start, end, False, sources)
+
+        total = result.total
+        self.assertEqual(total.files, 1254)
+        self.assertEqual(total.seconds, 3)
+        self.assertEqual(str(result), "2023-01-01-00_00_00")
+
+        data = json.loads(result.to_json())
+        self.assertEqual(data["total"]["total_size"], 123456789 + 2048)
+        self.assertEqual(len(data["sources"]), 2)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+from snappy import verify
+from snappy.catalog import Catalog
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.folder.name, "src")
+        self.backups = os.path.join(self.folder.name, "backups")
+        os.makedirs(os.path.join(self.src, "B"))
+        os.makedirs(self.backups)
+        self.write("a.txt", "This is file A")
+        self.write("B/b.txt", "This is file B")
+        self.write("skip.log", "Excluded")
+        self.catalog = Catalog(self.backups)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def write(self, rel, text, mtime = 1_600_000_000):
+        path = os.path.join(self.src, rel)
+        with open(path, "w") as f:
+            f.write(text)
+        os.utime(path, (mtime, mtime))
+
+    def snapshot(self, name, link = None):
+
+        # - a copy of the source, with hard links to the snapshot link
+        # - as rsync --link-dest makes them
+
+        dst = os.path.join(self.backups, name, "src")
+        copy = (lambda s, d: os.link(os.path.join(self.backups, link, "src", os.path.relpath(s, self.src)), d)) if link else shutil.copy2
+        shutil.copytree(self.src, dst, copy_function = copy, ignore = shutil.ignore_patterns("*.log"))
+        start = datetime.datetime.now() + datetime.timedelta(minutes = 1)
+        self.catalog.update(name, status = "complete", start = start.isoformat(timespec = "seconds"), sources = [self.src])
+        self.catalog.save()
+        return dst
+
+    def verify(self, snapshot = None, mode = "sources"):
+        return verify.verify(self.backups, snapshot, mode, workers = 2, exclude = ["*.log"])
+
+    def test_intact_snapshot(self):
+
+        self.snapshot("2023-01-01-00_00_00")
+        stats = self.verify()
+        self.assertTrue(stats.ok)
+        self.assertEqual((stats.files, stats.reused), (2, 0))
+        self.assertTrue(os.path.exists(os.path.join(self.backups, verify.MANIFESTS, "2023-01-01-00_00_00.json")))
+
+        # - the next snapshot only hashes its own files
+
+        self.write("a.txt", "This is file C", mtime = 1_700_000_000)
+        dst = self.snapshot("2023-01-02-00_00_00", link = "2023-01-01-00_00_00")
+        os.unlink(os.path.join(dst, "a.txt"))
+        shutil.copy2(os.path.join(self.src, "a.txt"), os.path.join(dst, "a.txt"))
+
+        stats = self.verify()
+        self.assertTrue(stats.ok)
+        self.assertEqual(stats.reused, 1)
+
+    def test_damaged_and_missing_files(self):
+
+        dst = self.snapshot("2023-01-01-00_00_00")
+        with open(os.path.join(dst, "B", "b.txt"), "w") as f:
+            f.write("This is file X")
+        os.utime(os.path.join(dst, "B", "b.txt"), (1_600_000_000, 1_600_000_000))
+        os.unlink(os.path.join(dst, "a.txt"))
+
+        stats = self.verify()
+        self.assertFalse(stats.ok)
+        self.assertEqual(stats.mismatched, [os.path.join("src", "B", "b.txt")])
+        self.assertEqual(stats.missing, [os.path.join("src", "a.txt")])
+
+    def test_changed_source_is_skipped(self):
+
+        self.snapshot("2023-01-01-00_00_00")
+        self.write("a.txt", "This is file C", mtime = 1_700_000_000)
+
+        stats = self.verify()
+        self.assertTrue(stats.ok)
+        self.assertEqual(stats.changed, [os.path.join("src", "a.txt")])
+
+    def test_excluded_folder(self):
+
+        # - files of an excluded folder are not in the snapshot and are
+        # - not missing
+
+        os.makedirs(os.path.join(self.src, "cache"))
+        self.write("cache/junk", "Excluded")
+        dst = self.snapshot("2023-01-01-00_00_00")
+        shutil.rmtree(os.path.join(dst, "cache"))
+
+        for pattern in ["cache/", "/src/cache", "cache"]:
+            stats = verify.verify(self.backups, mode = "sources", workers = 1, exclude = ["*.log", pattern])
+            self.assertTrue(stats.ok, pattern)
+            self.assertEqual(stats.missing, [])
+
+    def test_manifest(self):
+
+        dst = self.snapshot("2023-01-01-00_00_00")
+        with self.assertRaises(ValueError):
+            self.verify(mode = "manifest")
+
+        self.verify()
+        self.assertTrue(self.verify("2023-01-01-00_00_00", mode = "manifest").ok)
+
+        with open(os.path.join(dst, "a.txt"), "r+") as f:
+            f.write("X")
+
+        stats = self.verify(mode = "manifest")
+        self.assertEqual(stats.mismatched, [os.path.join("src", "a.txt")])